@@ -0,0 +1,15 @@
+"""
+Нагрузочные прогоны перед релизом.
+
+Схема — из миграций (как в datab.txt), данные генерируются в Postgres через
+generate_series, поэтому миллионы заявок и платежей заливаются за минуты.
+Прогон поднимает backend.main:app под uvicorn вместе с локальными fake OpenAI и
+SMTP-приёмником и бьёт по горячим эндпоинтам.
+
+    python -m backend.bench seed --clients 100000 --tickets 2000000 --payments 5000000 --reset
+    python -m backend.bench run --duration 30 --concurrency 32 --out bench.json
+    python -m backend.bench run --baseline bench/baseline.json   # код 1 при регрессии
+    python -m backend.bench compare bench.json bench/baseline.json
+
+База берётся из APP_DATABASE_URL — не запускайте seed --reset на рабочей базе.
+"""
@@ -0,0 +1,88 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+from . import runner
+from .seed import dataset, seed
+
+
+def main(argv=None) -> int:
+    from ..services.db import engine
+
+    parser = argparse.ArgumentParser(prog="python -m backend.bench", description="Нагрузочные прогоны")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p_seed = commands.add_parser("seed", help="Залить синтетические данные")
+    p_seed.add_argument("--clients", type=int, default=100_000)
+    p_seed.add_argument("--tickets", type=int, default=1_000_000)
+    p_seed.add_argument("--payments", type=int, default=2_000_000)
+    p_seed.add_argument("--reset", action="store_true", help="Очистить таблицы перед заливкой")
+
+    p_run = commands.add_parser("run", help="Прогнать сценарии")
+    p_run.add_argument("--scenarios", default=",".join(runner.SCENARIOS), help="Через запятую")
+    p_run.add_argument("--duration", type=float, default=30)
+    p_run.add_argument("--warmup", type=float, default=5)
+    p_run.add_argument("--concurrency", type=int, default=32)
+    p_run.add_argument("--workers", type=int, default=1, help="Воркеры uvicorn")
+    p_run.add_argument("--target", default=None, help="URL уже запущенного сервера вместо своего стенда")
+    p_run.add_argument("--ai-latency", type=float, default=0.3, help="Задержка fake OpenAI, с")
+    p_run.add_argument("--ai-jitter", type=float, default=0.2)
+    p_run.add_argument("--ai-error-rate", type=float, default=0.0)
+    p_run.add_argument("--out", default=None, help="Сохранить результат в JSON")
+    p_run.add_argument("--baseline", default=None, help="JSON прошлого прогона; код 1 при регрессии")
+
+    p_compare = commands.add_parser("compare", help="Сравнить два сохранённых прогона")
+    p_compare.add_argument("current")
+    p_compare.add_argument("baseline")
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    if args.command == "seed":
+        totals = seed(engine, args.clients, args.tickets, args.payments, reset=args.reset)
+        print("Залито: " + ", ".join(f"{k} {v}" for k, v in totals.items()))
+        return 0
+
+    if args.command == "compare":
+        current, baseline = runner.load(args.current), runner.load(args.baseline)
+        return _report(current, baseline)
+
+    names = [n.strip() for n in args.scenarios.split(",") if n.strip()]
+    unknown = [n for n in names if n not in runner.SCENARIOS]
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(unknown)}; есть: {', '.join(runner.SCENARIOS)}")
+
+    data = dataset(engine)
+    if not data["clients"]:
+        parser.error("база пуста — сначала python -m backend.bench seed")
+
+    async def go(base_url: str) -> dict:
+        return await runner.run(base_url, names, data, args.duration, args.concurrency, args.warmup)
+
+    if args.target:
+        result = asyncio.run(go(args.target))
+    else:
+        with runner.stack(args.workers, args.ai_latency, args.ai_jitter, args.ai_error_rate) as base_url:
+            result = asyncio.run(go(base_url))
+    result["meta"].update(workers=args.workers, ai_latency=args.ai_latency, ai_error_rate=args.ai_error_rate)
+
+    if args.out:
+        runner.save(result, args.out)
+    return _report(result, runner.load(args.baseline) if args.baseline else None)
+
+
+def _report(result: dict, baseline=None) -> int:
+    print(runner.format_report(result, baseline))
+    if baseline is None:
+        return 0
+    problems = runner.compare(result, baseline)
+    for problem in problems:
+        print(f"РЕГРЕССИЯ {problem}")
+    if not problems:
+        print("OK: в пределах допусков базовой линии")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
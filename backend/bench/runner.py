@@ -0,0 +1,357 @@
+"""
+Прогон сценариев против живого сервера и сравнение с базовой линией.
+
+Каждый сценарий гоняется отдельно: warmup секунд без учёта, затем duration секунд
+с concurrency одновременными клиентами. Число SQL-запросов на запрос берётся из
+/metrics сервера (разница гистограммы app_http_request_sql_queries до и после),
+поэтому при нескольких воркерах uvicorn это оценка по одному из процессов.
+"""
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+import httpx
+
+from ..services.security import create_access_token, create_operator_token
+from .seed import phone
+
+logger = logging.getLogger(__name__)
+
+# Допуски для compare(): во сколько раз можно ухудшиться, не считая это регрессией
+P95_TOLERANCE = 0.20
+RPS_TOLERANCE = 0.20
+ERROR_RATE_TOLERANCE = 0.01
+# Число запросов к БД детерминировано — любой рост это регрессия (0.5 — на шум средних)
+QUERIES_TOLERANCE = 0.5
+
+
+# ----------------------------
+# Сценарии
+# ----------------------------
+@dataclass
+class Context:
+    clients: int
+    tickets: int
+    rng: random.Random
+
+    def client(self) -> Tuple[int, dict]:
+        i = self.rng.randint(1, max(1, self.clients))
+        return i, {"Authorization": f"Bearer {create_access_token(i, phone(i))}"}
+
+    def operator(self) -> dict:
+        # Оператор в БД не нужен: токен проверяется без запроса к ней
+        return {"Authorization": f"Bearer {create_operator_token(0, 'bench')}"}
+
+    def ticket_id(self) -> int:
+        return self.rng.randint(1, max(1, self.tickets))
+
+
+@dataclass
+class Scenario:
+    name: str
+    method: str
+    route: str  # шаблон маршрута, как в метках /metrics
+    build: Callable[[Context], dict]  # аргументы httpx.request: url, json, headers, params
+
+
+TICKET_TEXTS = (
+    "Не работает интернет с утра, роутер мигает красным",
+    "Хочу подключить интернет по новому адресу",
+    "Почему списали больше, чем обычно?",
+    "Недоволен качеством связи, верните деньги",
+)
+CHAT_MESSAGES = ("Какой у меня баланс?", "Есть ли у меня задолженность?", "Какой у меня тариф?")
+
+
+def _ticket_create(ctx: Context) -> dict:
+    _, headers = ctx.client()
+    text = ctx.rng.choice(TICKET_TEXTS)
+    return {"url": "/api/tickets", "headers": headers, "json": {"subject": text[:30], "text": text}}
+
+
+def _operator_list(ctx: Context) -> dict:
+    params = ctx.rng.choice(({}, {"status": "new"}, {"category": "инцидент"}, {"assigned_to": "operator3"}))
+    return {"url": "/api/operator/tickets", "headers": ctx.operator(), "params": {**params, "limit": 50}}
+
+
+def _chat(ctx: Context) -> dict:
+    _, headers = ctx.client()
+    return {"url": "/api/ai/chat_with_db", "headers": headers, "json": {"message": ctx.rng.choice(CHAT_MESSAGES)}}
+
+
+SCENARIOS: Dict[str, Scenario] = {s.name: s for s in (
+    Scenario("ticket_create", "POST", "/api/tickets", _ticket_create),
+    Scenario("operator_list", "GET", "/api/operator/tickets", _operator_list),
+    Scenario(
+        "operator_history", "GET", "/api/operator/tickets/{ticket_id}/history",
+        lambda ctx: {"url": f"/api/operator/tickets/{ctx.ticket_id()}/history", "headers": ctx.operator()},
+    ),
+    Scenario("users_me", "GET", "/api/users/me", lambda ctx: {"url": "/api/users/me", "headers": ctx.client()[1]}),
+    Scenario("payments", "GET", "/api/payments", lambda ctx: {"url": "/api/payments", "headers": ctx.client()[1]}),
+    Scenario(
+        "payments_summary", "GET", "/api/payments/summary",
+        lambda ctx: {"url": "/api/payments/summary", "headers": ctx.client()[1]},
+    ),
+    Scenario("chat", "POST", "/api/ai/chat_with_db", _chat),
+)}
+
+
+# ----------------------------
+# Окружение: fake OpenAI, SMTP-приёмник, приложение
+# ----------------------------
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _wait_ready(url: str, process: Optional[subprocess.Popen] = None, timeout: float = 30) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Процесс завершился с кодом {process.returncode}: {' '.join(process.args)}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} не ответил за {timeout} с")
+
+
+def _wait_port(port: int, timeout: float = 10) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Порт {port} не открылся за {timeout} с")
+
+
+@contextmanager
+def stack(workers: int = 1, ai_latency: float = 0.3, ai_jitter: float = 0.2, ai_error_rate: float = 0.0) -> Iterator[str]:
+    """Поднимает fake OpenAI, SMTP-приёмник и uvicorn с приложением; отдаёт базовый URL."""
+    ai_port, smtp_port, app_port = _free_port(), _free_port(), _free_port()
+    processes: List[subprocess.Popen] = []
+    try:
+        processes.append(subprocess.Popen([
+            sys.executable, "-m", "backend.fakes.openai_server", "--port", str(ai_port),
+            "--latency", str(ai_latency), "--jitter", str(ai_jitter), "--error-rate", str(ai_error_rate),
+        ]))
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "backend.fakes.smtp_sink", "--port", str(smtp_port)],
+            stdout=subprocess.DEVNULL,
+        ))
+        _wait_ready(f"http://127.0.0.1:{ai_port}/_control", processes[0])
+        _wait_port(smtp_port)
+
+        env = {
+            **os.environ,
+            "APP_OPENAI_BASE_URL": f"http://127.0.0.1:{ai_port}/v1",
+            "APP_OPENAI_API_KEY": "bench",
+            "APP_EMAIL_HOST": "127.0.0.1",
+            "APP_EMAIL_PORT": str(smtp_port),
+            "APP_SMTP_STARTTLS": "false",
+            # Медленные запросы под нагрузкой — норма, лог только мешает
+            "APP_METRICS_SLOW_REQUEST_MS": "0",
+        }
+        app = subprocess.Popen([
+            sys.executable, "-m", "uvicorn", "backend.main:app",
+            "--port", str(app_port), "--workers", str(workers), "--log-level", "warning", "--no-access-log",
+        ], env=env)
+        processes.append(app)
+        base_url = f"http://127.0.0.1:{app_port}"
+        _wait_ready(f"{base_url}/metrics", app, timeout=60)
+        yield base_url
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+# ----------------------------
+# Нагрузка
+# ----------------------------
+_SQL_METRIC = re.compile(
+    r'^app_http_request_sql_(queries|seconds)_(sum|count)\{method="([^"]*)",route="([^"]*)"\} (\S+)$', re.M
+)
+
+
+async def _sql_totals(http: httpx.AsyncClient) -> Dict[Tuple[str, str], dict]:
+    totals: Dict[Tuple[str, str], dict] = {}
+    text = (await http.get("/metrics")).text
+    for kind, part, method, route, value in _SQL_METRIC.findall(text):
+        totals.setdefault((method, route), {})[f"{kind}_{part}"] = float(value)
+    return totals
+
+
+def percentile(ordered: List[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def run_scenario(
+    http: httpx.AsyncClient, scenario: Scenario, ctx: Context, duration: float, concurrency: int, warmup: float,
+) -> dict:
+    latencies: List[float] = []
+    statuses: Dict[int, int] = {}
+    errors = 0
+
+    async def worker(deadline: float, record: bool) -> None:
+        nonlocal errors
+        while time.monotonic() < deadline:
+            request = scenario.build(ctx)
+            started = time.perf_counter()
+            try:
+                response = await http.request(scenario.method, **request)
+                status = response.status_code
+            except httpx.HTTPError:
+                status = 0
+            elapsed = time.perf_counter() - started
+            if not record:
+                continue
+            statuses[status] = statuses.get(status, 0) + 1
+            if 200 <= status < 300:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    if warmup:
+        deadline = time.monotonic() + warmup
+        await asyncio.gather(*(worker(deadline, False) for _ in range(concurrency)))
+
+    before = await _sql_totals(http)
+    started = time.monotonic()
+    deadline = started + duration
+    await asyncio.gather(*(worker(deadline, True) for _ in range(concurrency)))
+    elapsed = time.monotonic() - started
+    after = await _sql_totals(http)
+
+    key = (scenario.method, scenario.route)
+    sql_before, sql_after = before.get(key, {}), after.get(key, {})
+    served = sql_after.get("queries_count", 0) - sql_before.get("queries_count", 0)
+    queries = sql_after.get("queries_sum", 0) - sql_before.get("queries_sum", 0)
+    sql_seconds = sql_after.get("seconds_sum", 0) - sql_before.get("seconds_sum", 0)
+
+    ordered = sorted(latencies)
+    total = len(latencies) + errors
+    return {
+        "requests": total,
+        "errors": errors,
+        "error_rate": round(errors / total, 4) if total else 0.0,
+        "statuses": {str(k): v for k, v in sorted(statuses.items())},
+        "rps": round(len(latencies) / elapsed, 2),
+        "p50_ms": round(percentile(ordered, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(ordered, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(ordered, 0.99) * 1000, 2),
+        "max_ms": round(ordered[-1] * 1000, 2) if ordered else 0.0,
+        "db_queries_per_request": round(queries / served, 2) if served else None,
+        "db_ms_per_request": round(sql_seconds / served * 1000, 2) if served else None,
+    }
+
+
+async def run(
+    base_url: str,
+    scenarios: List[str],
+    dataset: dict,
+    duration: float,
+    concurrency: int,
+    warmup: float,
+    seed: int = 1,
+) -> dict:
+    ctx = Context(dataset["clients"], dataset["tickets"], random.Random(seed))
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    results = {}
+    async with httpx.AsyncClient(base_url=base_url, timeout=60, limits=limits) as http:
+        for name in scenarios:
+            logger.info("Сценарий %s: %d с, %d клиентов", name, duration, concurrency)
+            results[name] = await run_scenario(http, SCENARIOS[name], ctx, duration, concurrency, warmup)
+    return {
+        "meta": {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "duration": duration,
+            "concurrency": concurrency,
+            "dataset": dataset,
+            "commit": _git_commit(),
+        },
+        "scenarios": results,
+    }
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ----------------------------
+# Отчёт и сравнение
+# ----------------------------
+def compare(current: dict, baseline: dict) -> List[str]:
+    """Регрессии относительно базовой линии; пустой список — всё в допуске."""
+    problems = []
+    for name, base in baseline.get("scenarios", {}).items():
+        now = current.get("scenarios", {}).get(name)
+        if now is None:
+            continue
+        if base["p95_ms"] and now["p95_ms"] > base["p95_ms"] * (1 + P95_TOLERANCE):
+            problems.append(f"{name}: p95 {base['p95_ms']} → {now['p95_ms']} мс")
+        if base["rps"] and now["rps"] < base["rps"] * (1 - RPS_TOLERANCE):
+            problems.append(f"{name}: RPS {base['rps']} → {now['rps']}")
+        if now["error_rate"] > base["error_rate"] + ERROR_RATE_TOLERANCE:
+            problems.append(f"{name}: ошибки {base['error_rate']:.2%} → {now['error_rate']:.2%}")
+        base_q, now_q = base.get("db_queries_per_request"), now.get("db_queries_per_request")
+        if base_q is not None and now_q is not None and now_q > base_q + QUERIES_TOLERANCE:
+            problems.append(f"{name}: запросов к БД {base_q} → {now_q}")
+    return problems
+
+
+def format_report(result: dict, baseline: Optional[dict] = None) -> str:
+    header = f"{'сценарий':<18}{'RPS':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'ошибки':>9}{'SQL/запр':>10}{'SQL мс':>9}"
+    lines = [header, "-" * len(header)]
+    base = (baseline or {}).get("scenarios", {})
+    for name, r in result["scenarios"].items():
+        lines.append(
+            f"{name:<18}{r['rps']:>9}{r['p50_ms']:>9}{r['p95_ms']:>9}{r['p99_ms']:>9}"
+            f"{r['error_rate']:>9.2%}{_dash(r['db_queries_per_request']):>10}{_dash(r['db_ms_per_request']):>9}"
+        )
+        if name in base:
+            b = base[name]
+            lines.append(
+                f"{'  база':<18}{b['rps']:>9}{b['p50_ms']:>9}{b['p95_ms']:>9}{b['p99_ms']:>9}"
+                f"{b['error_rate']:>9.2%}{_dash(b.get('db_queries_per_request')):>10}{_dash(b.get('db_ms_per_request')):>9}"
+            )
+    return "\n".join(lines)
+
+
+def _dash(value) -> str:
+    return "—" if value is None else str(value)
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save(result: dict, path: str) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(result, f, ensure_ascii=False, indent=2)
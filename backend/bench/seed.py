@@ -0,0 +1,142 @@
+"""
+Синтетические данные для нагрузочных прогонов.
+
+Всё генерируется на стороне Postgres (INSERT ... SELECT FROM generate_series)
+пачками по SEED_CHUNK строк, каждая пачка — своя транзакция. Данные детерминированы
+по номеру строки: клиент i имеет телефон phone(i), поэтому прогон может выдать
+токены, не читая базу.
+"""
+import logging
+import time
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from .. import migrations
+
+logger = logging.getLogger(__name__)
+
+SEED_CHUNK = 500_000
+
+# Таблицы, которые seed --reset очищает (порядок не важен: TRUNCATE ... CASCADE)
+TABLES = (
+    "clients", "tickets", "comments", "payments", "payment_monthly", "payment_summary",
+    "ai_logs", "notifications", "chat_sessions", "chat_messages",
+    "ticket_status_events", "ticket_facts", "analytics_ticket_hourly", "analytics_sla_hourly",
+)
+
+
+def phone(i: int) -> str:
+    return "+7700" + str(i).zfill(7)
+
+
+_CLIENTS = text("""
+INSERT INTO clients (full_name, phone, email, tariff, services, balance, debt, created_at)
+SELECT
+    'Клиент ' || i,
+    '+7700' || lpad(i::text, 7, '0'),
+    'client' || i || '@bench.local',
+    (ARRAY['Базовый', 'Стандарт', 'Премиум'])[1 + i % 3],
+    '["internet", "tv"]'::json,
+    round((random() * 20000)::numeric, 2),
+    CASE WHEN i % 10 = 0 THEN round((random() * 3000)::numeric, 2) ELSE 0 END,
+    now() - (i % 2000) * interval '1 day'
+FROM generate_series(:start, :stop) AS i
+""")
+
+# Тексты подобраны так, чтобы fake OpenAI и локальный классификатор раскладывали их по разным категориям
+_TICKETS = text("""
+INSERT INTO tickets (client_id, client_phone, subject, text, channel, category, priority, status,
+                     created_at, updated_at, assigned_to, enrichment_status, enrichment_attempts)
+SELECT
+    c,
+    '+7700' || lpad(c::text, 7, '0'),
+    (ARRAY['Нет интернета', 'Подключение', 'Вопрос по счёту', 'Жалоба', 'Смена тарифа'])[1 + t % 5],
+    (ARRAY[
+        'Не работает интернет с утра, роутер мигает красным',
+        'Хочу подключить интернет по новому адресу после переезда',
+        'Почему в этом месяце списали больше, чем обычно?',
+        'Недоволен качеством связи, верните деньги за простой',
+        'Подскажите, как перейти на тариф Премиум'
+    ])[1 + t % 5] || ' #' || t,
+    (ARRAY['web', 'web', 'email', 'telegram'])[1 + t % 4],
+    (ARRAY['инцидент', 'подключение', 'информация', 'жалоба', 'информация'])[1 + t % 5],
+    (ARRAY['normal', 'normal', 'normal', 'high', 'low'])[1 + t % 5],
+    (ARRAY['closed', 'closed', 'closed', 'in_progress', 'new'])[1 + t % 5],
+    created,
+    created + interval '1 hour',
+    CASE WHEN t % 5 = 3 THEN 'operator' || (t % 20) END,
+    'done',
+    0
+FROM (
+    SELECT t, 1 + t % :clients AS c, now() - random() * interval '730 days' AS created
+    FROM generate_series(:start, :stop) AS t
+) s
+""")
+
+_PAYMENTS = text("""
+INSERT INTO payments (client_id, amount, date, service, status)
+SELECT
+    1 + p % :clients,
+    round((500 + random() * 9500)::numeric, 2),
+    now() - random() * interval '1825 days',
+    (ARRAY['internet', 'internet', 'tv', 'mobile'])[1 + p % 4],
+    (ARRAY['completed', 'completed', 'completed', 'completed', 'completed',
+           'completed', 'completed', 'completed', 'pending', 'failed'])[1 + p % 10]
+FROM generate_series(:start, :stop) AS p
+""")
+
+_COMMENTS = text("""
+INSERT INTO comments (ticket_id, author, text, created_at)
+SELECT t.id, 'operator' || (t.id % 20), 'Проверили линию, ждём ответа клиента', t.created_at + interval '30 minutes'
+FROM tickets t
+WHERE t.id BETWEEN :start AND :stop AND t.id % 3 = 0
+""")
+
+
+def _chunked(engine: Engine, name: str, statement, total: int, **params) -> None:
+    started = time.monotonic()
+    for start in range(1, total + 1, SEED_CHUNK):
+        stop = min(total, start + SEED_CHUNK - 1)
+        with engine.begin() as conn:
+            conn.execute(statement, {"start": start, "stop": stop, **params})
+        logger.info("%s: %d/%d (%.0f с)", name, stop, total, time.monotonic() - started)
+
+
+def seed(engine: Engine, clients: int, tickets: int, payments: int, reset: bool = False) -> dict:
+    """Заливает данные и возвращает их объём. Без reset — только в пустую базу."""
+    migrations.upgrade(engine)
+    with engine.begin() as conn:
+        existing = conn.execute(text("SELECT count(*) FROM clients")).scalar_one()
+        if existing and not reset:
+            raise RuntimeError(f"В clients уже {existing} строк; для перезаливки передайте --reset")
+        if reset:
+            conn.execute(text(f"TRUNCATE {', '.join(TABLES)} RESTART IDENTITY CASCADE"))
+
+    _chunked(engine, "clients", _CLIENTS, clients)
+    _chunked(engine, "tickets", _TICKETS, tickets, clients=clients)
+    _chunked(engine, "comments", _COMMENTS, tickets)
+    # Триггеры свёрток на миллионах строк медленнее, чем пересчитать свёртки один раз
+    with engine.begin() as conn:
+        conn.execute(text("ALTER TABLE payments DISABLE TRIGGER USER"))
+    try:
+        _chunked(engine, "payments", _PAYMENTS, payments, clients=clients)
+    finally:
+        with engine.begin() as conn:
+            conn.execute(text("ALTER TABLE payments ENABLE TRIGGER USER"))
+    with engine.begin() as conn:
+        conn.execute(text("SELECT payment_rollups_rebuild()"))
+
+    # Свежая статистика, иначе планировщик первые минуты прогона считает таблицы пустыми
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM ANALYZE"))
+    return {"clients": clients, "tickets": tickets, "payments": payments}
+
+
+def dataset(engine: Engine) -> dict:
+    """Объём уже залитых данных — прогон по нему выбирает id и телефоны."""
+    with engine.connect() as conn:
+        clients, tickets = conn.execute(
+            text("SELECT (SELECT coalesce(max(id), 0) FROM clients), (SELECT coalesce(max(id), 0) FROM tickets)")
+        ).one()
+    return {"clients": clients, "tickets": tickets}
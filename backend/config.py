@@ -14,6 +14,21 @@ class Settings(BaseSettings):
     DB_HOST: str = Field("localhost", description="PostgreSQL host")
     DB_PORT: int = Field(5432, description="PostgreSQL port")
     DB_NAME: str = Field(..., description="PostgreSQL database name")
+
+    @property
+    def ASYNC_DATABASE_URL(self) -> str:
+        """URL для асинхронного движка (asyncpg)."""
+        return self.DATABASE_URL.replace("postgresql://", "postgresql+asyncpg://", 1)
+
+    # Connection Pool
+    DB_POOL_SIZE: int = Field(10, description="Постоянных соединений в пуле")
+    DB_MAX_OVERFLOW: int = Field(20, description="Дополнительных соединений сверх pool size")
+    DB_POOL_TIMEOUT: float = Field(10.0, description="Сколько секунд ждать свободное соединение")
+    DB_POOL_RECYCLE: int = Field(1800, description="Пересоздавать соединения старше N секунд")
+    DB_POOL_PRE_PING: bool = Field(True, description="Проверять соединение перед выдачей из пула")
+    DB_STATEMENT_TIMEOUT_MS: int = Field(30000, description="statement_timeout в мс (0 — без ограничения)")
+    DB_PGBOUNCER: bool = Field(False, description="Работа через PgBouncer в режиме transaction pooling")
+    DB_AUTO_MIGRATE: bool = Field(True, description="Применять миграции схемы при старте приложения")
     
     @property
     def DATABASE_URL(self) -> str:
@@ -27,11 +42,76 @@ class Settings(BaseSettings):
         )
 
     # Security Configuration
+    JWT_SECRET_KEY: str = Field(..., description="Secret key for signing JWT")
     JWT_ALGORITHM: str = Field("HS256", description="JWT signing algorithm")
     ACCESS_TOKEN_EXPIRE_MINUTES: int = Field(60, description="Token expiration in minutes")
+    OPERATOR_TOKEN_EXPIRE_MINUTES: int = Field(480, description="Срок действия токена оператора (смена)")
+    LOGIN_CODE_TTL_SECONDS: int = Field(300, description="Сколько действует код входа")
+    LOGIN_CODE_RESEND_SECONDS: int = Field(60, description="Не чаще одного нового кода на телефон за этот интервал")
+    LOGIN_CODE_MAX_ATTEMPTS: int = Field(5, description="Попыток ввода одного кода")
 
     # External Services
     OPENAI_API_KEY: str = Field(..., description="OpenAI API key")
+    OPENAI_BASE_URL: Optional[str] = Field(None, description="Другой адрес OpenAI API, например локальный fake-сервер")
+    AI_REQUEST_TIMEOUT: float = Field(30.0, description="Таймаут одного вызова OpenAI в секундах")
+    AI_BATCH_SIZE: int = Field(25, description="Сколько обращений упаковывать в один запрос пакетной классификации")
+    AI_BATCH_CONCURRENCY: int = Field(4, description="Параллельных запросов к модели при пакетной классификации")
+
+    # AI Gateway
+    AI_CLIENT_REQUESTS_PER_MINUTE: float = Field(20, description="Вызовов модели в минуту на один телефон")
+    AI_CLIENT_BURST: int = Field(5, description="Сколько вызовов клиент может сделать подряд")
+    AI_GLOBAL_TOKENS_PER_MINUTE: int = Field(90000, description="Общий бюджет токенов модели в минуту на процесс")
+    AI_MAX_CONCURRENT_CALLS: int = Field(16, description="Одновременных вызовов модели на процесс")
+    AI_QUEUE_TIMEOUT: float = Field(10.0, description="Сколько запрос ждёт в очереди к модели, прежде чем получить 429")
+
+    # AI Resilience
+    AI_RETRY_ATTEMPTS: int = Field(3, description="Попыток вызова модели, включая первую")
+    AI_RETRY_BASE_DELAY: float = Field(0.5, description="Базовая задержка повтора в секундах (растёт вдвое, с jitter)")
+    AI_RETRY_MAX_DELAY: float = Field(4.0, description="Максимальная задержка между повторами")
+    AI_HEDGE_ENABLED: bool = Field(True, description="Дублировать медленный вызов модели вторым запросом")
+    AI_HEDGE_AFTER_SECONDS: Optional[float] = Field(
+        None, description="Через сколько секунд отправлять дубль; по умолчанию p95 латентности последних вызовов"
+    )
+    AI_BREAKER_WINDOW: int = Field(20, description="Сколько последних вызовов оценивает circuit breaker")
+    AI_BREAKER_MIN_CALLS: int = Field(10, description="Минимум вызовов в окне, чтобы breaker мог открыться")
+    AI_BREAKER_ERROR_RATE: float = Field(0.5, description="Доля ошибок в окне, при которой breaker открывается")
+    AI_BREAKER_SLOW_SECONDS: float = Field(15.0, description="Вызов дольше этого считается медленным")
+    AI_BREAKER_SLOW_RATE: float = Field(0.8, description="Доля медленных вызовов в окне, при которой breaker открывается")
+    AI_BREAKER_OPEN_SECONDS: float = Field(30.0, description="Сколько breaker остаётся открытым до пробного вызова")
+
+    # AI Log
+    AI_LOG_QUEUE_SIZE: int = Field(10000, description="Сколько строк AILog держать в буфере до записи; сверх — отбрасываются")
+    AI_LOG_BATCH_SIZE: int = Field(500, description="Строк AILog в одном INSERT")
+    AI_LOG_FLUSH_SECONDS: float = Field(1.0, description="Как часто записывать буфер AILog")
+    AI_LOG_MAX_ATTEMPTS: int = Field(
+        3, description="После стольких ошибок подряд пачка AILog делится пополам, чтобы отбросить плохую строку"
+    )
+
+    # AI Cache
+    AI_CACHE_TTL_SECONDS: int = Field(86400, description="Время жизни записи AI-кэша")
+    AI_CACHE_MAX_ENTRIES: int = Field(10000, description="Размер локального LRU AI-кэша")
+    AI_CACHE_SHARED: bool = Field(False, description="Общий уровень AI-кэша в Postgres")
+    AI_CACHE_RESPONSES: bool = Field(
+        False,
+        description="Кэшировать сгенерированные ответы; такие ответы генерируются с temperature=0",
+    )
+
+    # Client Profile Cache
+    CLIENT_CACHE_TTL_SECONDS: int = Field(300, description="Время жизни профиля клиента в кэше")
+    CLIENT_CACHE_MAX_ENTRIES: int = Field(50000, description="Размер локального кэша профилей")
+    CLIENT_CACHE_MONEY_MAX_AGE_SECONDS: float = Field(5.0, description="Максимальный возраст balance/debt в ответе")
+    CLIENT_CACHE_REDIS_URL: Optional[str] = Field(None, description="Redis для общего уровня кэша профилей")
+
+    # AI Chat Memory
+    CHAT_HISTORY_TOKEN_BUDGET: int = Field(1500, description="Сколько токенов истории диалога отправлять модели")
+    CHAT_SUMMARY_TRIGGER_TOKENS: int = Field(2000, description="Сворачивать старые реплики, когда несвёрнутая история больше")
+    CHAT_KEEP_RECENT_MESSAGES: int = Field(6, description="Сколько последних реплик не сворачивать")
+    CHAT_CONTEXT_TTL_SECONDS: int = Field(120, description="Сколько жить кэшу заявок и платежей в сессии")
+
+    # Local Classifier
+    LOCAL_CLASSIFIER_ENABLED: bool = Field(True, description="Пробовать локальный классификатор перед OpenAI")
+    LOCAL_CLASSIFIER_PATH: str = Field("local_classifier.json", description="Файл обученной модели")
+    LOCAL_CLASSIFIER_THRESHOLD: float = Field(0.9, description="Минимальная уверенность для ответа без OpenAI")
     
     # Email Configuration (Optional)
     EMAIL_HOST: Optional[str] = Field(None, description="SMTP server host")
@@ -39,8 +119,75 @@ class Settings(BaseSettings):
     EMAIL_USER: Optional[str] = Field(None, description="SMTP username")
     EMAIL_PASSWORD: Optional[str] = Field(None, description="SMTP password")
     
+    SMTP_STARTTLS: bool = Field(True, description="Включать STARTTLS после подключения к SMTP")
+    SMTP_TIMEOUT: float = Field(10.0, description="Таймаут SMTP-операций в секундах")
+    SMTP_POOL_SIZE: int = Field(2, description="Сколько SMTP-соединений держать открытыми")
+    SMTP_MAX_MESSAGES_PER_CONNECTION: int = Field(100, description="Переподключаться после N писем")
+    SMTP_IDLE_SECONDS: float = Field(60.0, description="Закрывать SMTP-соединение после простоя")
+    EMAIL_FROM: Optional[str] = Field(None, description="Адрес отправителя (по умолчанию EMAIL_USER)")
+    
     # Telegram Configuration (Optional)
     TELEGRAM_BOT_TOKEN: Optional[str] = Field(None, description="Telegram bot token")
+    TELEGRAM_API_URL: str = Field("https://api.telegram.org", description="Базовый URL Bot API")
+    TELEGRAM_BOT_USERNAME: Optional[str] = Field(None, description="Имя бота для ссылки привязки t.me/<бот>?start=...")
+    TELEGRAM_WEBHOOK_SECRET: Optional[str] = Field(
+        None, description="secret_token из setWebhook; без него вебхук привязки выключен"
+    )
+    TELEGRAM_LINK_TTL_SECONDS: int = Field(900, description="Сколько действует ссылка привязки Telegram")
+
+    # Notification Outbox
+    NOTIFY_POLL_SECONDS: float = Field(2.0, description="Интервал опроса очереди уведомлений")
+    NOTIFY_BATCH_SIZE: int = Field(50, description="Сколько уведомлений воркер забирает за раз")
+    NOTIFY_MAX_ATTEMPTS: int = Field(6, description="Попыток отправки до статуса failed")
+    NOTIFY_BACKOFF_SECONDS: float = Field(30.0, description="Базовая задержка повтора, растёт вдвое с каждой попыткой")
+    NOTIFY_BACKOFF_MAX_SECONDS: float = Field(3600.0, description="Максимальная задержка повтора")
+    NOTIFY_LEASE_SECONDS: int = Field(300, description="Через сколько секунд зависшее уведомление берётся снова")
+    NOTIFY_EMAIL_RATE: float = Field(5.0, description="Писем в секунду, не больше")
+    NOTIFY_TELEGRAM_RATE: float = Field(25.0, description="Сообщений Telegram в секунду, не больше")
+
+    # Ticket Intake
+    TICKET_INTAKE_MODE: str = Field("sync", description="Режим приёма заявок: sync или async")
+    ENRICHMENT_POLL_SECONDS: float = Field(5.0, description="Интервал опроса очереди AI-обогащения")
+    ENRICHMENT_BATCH_SIZE: int = Field(10, description="Сколько заявок воркер забирает за раз")
+    ENRICHMENT_MAX_ATTEMPTS: int = Field(3, description="Число попыток обогащения до статуса failed")
+    ENRICHMENT_LEASE_SECONDS: int = Field(300, description="Через сколько секунд зависшая заявка снова берётся в работу")
+
+    # Reply Templates
+    TEMPLATES_ENABLED: bool = Field(True, description="Отвечать шаблоном категории, когда он подходит, без вызова модели")
+    TEMPLATES_RELOAD_SECONDS: float = Field(30.0, description="Как часто проверять изменения таблицы templates")
+
+    # Ticket Search
+    SEARCH_VECTOR_ENABLED: bool = Field(True, description="Держать в памяти векторный индекс заявок (нужен numpy)")
+    SEARCH_EMBEDDING_DIM: int = Field(256, description="Размерность хэшированных эмбеддингов")
+    SEARCH_INDEX_MAX_TICKETS: int = Field(50000, description="Сколько последних заявок держать в векторном индексе")
+    SEARCH_INDEX_REFRESH_SECONDS: float = Field(5.0, description="Как часто добавлять в индекс новые заявки")
+    SEARCH_INDEX_OVERLAP_SECONDS: float = Field(300.0, description="За сколько секунд перечитывать заявки, закоммиченные не по порядку id")
+    SEARCH_DUPLICATE_THRESHOLD: float = Field(0.85, description="Сходство, начиная с которого заявка считается дублем")
+    SEARCH_DUPLICATE_WINDOW_HOURS: int = Field(24, description="За сколько часов искать дубли новой заявки")
+    SEARCH_CLUSTER_THRESHOLD: float = Field(0.5, description="Сходство заявок внутри одного инцидента")
+    SEARCH_CLUSTER_MAX_TICKETS: int = Field(5000, description="Максимум заявок в одной кластеризации")
+
+    # События для панели оператора (SSE)
+    EVENTS_BACKEND: str = Field(
+        "memory", description="memory — брокер в процессе; postgres — LISTEN/NOTIFY для нескольких процессов API"
+    )
+    EVENTS_BUFFER_SIZE: int = Field(10000, description="Сколько последних событий хранить для переподключения по Last-Event-ID")
+    EVENTS_QUEUE_SIZE: int = Field(1000, description="Очередь одного подписчика; переполнил — соединение закрывается")
+    EVENTS_HEARTBEAT_SECONDS: float = Field(15.0, description="Интервал пустых сообщений, чтобы прокси не рвали соединение")
+
+    # Метрики (GET /metrics)
+    METRICS_ENABLED: bool = Field(True, description="Считать метрики HTTP-запросов и отдавать /metrics")
+    METRICS_SLOW_REQUEST_MS: int = Field(
+        1000, description="Запросы дольше этого пишутся в лог с разбивкой по фазам; 0 — не писать"
+    )
+
+    # Аналитика заявок (/api/operator/analytics)
+    ANALYTICS_ENABLED: bool = Field(True, description="Разбирать журнал смен статуса в почасовые свёртки в фоне")
+    ANALYTICS_REFRESH_SECONDS: float = Field(60.0, description="Как часто разбирать журнал смен статуса")
+    ANALYTICS_BATCH_SIZE: int = Field(10000, description="Сколько событий журнала разбирать за одну транзакцию")
+    ANALYTICS_SETTLE_SECONDS: float = Field(
+        60.0, description="События моложе этого не разбираются: ждём, пока обогащение проставит категорию"
+    )
 
     # Frontend Configuration
     FRONTEND_URL: str = Field("http://localhost:3000", description="Frontend application URL")
@@ -58,7 +205,7 @@ class Settings(BaseSettings):
         env_nested_delimiter="__"  # Optional: for nested configs
     )
 
-    @field_validator("PORT", "DB_PORT", "EMAIL_PORT", "ACCESS_TOKEN_EXPIRE_MINUTES", mode="before")
+    @field_validator("PORT", "DB_PORT", "EMAIL_PORT", "ACCESS_TOKEN_EXPIRE_MINUTES", "DB_POOL_SIZE", mode="before")
     @classmethod
     def validate_positive_integers(cls, v):
         """Validate that certain fields are positive integers."""
@@ -70,6 +217,14 @@ class Settings(BaseSettings):
         except (TypeError, ValueError) as e:
             raise ValueError(f"Invalid value: {v}. Must be a positive integer.") from e
 
+    @field_validator("TICKET_INTAKE_MODE")
+    @classmethod
+    def validate_intake_mode(cls, v):
+        """Допустимы только режимы sync и async."""
+        if v not in ("sync", "async"):
+            raise ValueError(f"Invalid value: {v}. Must be 'sync' or 'async'.")
+        return v
+
     @field_validator("FRONTEND_URL", mode="before")
     @classmethod
     def validate_frontend_url(cls, v):
@@ -88,4 +243,4 @@ except Exception as e:
 # Optional: Verify settings on startup
 if settings.DEBUG:
     print("Running in DEBUG mode")
-    print(f"Database URL: {settings.DATABASE_URL}")
\ No newline at end of file
+    print(f"Database: {settings.DB_USER}@{settings.DB_HOST}:{settings.DB_PORT}/{settings.DB_NAME}")
\ No newline at end of file
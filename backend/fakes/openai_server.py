@@ -0,0 +1,179 @@
+"""
+Локальный fake OpenAI API для разработки, нагрузочных прогонов и проверки деградации.
+
+    python -m backend.fakes.openai_server --port 8100 [--latency 0.2] [--error-rate 0.1]
+
+и в .env: APP_OPENAI_BASE_URL=http://localhost:8100/v1, APP_OPENAI_API_KEY=любой.
+Реализован только POST /v1/chat/completions: категория по ключевым словам,
+logprobs, JSON-ответ для пакетной классификации и SSE-стриминг с usage.
+Сбои меняются на лету, без рестарта:
+
+    curl -X POST localhost:8100/_control -d '{"error_rate": 1, "status": 503}'
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from dataclasses import asdict, dataclass
+from typing import List, Optional
+
+from fastapi import Body, FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# Первое совпадение по ключевым словам определяет категорию
+KEYWORDS = [
+    ("инцидент", ("не работает", "нет доступа", "пропал", "авари", "ошибк", "сломал", "нет интернета")),
+    ("подключение", ("подключ", "установ", "новый адрес", "переезд")),
+    ("жалоба", ("жалоб", "недоволен", "плохо", "хамств", "верните")),
+]
+DEFAULT_CATEGORY = "информация"
+
+
+@dataclass
+class Faults:
+    latency: float = 0.0  # задержка перед ответом, секунды
+    jitter: float = 0.0  # плюс случайная задержка от 0 до jitter
+    error_rate: float = 0.0  # доля запросов, отвечающих ошибкой
+    status: int = 500  # код этой ошибки
+    timeout_rate: float = 0.0  # доля запросов, которые «зависают» на hang секунд
+    hang: float = 60.0
+
+
+faults = Faults()
+stats = {"requests": 0, "errors": 0, "timeouts": 0}
+
+app = FastAPI(title="fake OpenAI")
+
+
+def categorize(text: str) -> str:
+    text = text.lower()
+    for category, words in KEYWORDS:
+        if any(w in text for w in words):
+            return category
+    return DEFAULT_CATEGORY
+
+
+def count_tokens(text: str) -> int:
+    return max(1, len(text) // 3)
+
+
+def _reply(messages: List[dict], json_mode: bool) -> str:
+    system = " ".join(m["content"] or "" for m in messages if m["role"] == "system").lower()
+    user = next((m["content"] or "" for m in reversed(messages) if m["role"] == "user"), "")
+
+    if json_mode:
+        # Пакетная классификация: пронумерованный список «1. текст»
+        items = re.findall(r"^(\d+)\.\s*(.*)$", user, flags=re.M)
+        return json.dumps({n: categorize(t) for n, t in items}, ensure_ascii=False)
+    if "классификатор" in system:
+        return categorize(user)
+    if "сожми диалог" in system:
+        return "Клиент задавал вопросы по своему счёту, ассистент ответил по данным профиля."
+    return f"Здравствуйте! Мы получили ваше обращение ({categorize(user)}) и уже занимаемся им."
+
+
+def _logprobs(content: str) -> dict:
+    tokens = [content[i:i + 4] for i in range(0, len(content), 4)] or [""]
+    return {"content": [
+        {"token": t, "logprob": -0.01, "bytes": list(t.encode()), "top_logprobs": []}
+        for t in tokens
+    ]}
+
+
+async def _inject_faults() -> Optional[JSONResponse]:
+    delay = faults.latency + random.uniform(0, faults.jitter)
+    if random.random() < faults.timeout_rate:
+        stats["timeouts"] += 1
+        delay = faults.hang
+    if delay:
+        await asyncio.sleep(delay)
+    if random.random() < faults.error_rate:
+        stats["errors"] += 1
+        return JSONResponse(
+            status_code=faults.status,
+            content={"error": {"message": "injected fault", "type": "server_error", "code": None}},
+        )
+    return None
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    stats["requests"] += 1
+    error = await _inject_faults()
+    if error is not None:
+        return error
+
+    body = await request.json()
+    model = body.get("model", "gpt-3.5-turbo")
+    messages = body.get("messages", [])
+    json_mode = (body.get("response_format") or {}).get("type") == "json_object"
+    content = _reply(messages, json_mode)
+    usage = {
+        "prompt_tokens": sum(count_tokens(m.get("content") or "") for m in messages),
+        "completion_tokens": count_tokens(content),
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+    base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()), "model": model}
+
+    if body.get("stream"):
+        async def events():
+            for i in range(0, len(content), 8):
+                chunk = dict(base, object="chat.completion.chunk", choices=[{
+                    "index": 0, "delta": {"content": content[i:i + 8]}, "finish_reason": None,
+                }])
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            last = dict(base, object="chat.completion.chunk", choices=[{
+                "index": 0, "delta": {}, "finish_reason": "stop",
+            }])
+            yield f"data: {json.dumps(last)}\n\n"
+            if (body.get("stream_options") or {}).get("include_usage"):
+                yield f"data: {json.dumps(dict(base, object='chat.completion.chunk', choices=[], usage=usage))}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return dict(base, object="chat.completion", usage=usage, choices=[{
+        "index": 0,
+        "message": {"role": "assistant", "content": content},
+        "logprobs": _logprobs(content) if body.get("logprobs") else None,
+        "finish_reason": "stop",
+    }])
+
+
+@app.get("/_control")
+def get_control():
+    return {"faults": asdict(faults), "stats": stats}
+
+
+@app.post("/_control")
+def set_control(changes: dict = Body(...)):
+    for name, value in changes.items():
+        if hasattr(faults, name):
+            setattr(faults, name, type(getattr(faults, name))(value))
+    return get_control()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m backend.fakes.openai_server", description="Fake OpenAI API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--status", type=int, default=500)
+    parser.add_argument("--timeout-rate", type=float, default=0.0)
+    args = parser.parse_args(argv)
+
+    faults.latency, faults.jitter = args.latency, args.jitter
+    faults.error_rate, faults.status, faults.timeout_rate = args.error_rate, args.status, args.timeout_rate
+
+    import uvicorn
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
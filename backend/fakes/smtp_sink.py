@@ -0,0 +1,145 @@
+"""
+Локальный SMTP-приёмник для разработки и тестов: принимает письма и ничего не отправляет.
+
+    python -m backend.fakes.smtp_sink --port 1025 [--maildir ./mail]
+
+и в .env: APP_EMAIL_HOST=localhost, APP_EMAIL_PORT=1025, APP_SMTP_STARTTLS=false.
+STARTTLS и AUTH не поддерживаются (AUTH принимается без проверки).
+В тестах можно поднять его в том же процессе:
+
+    sink = SMTPSink(port=0)
+    await sink.start()
+    ... sink.port, sink.messages ...
+    await sink.stop()
+"""
+import argparse
+import asyncio
+import email
+import email.policy
+import os
+import time
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+
+@dataclass
+class ReceivedMessage:
+    mail_from: str
+    rcpt_to: List[str]
+    data: bytes
+    received_at: float = field(default_factory=time.time)
+
+    @property
+    def message(self) -> email.message.EmailMessage:
+        return email.message_from_bytes(self.data, policy=email.policy.default)
+
+
+class SMTPSink:
+    def __init__(self, host: str = "127.0.0.1", port: int = 1025, maildir: Optional[str] = None):
+        self.host = host
+        self.port = port
+        self.maildir = maildir
+        self.messages: List[ReceivedMessage] = []
+        self.connections = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> None:
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        # При port=0 система выбирает свободный порт
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self) -> None:
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def serve_forever(self) -> None:
+        await self.start()
+        async with self._server:
+            await self._server.serve_forever()
+
+    def _store(self, msg: ReceivedMessage) -> None:
+        self.messages.append(msg)
+        if self.maildir:
+            os.makedirs(self.maildir, exist_ok=True)
+            name = f"{msg.received_at:.6f}-{len(self.messages)}.eml"
+            with open(os.path.join(self.maildir, name), "wb") as f:
+                f.write(msg.data)
+        print(f"[smtp_sink] {msg.mail_from} -> {', '.join(msg.rcpt_to)}: {msg.message['Subject']}")
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+
+        async def reply(line: str) -> None:
+            writer.write(line.encode() + b"\r\n")
+            await writer.drain()
+
+        mail_from, rcpt_to = None, []
+        await reply("220 smtp_sink ready")
+        try:
+            while True:
+                raw = await reader.readline()
+                if not raw:
+                    break
+                line = raw.decode(errors="replace").rstrip("\r\n")
+                verb = line.split(" ", 1)[0].upper()
+
+                if verb == "EHLO":
+                    writer.write(b"250-smtp_sink\r\n250-8BITMIME\r\n250-SMTPUTF8\r\n250 AUTH PLAIN LOGIN\r\n")
+                    await writer.drain()
+                elif verb == "HELO":
+                    await reply("250 smtp_sink")
+                elif verb == "AUTH":
+                    await reply("235 Authentication successful")
+                elif verb == "MAIL":
+                    mail_from, rcpt_to = line.split(":", 1)[1].strip().split(" ")[0].strip("<>"), []
+                    await reply("250 OK")
+                elif verb == "RCPT":
+                    rcpt_to.append(line.split(":", 1)[1].strip().split(" ")[0].strip("<>"))
+                    await reply("250 OK")
+                elif verb == "DATA":
+                    await reply("354 End data with <CR><LF>.<CR><LF>")
+                    lines = []
+                    while True:
+                        chunk = await reader.readline()
+                        if chunk in (b".\r\n", b".\n", b""):
+                            break
+                        # Снимаем dot-stuffing
+                        lines.append(chunk[1:] if chunk.startswith(b"..") else chunk)
+                    self._store(ReceivedMessage(mail_from, rcpt_to, b"".join(lines)))
+                    mail_from, rcpt_to = None, []
+                    await reply("250 OK: queued")
+                elif verb == "RSET":
+                    mail_from, rcpt_to = None, []
+                    await reply("250 OK")
+                elif verb == "NOOP":
+                    await reply("250 OK")
+                elif verb == "QUIT":
+                    await reply("221 Bye")
+                    break
+                else:
+                    await reply("502 Command not implemented")
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+def main(argv=None) -> None:
+    parser = argparse.ArgumentParser(prog="python -m backend.fakes.smtp_sink", description="Локальный SMTP-приёмник")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1025)
+    parser.add_argument("--maildir", default=None, help="Сохранять письма как .eml в этот каталог")
+    args = parser.parse_args(argv)
+
+    sink = SMTPSink(args.host, args.port, args.maildir)
+    print(f"[smtp_sink] слушаю {args.host}:{args.port}")
+    try:
+        asyncio.run(sink.serve_forever())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
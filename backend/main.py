@@ -5,19 +5,22 @@ from .routers.ai_chat import router as ai_chat_router
 # Подставьте свою кодировку, если в .env остались русские символы
 load_dotenv(".env", encoding="utf-8")
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
 from fastapi.middleware.cors import CORSMiddleware
 
 from .config import settings
-from .models import Base
-from .services.db import engine
+from .services.db import engine, async_engine, pool_metrics
+from .services import ai_classifier, ai_gateway, ai_log, analytics, client_cache, enrichment, events, metrics, notifications, search, templates
+from . import migrations
 
 from .routers.auth import router as auth_router
 from .routers.users import router as users_router
 from .routers.tickets import router as tickets_router
 from .routers.payments import router as payments_router
 from .routers.ai_chat import router as ai_chat_router
-from .routers.operator import router as operator_router
+from .routers.operator import router as operator_router, stream_router as operator_stream_router
+from .routers.analytics import router as analytics_router
+from .routers.telegram import router as telegram_router
 
 import os
 
@@ -40,10 +43,69 @@ app.add_middleware(
     allow_headers=["*"],
     expose_headers=["*"]  # Important for custom headers like x-client-phone
 )
+# Латентность по маршрутам, SQL и вызовы модели на запрос — см. /metrics
+app.add_middleware(metrics.MetricsMiddleware)
+
+metrics.register_collector("db_pool", pool_metrics)
+metrics.register_collector("client_cache", client_cache.stats)
+metrics.register_collector("ai_gateway", lambda: {
+    **{k: v for k, v in ai_gateway.stats().items() if k != "models"},
+    "breaker_open": ai_gateway.breaker.is_open(),
+})
+metrics.register_collector("ai_cache", ai_classifier.cache_stats)
+metrics.register_collector("ai_log", ai_log.writer.stats)
+metrics.register_collector("notifications", notifications.worker.stats)
+metrics.register_collector("templates", templates.engine.stats)
+metrics.register_collector("search_index", search.index.stats)
+metrics.register_collector("events", events.broker.stats)
+metrics.register_collector("analytics", analytics.refresher.stats)
 
 @app.on_event("startup")
-def on_startup():
-    Base.metadata.create_all(bind=engine)
+async def on_startup():
+    if settings.DB_AUTO_MIGRATE:
+        migrations.upgrade(engine)
+    # Воркер подхватывает и заявки, оставшиеся в очереди после рестарта
+    events.broker.start()
+    ai_log.writer.start()
+    templates.engine.start()
+    search.index.start()
+    enrichment.worker.start()
+    notifications.worker.start()
+    analytics.refresher.start()
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await enrichment.worker.stop()
+    await notifications.worker.stop()
+    await templates.engine.stop()
+    await search.index.stop()
+    await analytics.refresher.stop()
+    await events.broker.stop()
+    # Последним из фоновых: воркеры выше ещё могли поставить строки AILog
+    await ai_log.writer.stop()
+    await async_engine.dispose()
+
+@app.get("/api/health/db", tags=["health"], summary="Состояние пула соединений с БД")
+def db_health():
+    return {**pool_metrics(), "client_cache": client_cache.stats()}
+
+@app.get("/api/health/ai", tags=["health"], summary="Вызовы модели: токены, стоимость, лимиты, кэш")
+def ai_health():
+    return {
+        "gateway": ai_gateway.stats(),
+        "cache": ai_classifier.cache_stats(),
+        "log": ai_log.writer.stats(),
+        "templates": templates.engine.stats(),
+        "search_index": search.index.stats(),
+    }
+
+@app.get("/metrics", tags=["health"], summary="Метрики в формате Prometheus", include_in_schema=False)
+def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/api/health/events", tags=["health"], summary="Подписчики и буфер событий для операторов")
+def events_health():
+    return events.broker.stats()
 
 # Подключаем все роутеры
 app.include_router(auth_router)
@@ -52,6 +114,9 @@ app.include_router(tickets_router)
 app.include_router(payments_router)
 app.include_router(ai_chat_router)  # <--- добавили
 app.include_router(operator_router)
+app.include_router(operator_stream_router)
+app.include_router(analytics_router)
+app.include_router(telegram_router)
 
 if __name__ == "__main__":
     uvicorn.run(
@@ -0,0 +1,128 @@
+"""
+Версионированные миграции схемы.
+
+Каждая миграция — модуль versions/NNNN_<описание>.py с функцией upgrade(conn).
+Применённые версии хранятся в таблице schema_migrations. Миграция с
+TRANSACTIONAL = False выполняется в autocommit (нужно для CREATE INDEX CONCURRENTLY);
+такие миграции выполняют STATEMENTS через execute_concurrently().
+
+    python -m backend.migrations upgrade   # применить новые миграции
+    python -m backend.migrations status    # что применено, что нет
+    python -m backend.migrations check     # EXPLAIN горячих запросов, без Seq Scan
+"""
+import importlib
+import logging
+import pkgutil
+import re
+from typing import List, NamedTuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Произвольная константа для pg_advisory_lock: миграции не должны
+# идти одновременно из нескольких воркеров uvicorn
+_LOCK_ID = 72_310_001
+
+
+_CONCURRENT_INDEX_RE = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE,
+)
+
+
+class Migration(NamedTuple):
+    version: str
+    name: str
+    module: object
+
+
+def discover() -> List[Migration]:
+    from . import versions
+
+    found = []
+    for info in pkgutil.iter_modules(versions.__path__):
+        version, _, name = info.name.partition("_")
+        if not version.isdigit():
+            continue
+        module = importlib.import_module(f"{versions.__name__}.{info.name}")
+        found.append(Migration(version, name, module))
+    return sorted(found, key=lambda m: m.version)
+
+
+def _ensure_table(engine: Engine) -> None:
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "  version    VARCHAR(20) PRIMARY KEY,"
+            "  name       VARCHAR(255) NOT NULL,"
+            "  applied_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()"
+            ")"
+        ))
+
+
+def applied_versions(engine: Engine) -> set:
+    _ensure_table(engine)
+    with engine.connect() as conn:
+        return set(conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+
+
+def upgrade(engine: Engine) -> List[str]:
+    """Применяет все ещё не применённые миграции по порядку. Возвращает их версии."""
+    _ensure_table(engine)
+    applied = []
+    with engine.connect() as lock_conn:
+        lock_conn.execute(text("SELECT pg_advisory_lock(:id)"), {"id": _LOCK_ID})
+        try:
+            done = set(lock_conn.execute(text("SELECT version FROM schema_migrations")).scalars())
+            lock_conn.commit()
+            for migration in discover():
+                if migration.version in done:
+                    continue
+                logger.info("Применяю миграцию %s_%s", migration.version, migration.name)
+                _apply(engine, migration)
+                applied.append(migration.version)
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:id)"), {"id": _LOCK_ID})
+            lock_conn.commit()
+    return applied
+
+
+def _apply(engine: Engine, migration: Migration) -> None:
+    record = text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)")
+    params = {"version": migration.version, "name": migration.name}
+
+    if getattr(migration.module, "TRANSACTIONAL", True):
+        with engine.begin() as conn:
+            migration.module.upgrade(conn)
+            conn.execute(record, params)
+        return
+
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        migration.module.upgrade(conn)
+        conn.execute(record, params)
+
+
+def drop_invalid_index(conn, name: str) -> bool:
+    """
+    Удаляет индекс, если он INVALID. Такой остаётся после упавшего
+    CREATE INDEX CONCURRENTLY, и IF NOT EXISTS при повторе его бы пропустил.
+    """
+    invalid = conn.execute(
+        text("SELECT NOT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {"name": name},
+    ).scalar()
+    if not invalid:
+        return False
+    logger.warning("Индекс %s остался INVALID после прошлой попытки — пересоздаю", name)
+    conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{name}"'))
+    return True
+
+
+def execute_concurrently(conn, statements: List[str]) -> None:
+    """Выполняет STATEMENTS нетранзакционной миграции; перед CREATE INDEX CONCURRENTLY убирает INVALID-остаток."""
+    for statement in statements:
+        match = _CONCURRENT_INDEX_RE.search(statement)
+        if match:
+            drop_invalid_index(conn, match.group(1))
+        conn.execute(text(statement))
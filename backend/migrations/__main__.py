@@ -0,0 +1,36 @@
+import argparse
+import sys
+
+from . import applied_versions, check, discover, upgrade
+
+
+def main(argv=None) -> int:
+    from ..services.db import engine
+
+    parser = argparse.ArgumentParser(prog="python -m backend.migrations", description="Миграции схемы БД")
+    parser.add_argument("command", choices=["upgrade", "status", "check"])
+    args = parser.parse_args(argv)
+
+    if args.command == "upgrade":
+        applied = upgrade(engine)
+        print("Применены: " + ", ".join(applied) if applied else "Схема актуальна")
+        return 0
+
+    if args.command == "status":
+        done = applied_versions(engine)
+        for migration in discover():
+            mark = "x" if migration.version in done else " "
+            print(f"[{mark}] {migration.version}_{migration.name}")
+        return 0
+
+    failures = check.run(engine)
+    for name, tables in failures.items():
+        print(f"FAIL {name}: Seq Scan по {', '.join(tables)}")
+    if failures:
+        return 1
+    print(f"OK: {len(check.HOT_QUERIES)} горячих запросов используют индексы")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
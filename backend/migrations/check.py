@@ -0,0 +1,92 @@
+"""
+Проверка планов горячих запросов.
+
+Каждый запрос из HOT_QUERIES прогоняется через EXPLAIN с enable_seqscan = off:
+если планировщик всё равно выбирает Seq Scan, значит подходящего индекса нет.
+На маленьких таблицах Postgres честно предпочитает Seq Scan, поэтому без
+этого флага проверка была бы бесполезна на dev-базе.
+"""
+from typing import Dict, Iterator, List
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+# Запросы, которые выполняют роуты на каждом вызове. Параметры — любые
+# правдоподобные значения: важен план, а не результат.
+HOT_QUERIES: Dict[str, str] = {
+    "client_by_phone":
+        "SELECT * FROM clients WHERE phone = '+77011234567'",
+    "login_code_latest":
+        "SELECT * FROM login_codes WHERE phone = '+77011234567' ORDER BY created_at DESC LIMIT 1",
+    "client_tickets":
+        "SELECT * FROM tickets WHERE client_phone = '+77011234567' ORDER BY created_at DESC",
+    "client_payments":
+        "SELECT * FROM payments WHERE client_id = 1 ORDER BY date DESC LIMIT 10",
+    "client_payments_page":
+        "SELECT * FROM payments WHERE client_id = 1 AND (date, id) < (now(), 1000000) "
+        "ORDER BY date DESC, id DESC LIMIT 51",
+    "client_payment_summary":
+        "SELECT * FROM payment_summary s LEFT JOIN payments p ON p.id = s.last_payment_id WHERE s.client_id = 1",
+    "client_payment_monthly":
+        "SELECT * FROM payment_monthly WHERE client_id = 1",
+    "ticket_comments":
+        "SELECT * FROM comments WHERE ticket_id = 1 ORDER BY created_at",
+    "ticket_ai_logs":
+        "SELECT * FROM ai_logs WHERE ticket_id = 1",
+    "operator_page":
+        "SELECT * FROM tickets WHERE (created_at, id) < (now(), 1000000) "
+        "ORDER BY created_at DESC, id DESC LIMIT 51",
+    "operator_by_category":
+        "SELECT * FROM tickets WHERE category = 'инцидент' ORDER BY created_at DESC, id DESC LIMIT 51",
+    "operator_by_status":
+        "SELECT * FROM tickets WHERE status = 'new' ORDER BY created_at DESC, id DESC LIMIT 51",
+    "operator_by_assignee":
+        "SELECT * FROM tickets WHERE assigned_to = 'operator' ORDER BY created_at DESC, id DESC LIMIT 51",
+    "operator_search":
+        "SELECT * FROM tickets WHERE to_tsvector('russian'::regconfig, coalesce(subject, '') || ' ' || text) "
+        "@@ websearch_to_tsquery('russian', 'нет интернета') LIMIT 20",
+    "analytics_volume":
+        "SELECT status, sum(tickets) FROM analytics_ticket_hourly "
+        "WHERE hour >= now() - interval '7 days' AND hour < now() GROUP BY status",
+    "analytics_sla":
+        "SELECT sum(first_responses), sum(closed) FROM analytics_sla_hourly "
+        "WHERE hour >= now() - interval '7 days' AND hour < now()",
+    "analytics_backlog":
+        "SELECT status, category, count(*) FROM ticket_facts WHERE status <> 'closed' GROUP BY status, category",
+    "analytics_events_batch":
+        "SELECT id FROM ticket_status_events WHERE at < now() - interval '1 minute' ORDER BY at, id LIMIT 10000",
+    "enrichment_claim":
+        "SELECT * FROM tickets WHERE enrichment_status IN ('pending', 'processing') "
+        "AND (enrichment_status = 'pending' OR updated_at < now() - interval '5 minutes') "
+        "ORDER BY id LIMIT 10",
+}
+
+
+def _nodes(plan: dict) -> Iterator[dict]:
+    yield plan
+    for child in plan.get("Plans", []):
+        yield from _nodes(child)
+
+
+def seq_scans(engine: Engine, sql: str) -> List[str]:
+    """Таблицы, которые план запроса читает последовательным сканом."""
+    with engine.connect() as conn:
+        with conn.begin() as tx:
+            conn.execute(text("SET LOCAL enable_seqscan = off"))
+            plan = conn.execute(text(f"EXPLAIN (FORMAT JSON) {sql}")).scalar_one()
+            tx.rollback()
+    return [
+        node.get("Relation Name", "?")
+        for node in _nodes(plan[0]["Plan"])
+        if node["Node Type"] == "Seq Scan"
+    ]
+
+
+def run(engine: Engine) -> Dict[str, List[str]]:
+    """Запросы, упавшие в Seq Scan, и таблицы, по которым он идёт."""
+    failures = {}
+    for name, sql in HOT_QUERIES.items():
+        tables = seq_scans(engine, sql)
+        if tables:
+            failures[name] = tables
+    return failures
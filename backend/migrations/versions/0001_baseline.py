@@ -0,0 +1,83 @@
+"""
+Исходная схема (как в datab.txt и в моделях до появления миграций).
+IF NOT EXISTS — чтобы миграция спокойно проходила на уже существующей базе.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS clients (
+      id          SERIAL PRIMARY KEY,
+      full_name   VARCHAR(255)  NOT NULL,
+      phone       VARCHAR(20)   UNIQUE NOT NULL,
+      email       VARCHAR(255)  UNIQUE NOT NULL,
+      tariff      VARCHAR(100),
+      services    JSONB,
+      balance     NUMERIC(12,2) DEFAULT 0.00,
+      debt        NUMERIC(12,2) DEFAULT 0.00,
+      created_at  TIMESTAMP WITH TIME ZONE DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS tickets (
+      id            SERIAL PRIMARY KEY,
+      client_id     INTEGER REFERENCES clients(id) ON DELETE CASCADE,
+      client_phone  VARCHAR(20),
+      subject       VARCHAR(255),
+      text          TEXT NOT NULL,
+      channel       VARCHAR(50) DEFAULT 'web',
+      category      VARCHAR(100),
+      status        VARCHAR(50) DEFAULT 'new',
+      priority      VARCHAR(50) DEFAULT 'normal',
+      ai_response   TEXT,
+      created_at    TIMESTAMP WITH TIME ZONE DEFAULT now(),
+      updated_at    TIMESTAMP WITH TIME ZONE
+    )
+    """,
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS assigned_to VARCHAR(100)",
+    "CREATE INDEX IF NOT EXISTS ix_tickets_client_phone ON tickets (client_phone)",
+    """
+    CREATE TABLE IF NOT EXISTS comments (
+      id          SERIAL PRIMARY KEY,
+      ticket_id   INTEGER NOT NULL REFERENCES tickets(id),
+      author      VARCHAR(100) NOT NULL,
+      text        TEXT NOT NULL,
+      created_at  TIMESTAMP WITH TIME ZONE DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS payments (
+      id          SERIAL PRIMARY KEY,
+      client_id   INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+      amount      NUMERIC(12,2) NOT NULL,
+      date        TIMESTAMP WITH TIME ZONE DEFAULT now(),
+      service     VARCHAR(100),
+      status      VARCHAR(50) DEFAULT 'completed'
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS templates (
+      id          SERIAL PRIMARY KEY,
+      name        VARCHAR(100) UNIQUE NOT NULL,
+      category    VARCHAR(100) NOT NULL,
+      text        TEXT NOT NULL,
+      created_at  TIMESTAMP WITH TIME ZONE DEFAULT now()
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS ai_logs (
+      id                SERIAL PRIMARY KEY,
+      ticket_id         INTEGER NOT NULL REFERENCES tickets(id) ON DELETE CASCADE,
+      action            VARCHAR(50) NOT NULL,
+      request_payload   JSONB,
+      response_payload  JSONB,
+      confidence        NUMERIC(5,4),
+      created_at        TIMESTAMP WITH TIME ZONE DEFAULT now()
+    )
+    """,
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
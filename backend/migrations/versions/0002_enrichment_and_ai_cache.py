@@ -0,0 +1,25 @@
+"""
+Фоновое AI-обогащение заявок, признак кэша в ai_logs и общий AI-кэш.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS enrichment_status VARCHAR(20) NOT NULL DEFAULT 'done'",
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS enrichment_attempts INTEGER NOT NULL DEFAULT 0",
+    "ALTER TABLE ai_logs ADD COLUMN IF NOT EXISTS cached BOOLEAN NOT NULL DEFAULT false",
+    """
+    CREATE TABLE IF NOT EXISTS ai_cache (
+      key         VARCHAR(64) PRIMARY KEY,
+      action      VARCHAR(50) NOT NULL,
+      value       TEXT NOT NULL,
+      created_at  TIMESTAMP WITH TIME ZONE DEFAULT now(),
+      expires_at  TIMESTAMP WITH TIME ZONE NOT NULL
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_ai_cache_expires_at ON ai_cache (expires_at)",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
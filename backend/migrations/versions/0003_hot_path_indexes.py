@@ -0,0 +1,29 @@
+"""
+Составные индексы под горячие запросы роутеров (см. backend/migrations/check.py).
+CONCURRENTLY не блокирует запись в таблицы, но не работает внутри транзакции.
+"""
+from .. import execute_concurrently
+
+TRANSACTIONAL = False
+
+STATEMENTS = [
+    # Панель оператора: keyset-пагинация и фильтры
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_created_at_id ON tickets (created_at, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_status_created_at ON tickets (status, created_at, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_category_created_at ON tickets (category, created_at, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_assigned_to_created_at ON tickets (assigned_to, created_at, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_priority_created_at ON tickets (priority, created_at, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_channel_created_at ON tickets (channel, created_at, id)",
+    # Заявки клиента, новые сверху
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_client_phone_created_at ON tickets (client_phone, created_at)",
+    # Очередь AI-обогащения: частичный индекс, в нём только необработанные заявки
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_enrichment_queue ON tickets (id) "
+    "WHERE enrichment_status IN ('pending', 'processing')",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_payments_client_id_date ON payments (client_id, date)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_comments_ticket_id_created_at ON comments (ticket_id, created_at)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_ai_logs_ticket_id ON ai_logs (ticket_id)",
+]
+
+
+def upgrade(conn):
+    execute_concurrently(conn, STATEMENTS)
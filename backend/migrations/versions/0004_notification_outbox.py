@@ -0,0 +1,32 @@
+"""
+Очередь исходящих уведомлений (email, Telegram) и chat_id клиента в Telegram.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE clients ADD COLUMN IF NOT EXISTS telegram_chat_id VARCHAR(64)",
+    """
+    CREATE TABLE IF NOT EXISTS notifications (
+      id               SERIAL PRIMARY KEY,
+      ticket_id        INTEGER REFERENCES tickets(id) ON DELETE CASCADE,
+      channel          VARCHAR(20)  NOT NULL,
+      recipient        VARCHAR(255) NOT NULL,
+      subject          VARCHAR(255),
+      body             TEXT         NOT NULL,
+      status           VARCHAR(20)  NOT NULL DEFAULT 'pending',
+      attempts         INTEGER      NOT NULL DEFAULT 0,
+      next_attempt_at  TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now(),
+      last_error       TEXT,
+      created_at       TIMESTAMP WITH TIME ZONE DEFAULT now(),
+      sent_at          TIMESTAMP WITH TIME ZONE
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_notifications_ticket_id ON notifications (ticket_id)",
+    "CREATE INDEX IF NOT EXISTS ix_notifications_queue ON notifications (next_attempt_at) "
+    "WHERE status IN ('pending', 'sending')",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
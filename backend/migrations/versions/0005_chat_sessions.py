@@ -0,0 +1,36 @@
+"""
+Сессии чата с AI-ассистентом и их сообщения.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS chat_sessions (
+      id                VARCHAR(36) PRIMARY KEY,
+      client_id         INTEGER NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+      summary           TEXT,
+      summarized_until  INTEGER NOT NULL DEFAULT 0,
+      context           TEXT,
+      context_built_at  TIMESTAMP WITH TIME ZONE,
+      created_at        TIMESTAMP WITH TIME ZONE DEFAULT now(),
+      updated_at        TIMESTAMP WITH TIME ZONE DEFAULT now()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_chat_sessions_client_id ON chat_sessions (client_id)",
+    """
+    CREATE TABLE IF NOT EXISTS chat_messages (
+      id          SERIAL PRIMARY KEY,
+      session_id  VARCHAR(36) NOT NULL REFERENCES chat_sessions(id) ON DELETE CASCADE,
+      role        VARCHAR(20) NOT NULL,
+      content     TEXT        NOT NULL,
+      tokens      INTEGER     NOT NULL,
+      created_at  TIMESTAMP WITH TIME ZONE DEFAULT now()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_chat_messages_session_id_id ON chat_messages (session_id, id)",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
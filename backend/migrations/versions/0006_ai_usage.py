@@ -0,0 +1,23 @@
+"""
+Учёт вызовов модели в ai_logs: модель, токены, латентность, стоимость.
+ticket_id становится необязательным — чат и сводки диалогов не привязаны к заявке.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE ai_logs ALTER COLUMN ticket_id DROP NOT NULL",
+    "ALTER TABLE ai_logs ADD COLUMN IF NOT EXISTS model VARCHAR(100)",
+    "ALTER TABLE ai_logs ADD COLUMN IF NOT EXISTS prompt_tokens INTEGER",
+    "ALTER TABLE ai_logs ADD COLUMN IF NOT EXISTS completion_tokens INTEGER",
+    "ALTER TABLE ai_logs ADD COLUMN IF NOT EXISTS latency_ms INTEGER",
+    "ALTER TABLE ai_logs ADD COLUMN IF NOT EXISTS cost NUMERIC(12,6)",
+    # Логи без заявки пишутся без payload
+    "ALTER TABLE ai_logs ALTER COLUMN request_payload DROP NOT NULL",
+    "ALTER TABLE ai_logs ALTER COLUMN response_payload DROP NOT NULL",
+    "CREATE INDEX IF NOT EXISTS ix_ai_logs_created_at ON ai_logs (created_at)",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
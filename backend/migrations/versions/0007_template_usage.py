@@ -0,0 +1,15 @@
+"""
+Счётчики использования шаблонов ответов: движок шаблонов копит их в памяти
+и периодически добавляет сюда.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE templates ADD COLUMN IF NOT EXISTS uses BIGINT NOT NULL DEFAULT 0",
+    "ALTER TABLE templates ADD COLUMN IF NOT EXISTS last_used_at TIMESTAMP WITH TIME ZONE",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
@@ -0,0 +1,17 @@
+"""
+Полнотекстовый поиск по заявкам: GIN-индекс по выражению над subject и text.
+Выражение должно совпадать с services/search.document(), иначе индекс не используется.
+Индекс по выражению не требует переписывать таблицу, в отличие от generated-колонки.
+"""
+from .. import execute_concurrently
+
+TRANSACTIONAL = False
+
+STATEMENTS = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_tickets_search ON tickets "
+    "USING GIN (to_tsvector('russian'::regconfig, coalesce(subject, '') || ' ' || text))",
+]
+
+
+def upgrade(conn):
+    execute_concurrently(conn, STATEMENTS)
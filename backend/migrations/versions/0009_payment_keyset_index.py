@@ -0,0 +1,16 @@
+"""
+Индекс под keyset-пагинацию истории платежей: (client_id, date, id).
+Заменяет ix_payments_client_id_date — id в конце даёт однозначный порядок страниц.
+"""
+from .. import execute_concurrently
+
+TRANSACTIONAL = False
+
+STATEMENTS = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_payments_client_id_date_id ON payments (client_id, date, id)",
+    "DROP INDEX CONCURRENTLY IF EXISTS ix_payments_client_id_date",
+]
+
+
+def upgrade(conn):
+    execute_concurrently(conn, STATEMENTS)
@@ -0,0 +1,202 @@
+"""
+Свёртки платежей для /api/payments/summary.
+
+payment_monthly — число и сумма платежей клиента по месяцу, услуге и статусу;
+payment_summary — итоги клиента и его последний платёж. Обе таблицы ведут
+statement-level триггеры на payments с transition tables: многострочная вставка
+обновляет каждую строку свёртки один раз за оператор, а не на каждый платёж.
+Месяц считается по UTC, чтобы не зависеть от TimeZone сессии.
+
+Триггер создаётся до заполнения, в одной транзакции с ним: CREATE TRIGGER
+блокирует запись в payments до коммита, поэтому платежей мимо свёртки не будет.
+"""
+from sqlalchemy import text
+
+# Строки со знаком: +1 — новые версии строк, -1 — старые
+_DELTA = {
+    "insert": "SELECT client_id, date, service, status, amount, 1 AS sign FROM new_rows",
+    "update": "SELECT client_id, date, service, status, amount, 1 AS sign FROM new_rows "
+              "UNION ALL SELECT client_id, date, service, status, amount, -1 FROM old_rows",
+}
+
+_APPLY = """
+    WITH delta AS ({delta}),
+    monthly AS (
+        INSERT INTO payment_monthly AS m (client_id, month, service, status, payments, amount)
+        SELECT client_id, payment_month(date), coalesce(service, ''), coalesce(status, ''), sum(sign), sum(sign * amount)
+        FROM delta
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (client_id, month, service, status) DO UPDATE
+            SET payments = m.payments + EXCLUDED.payments,
+                amount = m.amount + EXCLUDED.amount
+    )
+    INSERT INTO payment_summary AS s (client_id, payments, completed_amount, pending, failed)
+    SELECT client_id,
+           sum(sign),
+           coalesce(sum(sign * amount) FILTER (WHERE status = 'completed'), 0),
+           coalesce(sum(sign) FILTER (WHERE status = 'pending'), 0),
+           coalesce(sum(sign) FILTER (WHERE status = 'failed'), 0)
+    FROM delta
+    GROUP BY client_id
+    ON CONFLICT (client_id) DO UPDATE
+        SET payments = s.payments + EXCLUDED.payments,
+            completed_amount = s.completed_amount + EXCLUDED.completed_amount,
+            pending = s.pending + EXCLUDED.pending,
+            failed = s.failed + EXCLUDED.failed,
+            updated_at = now();
+"""
+
+# Удаление только вычитает: при удалении клиента каскад уже мог убрать его строки
+# свёрток, и вставка их заново нарушила бы внешний ключ
+_SUBTRACT = """
+    WITH delta AS (
+        SELECT client_id, payment_month(date) AS month, coalesce(service, '') AS service,
+               coalesce(status, '') AS status, count(*) AS payments, sum(amount) AS amount
+        FROM old_rows
+        GROUP BY 1, 2, 3, 4
+    ),
+    monthly AS (
+        UPDATE payment_monthly m
+        SET payments = m.payments - d.payments, amount = m.amount - d.amount
+        FROM delta d
+        WHERE m.client_id = d.client_id AND m.month = d.month AND m.service = d.service AND m.status = d.status
+    )
+    UPDATE payment_summary s
+    SET payments = s.payments - d.payments,
+        completed_amount = s.completed_amount - d.completed_amount,
+        pending = s.pending - d.pending,
+        failed = s.failed - d.failed,
+        updated_at = now()
+    FROM (
+        SELECT client_id,
+               sum(payments) AS payments,
+               coalesce(sum(amount) FILTER (WHERE status = 'completed'), 0) AS completed_amount,
+               coalesce(sum(payments) FILTER (WHERE status = 'pending'), 0) AS pending,
+               coalesce(sum(payments) FILTER (WHERE status = 'failed'), 0) AS failed
+        FROM delta
+        GROUP BY client_id
+    ) d
+    WHERE s.client_id = d.client_id;
+"""
+
+# Новый платёж становится последним, только если он позже текущего последнего
+_LAST_ON_INSERT = """
+    UPDATE payment_summary s
+    SET last_payment_id = l.id, last_payment_at = l.date
+    FROM (
+        SELECT DISTINCT ON (client_id) client_id, id, date
+        FROM new_rows
+        ORDER BY client_id, date DESC, id DESC
+    ) l
+    WHERE s.client_id = l.client_id
+      AND (s.last_payment_at IS NULL OR (l.date, l.id) > (s.last_payment_at, s.last_payment_id));
+"""
+
+# После изменения или удаления последний платёж ищется заново по индексу (client_id, date, id)
+_LAST_RECOMPUTE = """
+    UPDATE payment_summary s
+    SET last_payment_id = l.id, last_payment_at = l.date
+    FROM (
+        SELECT c.client_id, p.id, p.date
+        FROM ({clients}) c
+        LEFT JOIN LATERAL (
+            SELECT id, date FROM payments
+            WHERE client_id = c.client_id
+            ORDER BY date DESC, id DESC
+            LIMIT 1
+        ) p ON true
+    ) l
+    WHERE s.client_id = l.client_id;
+    DELETE FROM payment_monthly m
+    USING ({clients}) c
+    WHERE m.client_id = c.client_id AND m.payments = 0;
+"""
+
+
+def _function(op: str) -> str:
+    if op == "insert":
+        body = _APPLY.format(delta=_DELTA[op]) + _LAST_ON_INSERT
+    elif op == "update":
+        body = _APPLY.format(delta=_DELTA[op]) + _LAST_RECOMPUTE.format(
+            clients="SELECT client_id FROM old_rows UNION SELECT client_id FROM new_rows"
+        )
+    else:
+        body = _SUBTRACT + _LAST_RECOMPUTE.format(clients="SELECT DISTINCT client_id FROM old_rows")
+    return (
+        f"CREATE OR REPLACE FUNCTION payments_rollup_{op}() RETURNS trigger LANGUAGE plpgsql AS $$\n"
+        f"BEGIN\n{body}    RETURN NULL;\nEND\n$$"
+    )
+
+
+_TRANSITIONS = {
+    "insert": "REFERENCING NEW TABLE AS new_rows",
+    "update": "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows",
+    "delete": "REFERENCING OLD TABLE AS old_rows",
+}
+
+STATEMENTS = [
+    """
+    CREATE OR REPLACE FUNCTION payment_month(ts TIMESTAMP WITH TIME ZONE) RETURNS DATE
+    LANGUAGE sql IMMUTABLE AS $$ SELECT date_trunc('month', ts AT TIME ZONE 'UTC')::date $$
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS payment_monthly (
+      client_id  INTEGER       NOT NULL REFERENCES clients(id) ON DELETE CASCADE,
+      month      DATE          NOT NULL,
+      service    VARCHAR(100)  NOT NULL,
+      status     VARCHAR(50)   NOT NULL,
+      payments   INTEGER       NOT NULL DEFAULT 0,
+      amount     NUMERIC(14,2) NOT NULL DEFAULT 0,
+      PRIMARY KEY (client_id, month, service, status)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS payment_summary (
+      client_id         INTEGER       PRIMARY KEY REFERENCES clients(id) ON DELETE CASCADE,
+      payments          INTEGER       NOT NULL DEFAULT 0,
+      completed_amount  NUMERIC(14,2) NOT NULL DEFAULT 0,
+      pending           INTEGER       NOT NULL DEFAULT 0,
+      failed            INTEGER       NOT NULL DEFAULT 0,
+      last_payment_id   INTEGER,
+      last_payment_at   TIMESTAMP WITH TIME ZONE,
+      updated_at        TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+    )
+    """,
+    *(_function(op) for op in ("insert", "update", "delete")),
+    *(
+        f"DROP TRIGGER IF EXISTS trg_payments_rollup_{op} ON payments"
+        for op in ("insert", "update", "delete")
+    ),
+    *(
+        f"CREATE TRIGGER trg_payments_rollup_{op} AFTER {op.upper()} ON payments "
+        f"{_TRANSITIONS[op]} FOR EACH STATEMENT EXECUTE FUNCTION payments_rollup_{op}()"
+        for op in ("insert", "update", "delete")
+    ),
+    # Заполнение по уже существующим платежам; функция нужна и после массовой заливки
+    """
+    CREATE OR REPLACE FUNCTION payment_rollups_rebuild() RETURNS void LANGUAGE sql AS $$
+        TRUNCATE payment_monthly, payment_summary;
+        INSERT INTO payment_monthly (client_id, month, service, status, payments, amount)
+        SELECT client_id, payment_month(date), coalesce(service, ''), coalesce(status, ''), count(*), sum(amount)
+        FROM payments
+        GROUP BY 1, 2, 3, 4;
+        INSERT INTO payment_summary (client_id, payments, completed_amount, pending, failed,
+                                     last_payment_id, last_payment_at)
+        SELECT client_id,
+               count(*),
+               coalesce(sum(amount) FILTER (WHERE status = 'completed'), 0),
+               count(*) FILTER (WHERE status = 'pending'),
+               count(*) FILTER (WHERE status = 'failed'),
+               (array_agg(id ORDER BY date DESC, id DESC))[1],
+               max(date)
+        FROM payments
+        GROUP BY client_id;
+    $$
+    """,
+    "SELECT payment_rollups_rebuild()",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
@@ -0,0 +1,102 @@
+"""
+Аналитика заявок для супервизоров: журнал смен статуса и почасовые свёртки.
+
+Триггер на tickets пишет каждое создание, смену статуса и категории в ticket_status_events.
+services/analytics разбирает журнал пачками (DELETE ... RETURNING — разобранное
+удаляется, незакоммиченное просто не видно и попадёт в следующую пачку) и
+обновляет:
+- ticket_facts — по строке на заявку: текущий статус, первый ответ, закрытие;
+- analytics_ticket_hourly — сколько заявок перешло в статус за час (new — создано);
+- analytics_sla_hourly — первые ответы и закрытия за час с суммой и максимумом времени.
+
+Первый ответ — первый уход заявки из статуса new, закрытие — первый переход в closed.
+Для уже существующих заявок журнал заполняется по created_at и updated_at.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS ticket_status_events (
+      id           BIGSERIAL    PRIMARY KEY,
+      ticket_id    INTEGER      NOT NULL,
+      from_status  VARCHAR(50),
+      to_status    VARCHAR(50)  NOT NULL,
+      at           TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_ticket_status_events_at ON ticket_status_events (at, id)",
+    """
+    CREATE TABLE IF NOT EXISTS ticket_facts (
+      ticket_id          INTEGER PRIMARY KEY REFERENCES tickets(id) ON DELETE CASCADE,
+      created_at         TIMESTAMP WITH TIME ZONE NOT NULL,
+      category           VARCHAR(100) NOT NULL DEFAULT '',
+      channel            VARCHAR(50)  NOT NULL DEFAULT '',
+      status             VARCHAR(50)  NOT NULL,
+      status_at          TIMESTAMP WITH TIME ZONE NOT NULL,
+      first_response_at  TIMESTAMP WITH TIME ZONE,
+      closed_at          TIMESTAMP WITH TIME ZONE
+    )
+    """,
+    # Очередь открытых заявок — небольшая часть таблицы
+    "CREATE INDEX IF NOT EXISTS ix_ticket_facts_open ON ticket_facts (status, category) WHERE status <> 'closed'",
+    """
+    CREATE TABLE IF NOT EXISTS analytics_ticket_hourly (
+      hour      TIMESTAMP WITH TIME ZONE NOT NULL,
+      category  VARCHAR(100) NOT NULL,
+      channel   VARCHAR(50)  NOT NULL,
+      status    VARCHAR(50)  NOT NULL,
+      tickets   INTEGER      NOT NULL DEFAULT 0,
+      PRIMARY KEY (hour, category, channel, status)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS analytics_sla_hourly (
+      hour                     TIMESTAMP WITH TIME ZONE NOT NULL,
+      category                 VARCHAR(100) NOT NULL,
+      channel                  VARCHAR(50)  NOT NULL,
+      first_responses          INTEGER NOT NULL DEFAULT 0,
+      first_response_seconds   DOUBLE PRECISION NOT NULL DEFAULT 0,
+      first_response_max       DOUBLE PRECISION,
+      closed                   INTEGER NOT NULL DEFAULT 0,
+      close_seconds            DOUBLE PRECISION NOT NULL DEFAULT 0,
+      close_max                DOUBLE PRECISION,
+      PRIMARY KEY (hour, category, channel)
+    )
+    """,
+    """
+    CREATE OR REPLACE FUNCTION tickets_status_event() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO ticket_status_events (ticket_id, from_status, to_status, at)
+            VALUES (NEW.id, NULL, coalesce(NEW.status, 'new'), coalesce(NEW.created_at, now()));
+        ELSIF NEW.status IS DISTINCT FROM OLD.status OR NEW.category IS DISTINCT FROM OLD.category THEN
+            -- Смена только категории пишется с from_status = to_status: она не считается
+            -- переходом, но переносит заявку в ticket_facts в новую категорию
+            INSERT INTO ticket_status_events (ticket_id, from_status, to_status)
+            VALUES (NEW.id, OLD.status, coalesce(NEW.status, ''));
+        END IF;
+        RETURN NULL;
+    END
+    $$
+    """,
+    "DROP TRIGGER IF EXISTS trg_tickets_status_event ON tickets",
+    "CREATE TRIGGER trg_tickets_status_event AFTER INSERT OR UPDATE OF status, category ON tickets "
+    "FOR EACH ROW EXECUTE FUNCTION tickets_status_event()",
+    # Существующие заявки: создание и, если статус уже не new, переход в него в момент updated_at
+    """
+    INSERT INTO ticket_status_events (ticket_id, from_status, to_status, at)
+    SELECT id, NULL, 'new', coalesce(created_at, now()) FROM tickets
+    WHERE NOT EXISTS (SELECT 1 FROM ticket_facts)
+    """,
+    """
+    INSERT INTO ticket_status_events (ticket_id, from_status, to_status, at)
+    SELECT id, 'new', status, greatest(coalesce(updated_at, created_at, now()), coalesce(created_at, now()))
+    FROM tickets
+    WHERE coalesce(status, 'new') <> 'new' AND NOT EXISTS (SELECT 1 FROM ticket_facts)
+    """,
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
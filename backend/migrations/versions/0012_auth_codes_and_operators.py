@@ -0,0 +1,37 @@
+"""
+Второй фактор входа клиента и учётные записи операторов.
+
+login_codes — одноразовые коды входа: хранится только HMAC кода, число попыток
+и срок действия. operators — операторы панели (/api/operator/*) с паролем
+в виде PBKDF2-хэша; создаются командой python -m backend.services.security.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    """
+    CREATE TABLE IF NOT EXISTS login_codes (
+      id          SERIAL       PRIMARY KEY,
+      phone       VARCHAR(20)  NOT NULL,
+      code_hash   VARCHAR(64)  NOT NULL,
+      attempts    INTEGER      NOT NULL DEFAULT 0,
+      expires_at  TIMESTAMP WITH TIME ZONE NOT NULL,
+      used_at     TIMESTAMP WITH TIME ZONE,
+      created_at  TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS ix_login_codes_phone_created_at ON login_codes (phone, created_at)",
+    """
+    CREATE TABLE IF NOT EXISTS operators (
+      id             SERIAL        PRIMARY KEY,
+      login          VARCHAR(100)  NOT NULL UNIQUE,
+      password_hash  VARCHAR(255)  NOT NULL,
+      is_active      BOOLEAN       NOT NULL DEFAULT TRUE,
+      created_at     TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT now()
+    )
+    """,
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
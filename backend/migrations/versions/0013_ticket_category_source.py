@@ -0,0 +1,15 @@
+"""
+Кто поставил категорию заявки: openai, local, duplicate или operator.
+Локальный классификатор учится только на openai и operator — не на своих же
+предсказаниях. У старых заявок NULL: их разметку берём из ai_logs.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "ALTER TABLE tickets ADD COLUMN IF NOT EXISTS category_source VARCHAR(20)",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
@@ -0,0 +1,17 @@
+"""
+tickets.created_at NOT NULL: keyset-пагинация списка оператора идёт по
+(created_at, id), и строки с NULL в неё не попадали, а курсор на них падал.
+Пустые значения заполняются временем последнего изменения или текущим.
+"""
+from sqlalchemy import text
+
+STATEMENTS = [
+    "UPDATE tickets SET created_at = COALESCE(updated_at, now()) WHERE created_at IS NULL",
+    "ALTER TABLE tickets ALTER COLUMN created_at SET DEFAULT now()",
+    "ALTER TABLE tickets ALTER COLUMN created_at SET NOT NULL",
+]
+
+
+def upgrade(conn):
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
@@ -0,0 +1,29 @@
+"""
+payments.date NOT NULL: по дате считается месяц свёртки (часть первичного ключа
+payment_monthly) и курсор истории платежей, NULL ломал и то и другое.
+
+Свёртки и их триггеры созданы в 0010, поэтому платежи без даты, если они есть,
+заполняются при выключенном триггере (старая строка с NULL-месяцем уронила бы
+его), а свёртки пересчитываются.
+"""
+from sqlalchemy import text
+
+BACKFILL = [
+    "ALTER TABLE payments DISABLE TRIGGER trg_payments_rollup_update",
+    "UPDATE payments SET date = now() WHERE date IS NULL",
+    "ALTER TABLE payments ENABLE TRIGGER trg_payments_rollup_update",
+    "SELECT payment_rollups_rebuild()",
+]
+
+STATEMENTS = [
+    "ALTER TABLE payments ALTER COLUMN date SET DEFAULT now()",
+    "ALTER TABLE payments ALTER COLUMN date SET NOT NULL",
+]
+
+
+def upgrade(conn):
+    if conn.execute(text("SELECT EXISTS (SELECT 1 FROM payments WHERE date IS NULL)")).scalar():
+        for statement in BACKFILL:
+            conn.execute(text(statement))
+    for statement in STATEMENTS:
+        conn.execute(text(statement))
@@ -1,6 +1,6 @@
 from sqlalchemy import (
-    Column, Integer, String, Text, DateTime,
-    ForeignKey, Numeric, JSON, func
+    Column, Integer, BigInteger, String, Text, Date, DateTime, Boolean, Float,
+    ForeignKey, Numeric, JSON, Index, func, text as sql_text
 )
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
@@ -21,6 +21,7 @@ class Client(Base):
     services = Column(JSON, nullable=True)  # Список подключенных услуг
     balance = Column(Numeric(12, 2), default=0)
     debt = Column(Numeric(12, 2), default=0)
+    telegram_chat_id = Column(String(64), nullable=True)  # для уведомлений в Telegram
     created_at = Column(DateTime, server_default=func.now())
 
     # Связи
@@ -41,17 +42,43 @@ class Ticket(Base):
     text = Column(Text, nullable=False)
     channel = Column(String(50), default="web")     # web, email, telegram и т.п.
     category = Column(String(100), nullable=True)
+    category_source = Column(String(20), nullable=True)  # openai, local, duplicate, operator
     priority = Column(String(50), default="normal")
     status = Column(String(50), default="new")      # new, in_progress, closed...
     ai_response = Column(Text, nullable=True)
-    created_at = Column(DateTime, server_default=func.now())
+    created_at = Column(DateTime, server_default=func.now(), nullable=False)
     updated_at = Column(DateTime, onupdate=func.now())
     assigned_to = Column(String(100), nullable=True)
+    # Состояние AI-обогащения: pending, processing, done, failed
+    enrichment_status = Column(String(20), default="done", nullable=False)
+    enrichment_attempts = Column(Integer, default=0, nullable=False)
     # Связи
     client = relationship("Client", back_populates="tickets")
     ai_logs = relationship("AILog", back_populates="ticket")
     comments = relationship("Comment", back_populates="ticket")
 
+    __table_args__ = (
+        # Keyset-пагинация панели оператора и фильтры по ней
+        Index("ix_tickets_created_at_id", "created_at", "id"),
+        Index("ix_tickets_status_created_at", "status", "created_at", "id"),
+        Index("ix_tickets_category_created_at", "category", "created_at", "id"),
+        Index("ix_tickets_assigned_to_created_at", "assigned_to", "created_at", "id"),
+        Index("ix_tickets_priority_created_at", "priority", "created_at", "id"),
+        Index("ix_tickets_channel_created_at", "channel", "created_at", "id"),
+        Index("ix_tickets_client_phone_created_at", "client_phone", "created_at"),
+        # Очередь AI-обогащения: в частичном индексе только необработанные заявки
+        Index(
+            "ix_tickets_enrichment_queue", "id",
+            postgresql_where=sql_text("enrichment_status IN ('pending', 'processing')"),
+        ),
+        # Полнотекстовый поиск, выражение совпадает с services/search.document()
+        Index(
+            "ix_tickets_search",
+            sql_text("to_tsvector('russian'::regconfig, coalesce(subject, '') || ' ' || text)"),
+            postgresql_using="gin",
+        ),
+    )
+
 
 
 class Comment(Base):
@@ -64,6 +91,10 @@ class Comment(Base):
 
     ticket = relationship("Ticket", back_populates="comments")
 
+    __table_args__ = (
+        Index("ix_comments_ticket_id_created_at", "ticket_id", "created_at"),
+    )
+
 
 
 class Payment(Base):
@@ -75,13 +106,116 @@ class Payment(Base):
     id = Column(Integer, primary_key=True, index=True)
     client_id = Column(Integer, ForeignKey("clients.id"), nullable=False)
     amount = Column(Numeric(12, 2), nullable=False)
-    date = Column(DateTime, server_default=func.now())
+    date = Column(DateTime, server_default=func.now(), nullable=False)
     service = Column(String(100), nullable=True)
     status = Column(String(50), default="completed")  # pending, completed, failed...
 
     # Связь
     client = relationship("Client", back_populates="payments")
 
+    __table_args__ = (
+        Index("ix_payments_client_id_date_id", "client_id", "date", "id"),
+    )
+
+
+class PaymentMonthly(Base):
+    """
+    Свёртка платежей клиента по месяцу, услуге и статусу.
+    Ведётся триггерами на payments (миграция 0010), приложение её только читает.
+    """
+    __tablename__ = "payment_monthly"
+
+    client_id = Column(Integer, ForeignKey("clients.id"), primary_key=True)
+    month = Column(Date, primary_key=True)  # первое число месяца, UTC
+    service = Column(String(100), primary_key=True)  # '' — услуга не указана
+    status = Column(String(50), primary_key=True)
+    payments = Column(Integer, nullable=False, default=0)
+    amount = Column(Numeric(14, 2), nullable=False, default=0)
+
+
+class PaymentSummary(Base):
+    """
+    Итоги платежей клиента и его последний платёж. Ведётся триггерами на payments.
+    """
+    __tablename__ = "payment_summary"
+
+    client_id = Column(Integer, ForeignKey("clients.id"), primary_key=True)
+    payments = Column(Integer, nullable=False, default=0)
+    completed_amount = Column(Numeric(14, 2), nullable=False, default=0)
+    pending = Column(Integer, nullable=False, default=0)
+    failed = Column(Integer, nullable=False, default=0)
+    last_payment_id = Column(Integer, nullable=True)
+    last_payment_at = Column(DateTime(timezone=True), nullable=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class TicketStatusEvent(Base):
+    """
+    Журнал создания и смен статуса заявок. Пишет триггер на tickets (миграция 0011),
+    разбирает и удаляет services/analytics.
+    """
+    __tablename__ = "ticket_status_events"
+
+    id = Column(BigInteger, primary_key=True)
+    ticket_id = Column(Integer, nullable=False)
+    from_status = Column(String(50), nullable=True)  # NULL — заявка создана; = to_status — сменилась категория
+    to_status = Column(String(50), nullable=False)
+    at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_ticket_status_events_at", "at", "id"),
+    )
+
+
+class TicketFacts(Base):
+    """
+    Состояние заявки для аналитики: текущий статус, первый ответ и закрытие.
+    """
+    __tablename__ = "ticket_facts"
+
+    ticket_id = Column(Integer, ForeignKey("tickets.id", ondelete="CASCADE"), primary_key=True)
+    created_at = Column(DateTime(timezone=True), nullable=False)
+    category = Column(String(100), nullable=False, default="")
+    channel = Column(String(50), nullable=False, default="")
+    status = Column(String(50), nullable=False)
+    status_at = Column(DateTime(timezone=True), nullable=False)  # время события, давшего status
+    first_response_at = Column(DateTime(timezone=True), nullable=True)  # первый уход из new
+    closed_at = Column(DateTime(timezone=True), nullable=True)          # первое закрытие
+
+    __table_args__ = (
+        Index("ix_ticket_facts_open", "status", "category", postgresql_where=sql_text("status <> 'closed'")),
+    )
+
+
+class TicketHourly(Base):
+    """
+    Сколько заявок перешло в статус за час; status = new — созданные.
+    """
+    __tablename__ = "analytics_ticket_hourly"
+
+    hour = Column(DateTime(timezone=True), primary_key=True)
+    category = Column(String(100), primary_key=True)  # '' — категория не определена
+    channel = Column(String(50), primary_key=True)
+    status = Column(String(50), primary_key=True)
+    tickets = Column(Integer, nullable=False, default=0)
+
+
+class SlaHourly(Base):
+    """
+    Первые ответы и закрытия за час: число, сумма и максимум времени от создания, в секундах.
+    """
+    __tablename__ = "analytics_sla_hourly"
+
+    hour = Column(DateTime(timezone=True), primary_key=True)
+    category = Column(String(100), primary_key=True)
+    channel = Column(String(50), primary_key=True)
+    first_responses = Column(Integer, nullable=False, default=0)
+    first_response_seconds = Column(Float, nullable=False, default=0)
+    first_response_max = Column(Float, nullable=True)
+    closed = Column(Integer, nullable=False, default=0)
+    close_seconds = Column(Float, nullable=False, default=0)
+    close_max = Column(Float, nullable=True)
+
 
 class Template(Base):
     """
@@ -94,6 +228,9 @@ class Template(Base):
     category = Column(String(100), nullable=False)
     text = Column(Text, nullable=False)
     created_at = Column(DateTime, server_default=func.now())
+    # Копятся в памяти services/templates и сбрасываются сюда периодически
+    uses = Column(BigInteger, nullable=False, server_default="0")
+    last_used_at = Column(DateTime(timezone=True), nullable=True)
 
 
 class AILog(Base):
@@ -103,12 +240,135 @@ class AILog(Base):
     __tablename__ = "ai_logs"
 
     id = Column(Integer, primary_key=True, index=True)
-    ticket_id = Column(Integer, ForeignKey("tickets.id"), nullable=False)
+    # NULL — вызов без заявки (чат, сводка диалога, пакетная классификация)
+    ticket_id = Column(Integer, ForeignKey("tickets.id"), nullable=True, index=True)
     action = Column(String(50), nullable=False)  # classify, generate_response...
     request_payload = Column(JSON, nullable=True)
     response_payload = Column(JSON, nullable=True)
     confidence = Column(Numeric(5, 4), nullable=True)  # при наличии
+    cached = Column(Boolean, default=False, nullable=False)  # ответ взят из AI-кэша
+    # Учёт вызова модели (пусто, если ответ из кэша или локального классификатора)
+    model = Column(String(100), nullable=True)
+    prompt_tokens = Column(Integer, nullable=True)
+    completion_tokens = Column(Integer, nullable=True)
+    latency_ms = Column(Integer, nullable=True)
+    cost = Column(Numeric(12, 6), nullable=True)  # USD
     created_at = Column(DateTime, server_default=func.now())
 
     # Связь
     ticket = relationship("Ticket", back_populates="ai_logs")
+
+    __table_args__ = (
+        Index("ix_ai_logs_created_at", "created_at"),
+    )
+
+
+class AICacheEntry(Base):
+    """
+    Общий (межпроцессный) уровень кэша AI-ответов.
+    Ключ — sha256 от нормализованного текста, модели, версии промпта и температуры.
+    """
+    __tablename__ = "ai_cache"
+
+    key = Column(String(64), primary_key=True)
+    action = Column(String(50), nullable=False)
+    value = Column(Text, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+
+class Notification(Base):
+    """
+    Исходящее уведомление клиенту (outbox). Отправляет notifications.NotificationWorker.
+    Пока статус sending, next_attempt_at служит сроком аренды записи воркером.
+    """
+    __tablename__ = "notifications"
+
+    id = Column(Integer, primary_key=True, index=True)
+    ticket_id = Column(Integer, ForeignKey("tickets.id"), nullable=True, index=True)
+    channel = Column(String(20), nullable=False)       # email, telegram
+    recipient = Column(String(255), nullable=False)    # адрес или chat_id
+    subject = Column(String(255), nullable=True)
+    body = Column(Text, nullable=False)
+    status = Column(String(20), default="pending", nullable=False)  # pending, sending, sent, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime, server_default=func.now(), nullable=False)
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        # Очередь отправки: в частичном индексе только неотправленные
+        Index(
+            "ix_notifications_queue", "next_attempt_at",
+            postgresql_where=sql_text("status IN ('pending', 'sending')"),
+        ),
+    )
+
+
+class LoginCode(Base):
+    """
+    Одноразовый код входа клиента (второй фактор). Хранится только HMAC кода.
+    """
+    __tablename__ = "login_codes"
+
+    id = Column(Integer, primary_key=True)
+    phone = Column(String(20), nullable=False)
+    code_hash = Column(String(64), nullable=False)
+    attempts = Column(Integer, default=0, nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+    used_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+    __table_args__ = (
+        Index("ix_login_codes_phone_created_at", "phone", "created_at"),
+    )
+
+
+class Operator(Base):
+    """
+    Оператор панели /api/operator/*. Пароль — PBKDF2-хэш (security.hash_password).
+    """
+    __tablename__ = "operators"
+
+    id = Column(Integer, primary_key=True)
+    login = Column(String(100), unique=True, nullable=False)
+    password_hash = Column(String(255), nullable=False)
+    is_active = Column(Boolean, default=True, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+
+class ChatSession(Base):
+    """
+    Диалог клиента с AI-ассистентом.
+    Старые реплики сворачиваются в summary, контекст клиента кэшируется в context.
+    """
+    __tablename__ = "chat_sessions"
+
+    id = Column(String(36), primary_key=True)  # uuid4
+    client_id = Column(Integer, ForeignKey("clients.id"), nullable=False, index=True)
+    summary = Column(Text, nullable=True)
+    summarized_until = Column(Integer, default=0, nullable=False)  # id последнего свёрнутого сообщения
+    context = Column(Text, nullable=True)
+    context_built_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, server_default=func.now())
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+
+    messages = relationship("ChatMessage", back_populates="session")
+
+
+class ChatMessage(Base):
+    __tablename__ = "chat_messages"
+
+    id = Column(Integer, primary_key=True, index=True)
+    session_id = Column(String(36), ForeignKey("chat_sessions.id"), nullable=False)
+    role = Column(String(20), nullable=False)  # user, assistant
+    content = Column(Text, nullable=False)
+    tokens = Column(Integer, nullable=False)
+    created_at = Column(DateTime, server_default=func.now())
+
+    session = relationship("ChatSession", back_populates="messages")
+
+    __table_args__ = (
+        Index("ix_chat_messages_session_id_id", "session_id", "id"),
+    )
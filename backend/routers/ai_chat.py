@@ -1,22 +1,27 @@
+import json
+from typing import Optional
+
 from fastapi import APIRouter, HTTPException, Depends
-from pydantic import BaseModel
-from sqlalchemy.orm import Session
-from openai import OpenAI  # ✅ Новый импорт
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from ..config import settings
-from ..services.db import get_db
-from ..models import Client, Ticket, Payment
+from ..services.db import get_async_db, AsyncSessionLocal
+from ..services import chat_memory, client_cache
+from ..services import ai_gateway
+from ..services.security import CurrentClient, get_current_client
 
-# Инициализация клиента OpenAI
-client_ai = OpenAI(api_key=settings.OPENAI_API_KEY)
+CHAT_MODEL = "gpt-4"
 
 # Схемы
 class ExtendedChatRequest(BaseModel):
     message: str
-    client_phone: str
+    session_id: Optional[str] = Field(None, description="Продолжить диалог; без него начинается новый")
 
 class ExtendedChatResponse(BaseModel):
     ai_message: str
+    session_id: str
 
 # Инициализация роутера
 router = APIRouter(
@@ -24,57 +29,126 @@ router = APIRouter(
     tags=["ai"],
 )
 
+
+async def _load_client(db: AsyncSession, phone: str) -> dict:
+    client = await client_cache.get_profile(db, phone)
+    if not client:
+        raise HTTPException(status_code=404, detail="Клиент не найден")
+    return client
+
+
 @router.post(
     "/chat_with_db",
     response_model=ExtendedChatResponse,
     summary="Персонализированный чат с доступом к данным"
 )
-async def chat_with_ai_and_db(payload: ExtendedChatRequest, db: Session = Depends(get_db)):
-    try:
-        # 1. Получаем данные клиента
-        client = db.query(Client).filter(Client.phone == payload.client_phone).first()
-        if not client:
-            raise HTTPException(status_code=404, detail="Клиент не найден")
-
-        # 2. Формируем персонализированный промпт
-        prompt = (
-            f"Ты - персональный ассистент клиента {client.full_name} в сервисном портале.\n"
-            f"Информация о клиенте:\n"
-            f"- Имя: {client.full_name}\n"
-            f"- Тариф: {client.tariff or 'не указан'}\n"
-            f"- Баланс: {client.balance}₸\n"
-            f"- Долг: {client.debt}₸\n\n"
-            
-            f"Отвечай на русском языке, будь вежливым и профессиональным.\n"
-            f"Если клиент спрашивает о балансе или платежах, уточняй конкретные цифры.\n"
-            f"Если вопрос про заявки, проверяй их статус.\n\n"
-            f"Вопрос клиента: {payload.message}"
-        )
+async def chat_with_ai_and_db(
+    payload: ExtendedChatRequest,
+    current: CurrentClient = Depends(get_current_client),
+    db: AsyncSession = Depends(get_async_db)
+):
+    # 1. Получаем данные клиента, сессию и собираем контекст
+    client = await _load_client(db, current.phone)
+    session = await chat_memory.get_session(db, current.id, payload.session_id)
+    messages = await chat_memory.build_messages(db, session, client, payload.message)
+    # Не держим транзакцию и соединение из пула, пока ждём модель;
+    # реплики record_turn запишет новой транзакцией
+    await db.commit()
 
-        # 3. Получаем ответ от AI
-        response = client_ai.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {
-                    "role": "system", 
-                    "content": (
-                        "Ты персональный ассистент сервисного портала. "
-                        "Отвечай кратко и по делу на русском языке. "
-                        "Используй только факты из предоставленных данных."
-                    )
-                },
-                {"role": "user", "content": prompt}
-            ],
+    try:
+        # 2. Получаем ответ от AI (неблокирующий клиент)
+        response, _ = await ai_gateway.chat_completion(
+            model=CHAT_MODEL,
+            messages=messages,
             temperature=0.3,
-            max_tokens=256
+            max_tokens=256,
+            phone=current.phone,
+            log_action="chat",
         )
-
-        # 4. Возвращаем ответ
         ai_message = response.choices[0].message.content.strip()
-        return ExtendedChatResponse(ai_message=ai_message)
-
+    except HTTPException:
+        # 429 от лимитов ai_gateway отдаём как есть
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500,
             detail=f"Ошибка AI-ассистента: {str(e)}"
-        )
\ No newline at end of file
+        )
+
+    # 3. Сохраняем реплики и возвращаем ответ
+    await chat_memory.record_turn(db, session.id, payload.message, ai_message)
+    return ExtendedChatResponse(ai_message=ai_message, session_id=session.id)
+
+
+def _sse(data: dict, event: Optional[str] = None) -> str:
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+@router.post(
+    "/chat_with_db/stream",
+    summary="Персонализированный чат с потоковым ответом (Server-Sent Events)"
+)
+async def chat_with_ai_and_db_stream(
+    payload: ExtendedChatRequest,
+    current: CurrentClient = Depends(get_current_client),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Отдаёт ответ модели по мере генерации.
+    События: `data: {"delta": "..."}` на каждый фрагмент, затем `event: done`
+    с полным текстом и session_id или `event: error`.
+    """
+    # Клиента и сессию ищем до начала потока, чтобы 404 пришёл обычным HTTP-статусом
+    client = await _load_client(db, current.phone)
+    session = await chat_memory.get_session(db, current.id, payload.session_id)
+    session_id = session.id
+    messages = await chat_memory.build_messages(db, session, client, payload.message)
+    # Кэш контекста сохраняем сразу: сессия запроса не живёт дольше начала потока
+    await db.commit()
+
+    # Поток открываем до ответа, чтобы 429 от лимитов пришёл обычным HTTP-статусом
+    stream, open_error = None, None
+    try:
+        stream = await ai_gateway.stream_chat_completion(
+            model=CHAT_MODEL,
+            messages=messages,
+            temperature=0.3,
+            max_tokens=256,
+            phone=current.phone,
+            log_action="chat",
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        open_error = e
+
+    async def events():
+        parts = []
+        try:
+            if open_error is not None:
+                raise open_error
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield _sse({"delta": delta})
+            ai_message = "".join(parts).strip()
+            async with AsyncSessionLocal() as memory_db:
+                await chat_memory.record_turn(memory_db, session_id, payload.message, ai_message)
+            yield _sse({"ai_message": ai_message, "session_id": session_id}, event="done")
+        except Exception as e:
+            yield _sse({"detail": f"Ошибка AI-ассистента: {str(e)}"}, event="error")
+        finally:
+            if stream is not None:
+                await stream.aclose()
+
+    # Слот модели освобождается и тогда, когда events() не успел начаться (клиент ушёл сразу)
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        background=BackgroundTask(stream.aclose) if stream is not None else None,
+    )
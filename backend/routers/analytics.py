@@ -0,0 +1,161 @@
+# backend/routers/analytics.py
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from pydantic import BaseModel
+from typing import List, Optional
+from datetime import datetime, timedelta, timezone
+
+from ..services.db import get_async_db
+from ..services import analytics
+from ..services.security import get_current_operator
+from ..models import SlaHourly, TicketFacts, TicketHourly, TicketStatusEvent
+
+router = APIRouter(prefix="/api/operator/analytics", tags=["analytics"], dependencies=[Depends(get_current_operator)])
+
+MAX_RANGE = timedelta(days=366)
+
+class VolumePoint(BaseModel):
+    key: str        # час/день в ISO, категория, канал или статус
+    tickets: int
+
+class SlaPoint(BaseModel):
+    key: Optional[str]              # None при group_by=none
+    first_responses: int
+    avg_first_response_seconds: Optional[float]
+    max_first_response_seconds: Optional[float]
+    closed: int
+    avg_close_seconds: Optional[float]
+    max_close_seconds: Optional[float]
+
+class BacklogRow(BaseModel):
+    status: str
+    category: str
+    tickets: int
+
+class Backlog(BaseModel):
+    items: List[BacklogRow]
+    pending_events: int  # ещё не разобранные события журнала — насколько свёртки отстают
+
+def _range(date_from: Optional[datetime], date_to: Optional[datetime]):
+    """Интервал [date_from, date_to), по умолчанию последние 7 дней; без зоны — UTC."""
+    date_to = date_to or datetime.now(timezone.utc)
+    date_from = date_from or date_to - timedelta(days=7)
+    if date_to.tzinfo is None:
+        date_to = date_to.replace(tzinfo=timezone.utc)
+    if date_from.tzinfo is None:
+        date_from = date_from.replace(tzinfo=timezone.utc)
+    if date_from >= date_to:
+        raise HTTPException(400, "date_from должен быть раньше date_to")
+    if date_to - date_from > MAX_RANGE:
+        raise HTTPException(400, "Интервал не больше 366 дней")
+    # Свёртки почасовые: начало интервала округляется вниз до часа
+    return date_from.replace(minute=0, second=0, microsecond=0), date_to
+
+def _group_key(model, group_by: str):
+    if group_by == "hour":
+        return model.hour
+    if group_by == "day":
+        return func.date_trunc("day", model.hour)
+    return getattr(model, group_by)
+
+def _key(value) -> str:
+    return value.isoformat() if isinstance(value, datetime) else value
+
+@router.get("/volume", response_model=List[VolumePoint], summary="Число заявок по часам, дням, категориям, каналам или статусам")
+async def ticket_volume(
+    group_by:  str = Query("day", pattern="^(hour|day|category|channel|status)$"),
+    date_from: Optional[datetime] = Query(None),
+    date_to:   Optional[datetime] = Query(None),
+    status:    Optional[str] = Query(None, description="В какой статус перешли заявки; по умолчанию new — созданные"),
+    category:  Optional[str] = Query(None),
+    channel:   Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Читается из analytics_ticket_hourly: строк не больше, чем часов в интервале ×
+    категорий × каналов × статусов, — сколько бы заявок ни было в истории.
+    """
+    since, until = _range(date_from, date_to)
+    key = _group_key(TicketHourly, group_by)
+    q = (
+        select(key, func.sum(TicketHourly.tickets))
+        .where(TicketHourly.hour >= since, TicketHourly.hour < until)
+        .group_by(key)
+        .order_by(key)
+    )
+    # Без фильтра по статусу суммы смешали бы созданные заявки с переходами
+    if status or group_by != "status":
+        q = q.where(TicketHourly.status == (status or "new"))
+    if category is not None: q = q.where(TicketHourly.category == category)
+    if channel is not None:  q = q.where(TicketHourly.channel  == channel)
+
+    rows = (await db.execute(q)).all()
+    return [{"key": _key(k), "tickets": n} for k, n in rows]
+
+@router.get("/sla", response_model=List[SlaPoint], summary="Время до первого ответа и до закрытия")
+async def ticket_sla(
+    group_by:  str = Query("none", pattern="^(none|hour|day|category|channel)$"),
+    date_from: Optional[datetime] = Query(None),
+    date_to:   Optional[datetime] = Query(None),
+    category:  Optional[str] = Query(None),
+    channel:   Optional[str] = Query(None),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Первый ответ — первый уход заявки из статуса new, закрытие — первый переход в closed;
+    время считается от создания заявки и относится к часу ответа или закрытия.
+    """
+    since, until = _range(date_from, date_to)
+    s = SlaHourly
+    responses, closed = func.sum(s.first_responses), func.sum(s.closed)
+    columns = [
+        responses,
+        func.sum(s.first_response_seconds) / func.nullif(responses, 0),
+        func.max(s.first_response_max),
+        closed,
+        func.sum(s.close_seconds) / func.nullif(closed, 0),
+        func.max(s.close_max),
+    ]
+    q = select(*columns).where(s.hour >= since, s.hour < until)
+    if group_by != "none":
+        key = _group_key(s, group_by)
+        q = select(key, *columns).where(s.hour >= since, s.hour < until).group_by(key).order_by(key)
+    if category is not None: q = q.where(s.category == category)
+    if channel is not None:  q = q.where(s.channel  == channel)
+
+    result = []
+    for row in (await db.execute(q)).all():
+        key, values = (None, row) if group_by == "none" else (_key(row[0]), row[1:])
+        result.append({
+            "key": key,
+            "first_responses": values[0] or 0,
+            "avg_first_response_seconds": values[1],
+            "max_first_response_seconds": values[2],
+            "closed": values[3] or 0,
+            "avg_close_seconds": values[4],
+            "max_close_seconds": values[5],
+        })
+    return result
+
+@router.get("/backlog", response_model=Backlog, summary="Открытые заявки по статусам и категориям")
+async def ticket_backlog(db: AsyncSession = Depends(get_async_db)):
+    """Из ticket_facts по частичному индексу открытых заявок."""
+    rows = (await db.execute(
+        select(TicketFacts.status, TicketFacts.category, func.count())
+        .where(TicketFacts.status != "closed")
+        .group_by(TicketFacts.status, TicketFacts.category)
+        .order_by(TicketFacts.status, TicketFacts.category)
+    )).all()
+    pending = (await db.execute(select(func.count()).select_from(TicketStatusEvent))).scalar_one()
+    return {
+        "items": [{"status": st, "category": cat, "tickets": n} for st, cat, n in rows],
+        "pending_events": pending,
+    }
+
+@router.post("/refresh", summary="Разобрать журнал смен статуса сейчас")
+async def refresh_analytics():
+    events = await run_in_threadpool(analytics.refresher.refresh)
+    return {"events": events, **analytics.refresher.stats()}
@@ -1,9 +1,20 @@
+import hmac
+import logging
+from datetime import datetime, timedelta, timezone
+
 from fastapi import APIRouter, Depends, HTTPException, status
 from pydantic import BaseModel, EmailStr, Field
 from sqlalchemy.orm import Session
 
+from ..config import settings
 from ..services.db import get_db
-from ..models import Client
+from ..services import notifications
+from ..services.security import (
+    create_access_token, create_operator_token, hash_login_code, new_login_code, verify_password,
+)
+from ..models import Client, LoginCode, Operator
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(
     prefix="/api/auth",
@@ -25,8 +36,24 @@ class RegisterResponse(BaseModel):
 class LoginRequest(BaseModel):
     phone: str = Field(..., example="+79001234567")
 
+class LoginCodeSent(BaseModel):
+    message: str
+    expires_in: int      # сколько секунд действует код
+    resend_after: int    # через сколько секунд можно запросить новый
+
+class LoginVerifyRequest(BaseModel):
+    phone: str = Field(..., example="+79001234567")
+    code: str = Field(..., min_length=6, max_length=6, example="123456")
+
+class OperatorLoginRequest(BaseModel):
+    login: str = Field(..., example="operator1")
+    password: str
+
 class LoginResponse(BaseModel):
     message: str
+    access_token: str
+    token_type: str = "bearer"
+    expires_in: int
 
 
 # Эндпоинты
@@ -67,15 +94,112 @@ def register_user(payload: RegisterRequest, db: Session = Depends(get_db)):
 
 @router.post(
     "/login",
-    response_model=LoginResponse,
-    summary="Вход по номеру телефона"
+    response_model=LoginCodeSent,
+    summary="Вход, шаг 1: отправить код на email или в Telegram клиента"
 )
 def login_user(payload: LoginRequest, db: Session = Depends(get_db)):
+    """
+    Ответ всегда один и тот же — 200 и для известных, и для неизвестных номеров,
+    и при повторном запросе, и без канала доставки: по нему нельзя перебрать базу
+    клиентов. Ограничение на повторную отправку действует по номеру: для
+    неизвестного номера сохраняется код, который никуда не уходит.
+    Токен выдаёт только /login/verify.
+    """
+    sent = LoginCodeSent(
+        message="Если номер зарегистрирован, мы отправили код входа",
+        expires_in=settings.LOGIN_CODE_TTL_SECONDS,
+        resend_after=settings.LOGIN_CODE_RESEND_SECONDS,
+    )
+    now = datetime.now(timezone.utc)
+    last = (
+        db.query(LoginCode)
+        .filter(LoginCode.phone == payload.phone)
+        .order_by(LoginCode.created_at.desc())
+        .first()
+    )
+    if last and last.created_at > now - timedelta(seconds=settings.LOGIN_CODE_RESEND_SECONDS):
+        return sent
+
+    code = new_login_code()
+    client = db.query(Client).filter(Client.phone == payload.phone).first()
+    queued = notifications.enqueue_login_code(db, client, code) if client else []
+    if client and not queued:
+        if settings.DEBUG:
+            logger.warning("DEBUG: код входа для %s: %s", client.phone, code)
+        else:
+            logger.error("Код входа для клиента %s не отправлен: не настроен ни email, ни Telegram", client.id)
+    db.add(LoginCode(
+        phone=payload.phone,
+        code_hash=hash_login_code(payload.phone, code),
+        expires_at=now + timedelta(seconds=settings.LOGIN_CODE_TTL_SECONDS),
+        created_at=now,
+    ))
+    db.commit()
+    if queued:
+        notifications.worker.notify()
+    return sent
+
+
+@router.post(
+    "/login/verify",
+    response_model=LoginResponse,
+    summary="Вход, шаг 2: обменять код на токен"
+)
+def verify_login(payload: LoginVerifyRequest, db: Session = Depends(get_db)):
+    invalid = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Неверный или просроченный код",
+    )
+    now = datetime.now(timezone.utc)
+    # Действует только последний выданный код; FOR UPDATE — параллельные попытки считаются честно
+    login_code = (
+        db.query(LoginCode)
+        .filter(LoginCode.phone == payload.phone)
+        .order_by(LoginCode.created_at.desc())
+        .with_for_update()
+        .first()
+    )
+    if (
+        login_code is None
+        or login_code.used_at is not None
+        or login_code.expires_at <= now
+        or login_code.attempts >= settings.LOGIN_CODE_MAX_ATTEMPTS
+    ):
+        db.rollback()
+        raise invalid
+
+    login_code.attempts += 1
+    if not hmac.compare_digest(login_code.code_hash, hash_login_code(payload.phone, payload.code)):
+        db.commit()
+        raise invalid
+
     client = db.query(Client).filter(Client.phone == payload.phone).first()
     if not client:
+        db.rollback()
+        raise invalid
+    login_code.used_at = now
+    db.commit()
+    return LoginResponse(
+        message="Успешный вход",
+        access_token=create_access_token(client.id, client.phone),
+        expires_in=settings.ACCESS_TOKEN_EXPIRE_MINUTES * 60,
+    )
+
+
+@router.post(
+    "/operator/login",
+    response_model=LoginResponse,
+    summary="Вход оператора по логину и паролю"
+)
+def login_operator(payload: OperatorLoginRequest, db: Session = Depends(get_db)):
+    operator = db.query(Operator).filter(Operator.login == payload.login).first()
+    if not operator or not operator.is_active or not verify_password(payload.password, operator.password_hash):
         raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Клиент с таким номером не найден"
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Неверный логин или пароль",
         )
-    # Здесь можно выдавать JWT, но для простоты просто возвращаем сообщение
-    return LoginResponse(message="Успешный вход")
+    return LoginResponse(
+        message="Успешный вход",
+        access_token=create_operator_token(operator.id, operator.login),
+        expires_in=settings.OPERATOR_TOKEN_EXPIRE_MINUTES * 60,
+    )
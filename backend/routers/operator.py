@@ -1,12 +1,31 @@
-from fastapi import APIRouter, Depends, HTTPException, Query, Body
+from fastapi import APIRouter, Depends, HTTPException, Query, Body, Response, Header, Request
+from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from typing import List, Optional
+from collections import Counter
+from functools import partial
+import asyncio, base64, json
+from anyio import from_thread
+from sqlalchemy import func, select, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from ..services.db import get_db
-from ..models import Ticket, Comment, Client, Payment
+from ..services.db import get_db, get_async_db, track_queries
+from ..services.client_history import load_client_history
+from ..services import ai_log, enrichment, events, notifications, search, templates
+from ..services.ai_classifier import AIResult
+from ..services.security import get_current_operator, get_stream_operator
+from ..config import settings
+from ..models import Ticket, Comment, Template
 from pydantic import BaseModel
-from datetime import datetime
+from datetime import datetime, timedelta
+from decimal import Decimal
 
-router = APIRouter(prefix="/api/operator", tags=["operator"])
+router = APIRouter(prefix="/api/operator", tags=["operator"], dependencies=[Depends(get_current_operator)])
+# EventSource не умеет заголовки — для потока событий токен принимается и в ?access_token=
+stream_router = APIRouter(prefix="/api/operator", tags=["operator"], dependencies=[Depends(get_stream_operator)])
+
+MAX_PAGE_SIZE = 200
 
 class TicketAdmin(BaseModel):
     id: int
@@ -19,16 +38,61 @@ class TicketAdmin(BaseModel):
     created_at: datetime
     class Config: orm_mode = True
 
-@router.get("/tickets", response_model=List[TicketAdmin], summary="Список заявок (панель оператора)")
-def list_tickets(
-    category: Optional[str] = Query(None),
-    status:   Optional[str] = Query(None),
-    db: Session = Depends(get_db)
+class TicketPage(BaseModel):
+    items: List[TicketAdmin]
+    next_cursor: Optional[str] = None  # передать в ?cursor= для следующей страницы
+    total: Optional[int] = None        # только при with_total=true
+
+def _encode_cursor(ticket: Ticket) -> str:
+    raw = json.dumps([ticket.created_at.isoformat(), ticket.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor: str):
+    try:
+        created_at, ticket_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(ticket_id)
+    except Exception:
+        raise HTTPException(400, "Некорректный cursor")
+
+@router.get("/tickets", response_model=TicketPage, summary="Список заявок (панель оператора)")
+async def list_tickets(
+    category:     Optional[str] = Query(None),
+    status:       Optional[str] = Query(None),
+    assigned_to:  Optional[str] = Query(None),
+    priority:     Optional[str] = Query(None),
+    channel:      Optional[str] = Query(None),
+    created_from: Optional[datetime] = Query(None, description="Создана не раньше"),
+    created_to:   Optional[datetime] = Query(None, description="Создана раньше"),
+    cursor:       Optional[str] = Query(None, description="next_cursor предыдущей страницы"),
+    limit:        int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    with_total:   bool = Query(False, description="Посчитать общее число заявок по фильтру (дорого)"),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    q = db.query(Ticket)
-    if category: q = q.filter(Ticket.category == category)
-    if status:   q = q.filter(Ticket.status   == status)
-    return q.order_by(Ticket.created_at.desc()).all()
+    """
+    Keyset-пагинация по (created_at, id), от новых к старым.
+    Каждую страницу отдаёт индекс-скан, независимо от глубины листания.
+    """
+    q = select(Ticket)
+    if category:     q = q.where(Ticket.category    == category)
+    if status:       q = q.where(Ticket.status      == status)
+    if assigned_to:  q = q.where(Ticket.assigned_to == assigned_to)
+    if priority:     q = q.where(Ticket.priority    == priority)
+    if channel:      q = q.where(Ticket.channel     == channel)
+    if created_from: q = q.where(Ticket.created_at  >= created_from)
+    if created_to:   q = q.where(Ticket.created_at  <  created_to)
+
+    total = None
+    if with_total:
+        total = (await db.execute(select(func.count()).select_from(q.subquery()))).scalar_one()
+
+    if cursor:
+        q = q.where(tuple_(Ticket.created_at, Ticket.id) < tuple_(*_decode_cursor(cursor)))
+    q = q.order_by(Ticket.created_at.desc(), Ticket.id.desc()).limit(limit + 1)
+
+    rows = (await db.execute(q)).scalars().all()
+    items = rows[:limit]
+    next_cursor = _encode_cursor(items[-1]) if len(rows) > limit else None
+    return TicketPage(items=items, next_cursor=next_cursor, total=total)
 
 @router.patch("/tickets/{ticket_id}", response_model=TicketAdmin, summary="Обновить заявку (категория, статус, исполнитель)")
 def update_ticket(
@@ -42,6 +106,9 @@ def update_ticket(
     for field in ("category","status","assigned_to","priority"):
         if field in data:
             setattr(ticket, field, data[field])
+    if "category" in data:
+        # Категория от оператора — эталон для обучения локального классификатора
+        ticket.category_source = "operator"
     db.commit(); db.refresh(ticket)
     return ticket
 
@@ -66,16 +133,391 @@ def add_comment(ticket_id: int, payload: CommentCreate, db: Session = Depends(ge
     db.add(c); db.commit(); db.refresh(c)
     return c
 
-@router.get("/tickets/{ticket_id}/history", summary="История клиента по заявке")
-def client_history(ticket_id: int, db: Session = Depends(get_db)):
-    ticket = db.get(Ticket, ticket_id)
+class HistoryClient(BaseModel):
+    id: int
+    full_name: str
+    phone: str
+    email: str
+    tariff: Optional[str]
+    services: Optional[dict]
+    balance: Optional[Decimal]
+    debt: Optional[Decimal]
+    created_at: Optional[datetime]
+
+class HistoryPayment(BaseModel):
+    id: int
+    amount: Decimal
+    date: Optional[datetime]
+    service: Optional[str]
+    status: Optional[str]
+
+class HistoryTicket(BaseModel):
+    id: int
+    subject: Optional[str]
+    category: Optional[str]
+    status: Optional[str]
+    priority: Optional[str]
+    channel: Optional[str]
+    created_at: Optional[datetime]
+    comments_count: int
+
+class ClientHistory(BaseModel):
+    ticket_id: int
+    client: Optional[HistoryClient]  # None, если по телефону заявки клиента нет
+    payments: List[HistoryPayment]
+    tickets: List[HistoryTicket]
+
+@router.get("/tickets/{ticket_id}/history", response_model=ClientHistory, summary="История клиента по заявке")
+async def client_history(ticket_id: int, response: Response, db: AsyncSession = Depends(get_async_db)):
+    """Один запрос к БД; число запросов отдаётся в заголовке X-DB-Queries."""
+    with track_queries() as stats:
+        history = await load_client_history(db, ticket_id)
+    response.headers["X-DB-Queries"] = str(stats.count)
+    if history is None:
+        raise HTTPException(404, "Заявка не найдена")
+    return history
+
+class ReplyOut(BaseModel):
+    ai_response: str
+    source: str  # template или openai
+
+@router.post("/tickets/{ticket_id}/reply", response_model=ReplyOut, summary="Подготовить ответ по заявке")
+async def prepare_reply(
+    ticket_id: int,
+    force_ai: bool = Query(False, description="Сгенерировать ответ моделью, даже если подходит шаблон"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """Шаблон категории, если подходит, иначе модель; ответ сохраняется в заявке."""
+    ticket = await db.get(Ticket, ticket_id)
+    if not ticket:
+        raise HTTPException(404, "Заявка не найдена")
+    # Закрываем транзакцию до вызова модели, чтобы не держать соединение из пула;
+    # expire_on_commit=False — заявка остаётся загруженной, ответ уйдёт новой транзакцией
+    await db.commit()
+    ai_resp = await enrichment.reply(ticket.text, ticket.category, enrichment.ticket_fields(ticket), force_ai=force_ai)
+    ticket.ai_response = ai_resp.value
+    ai_log.add(db, ai_log.entry(
+        "generate_response",
+        ticket_id=ticket.id,
+        request_payload={"force_ai": force_ai},
+        response_payload={"response": ai_resp.value, "source": ai_resp.source},
+        cached=ai_resp.cached,
+        **ai_resp.log_fields()
+    ))
+    await db.commit()
+    return ReplyOut(ai_response=ai_resp.value, source=ai_resp.source)
+
+# ----------------------------
+# Шаблоны ответов
+# ----------------------------
+class TemplateIn(BaseModel):
+    name: str
+    category: str
+    text: str
+
+class TemplateOut(TemplateIn):
+    id: int
+    uses: int
+    last_used_at: Optional[datetime]
+    class Config: orm_mode = True
+
+def _save_template(db: Session, template: Template, payload: TemplateIn) -> Template:
+    try:
+        templates.parse_fields(payload.text)
+    except templates.TemplateError as e:
+        raise HTTPException(400, str(e))
+    template.name, template.category, template.text = payload.name, payload.category, payload.text
+    db.add(template)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(409, "Шаблон с таким именем уже есть")
+    db.refresh(template)
+    # Этот процесс видит изменение сразу, остальные — при следующей проверке
+    templates.engine.reload()
+    return template
+
+@router.get("/templates", response_model=List[TemplateOut], summary="Шаблоны ответов с числом использований")
+def list_templates(category: Optional[str] = Query(None), db: Session = Depends(get_db)):
+    q = select(Template).order_by(Template.category, Template.id)
+    if category:
+        q = q.where(Template.category == category)
+    rows = db.execute(q).scalars().all()
+    # В БД счётчики сбрасываются периодически — добавляем ещё не сброшенные
+    pending = templates.engine.pending_usage()
+    return [
+        TemplateOut(
+            id=t.id, name=t.name, category=t.category, text=t.text,
+            uses=t.uses + pending.get(t.id, (0, None))[0],
+            last_used_at=pending.get(t.id, (0, t.last_used_at))[1],
+        )
+        for t in rows
+    ]
+
+@router.post("/templates", response_model=TemplateOut, status_code=201, summary="Создать шаблон")
+def create_template(payload: TemplateIn, db: Session = Depends(get_db)):
+    return _save_template(db, Template(), payload)
+
+@router.put("/templates/{template_id}", response_model=TemplateOut, summary="Изменить шаблон")
+def update_template(template_id: int, payload: TemplateIn, db: Session = Depends(get_db)):
+    template = db.get(Template, template_id)
+    if not template:
+        raise HTTPException(404, "Шаблон не найден")
+    return _save_template(db, template, payload)
+
+@router.delete("/templates/{template_id}", status_code=204, summary="Удалить шаблон")
+def delete_template(template_id: int, db: Session = Depends(get_db)):
+    template = db.get(Template, template_id)
+    if not template:
+        raise HTTPException(404, "Шаблон не найден")
+    db.delete(template); db.commit()
+    templates.engine.reload()
+    return Response(status_code=204)
+
+@router.post("/templates/reload", summary="Перечитать шаблоны сейчас")
+def reload_templates():
+    templates.engine.reload(force=True)
+    return templates.engine.stats()
+
+# ----------------------------
+# Поиск, похожие заявки и инциденты
+# ----------------------------
+class SearchHit(BaseModel):
+    ticket: TicketAdmin
+    rank: float
+    snippet: str
+
+class SimilarTicket(BaseModel):
+    ticket: TicketAdmin
+    score: float
+
+class SimilarTickets(BaseModel):
+    source: str  # vector или fts
+    items: List[SimilarTicket]
+
+class Incident(BaseModel):
+    lead: TicketAdmin  # самая «центральная» заявка группы
+    size: int
+    ticket_ids: List[int]
+    first_at: Optional[datetime]
+    last_at: Optional[datetime]
+
+class IncidentRespond(BaseModel):
+    ticket_ids: List[int]
+    text: Optional[str] = None    # готовый ответ оператора; без него — шаблон или AI
+    force_ai: bool = False
+    status: Optional[str] = None  # например in_progress
+
+MAX_INCIDENT_TICKETS = 1000
+
+@router.get("/tickets/search", response_model=List[SearchHit], summary="Полнотекстовый поиск по заявкам")
+async def search_tickets(
+    q:        str = Query(..., min_length=2, description="Слова, «фраза в кавычках», OR, -исключить"),
+    category: Optional[str] = Query(None),
+    status:   Optional[str] = Query(None),
+    limit:    int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_db)
+):
+    hits = await search.full_text(db, q, limit, category=category, status=status)
+    return [{"ticket": t, "rank": rank, "snippet": snippet} for t, rank, snippet in hits]
+
+@router.get("/tickets/{ticket_id}/similar", response_model=SimilarTickets, summary="Похожие заявки")
+async def similar_tickets(
+    ticket_id: int,
+    limit:     int = Query(10, ge=1, le=100),
+    min_score: float = Query(0.3, ge=0, le=1, description="Минимальное сходство (только для векторного поиска)"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    ticket = await db.get(Ticket, ticket_id)
     if not ticket:
         raise HTTPException(404, "Заявка не найдена")
-    client = db.query(Client).filter(Client.phone == ticket.client_phone).first()
-    payments = db.query(Payment).filter(Payment.client_id == client.id).order_by(Payment.date.desc()).limit(10).all()
-    tickets  = db.query(Ticket).filter(Ticket.client_phone == ticket.client_phone).order_by(Ticket.created_at.desc()).limit(10).all()
+    if not search.index.ready:
+        items = await search.similar_full_text(db, ticket, limit)
+        return {"source": "fts", "items": [{"ticket": t, "score": score} for t, score in items]}
+
+    vector = search.index.vectors_for([ticket.id]).get(ticket.id)
+    if vector is None:
+        vector = search.embed(f"{ticket.subject or ''} {ticket.text}")
+    found = search.index.search(vector, limit, exclude=[ticket.id], min_score=min_score)
+    rows = {t.id: t for t in (await db.execute(
+        select(Ticket).where(Ticket.id.in_([i for i, _ in found]))
+    )).scalars()}
+    return {"source": "vector", "items": [
+        {"ticket": rows[i], "score": round(score, 4)} for i, score in found if i in rows
+    ]}
+
+@router.get("/incidents", response_model=List[Incident], summary="Группы похожих открытых заявок")
+async def list_incidents(
+    hours:     int = Query(24, ge=1, le=168, description="За сколько последних часов"),
+    category:  Optional[str] = Query(None),
+    min_size:  int = Query(3, ge=2, description="Минимум заявок в группе"),
+    threshold: Optional[float] = Query(None, ge=0, le=1, description="Сходство внутри группы"),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Открытые заявки за окно времени, сгруппированные по сходству текста:
+    массовая авария — одна группа, на которую можно ответить разом (/incidents/respond).
+    """
+    if search.np is None:
+        raise HTTPException(503, "Группировка недоступна: не установлен numpy")
+    q = (
+        select(Ticket)
+        .where(Ticket.created_at >= func.now() - timedelta(hours=hours))
+        .where(Ticket.status != "closed")
+    )
+    if category:
+        q = q.where(Ticket.category == category)
+    rows = (await db.execute(
+        q.order_by(Ticket.created_at.desc(), Ticket.id.desc()).limit(settings.SEARCH_CLUSTER_MAX_TICKETS)
+    )).scalars().all()
+    if not rows:
+        return []
+
+    vectors = await run_in_threadpool(search.vectors_for_rows, rows)
+    clusters = await run_in_threadpool(
+        search.cluster, [t.id for t in rows], vectors,
+        threshold if threshold is not None else settings.SEARCH_CLUSTER_THRESHOLD, min_size,
+    )
+    by_id = {t.id: t for t in rows}
+    incidents = []
+    for ids in clusters:
+        moments = [by_id[i].created_at for i in ids if by_id[i].created_at]
+        incidents.append({
+            "lead": by_id[ids[0]],
+            "size": len(ids),
+            "ticket_ids": sorted(ids),
+            "first_at": min(moments, default=None),
+            "last_at": max(moments, default=None),
+        })
+    return sorted(incidents, key=lambda i: -i["size"])
+
+@router.post("/incidents/respond", summary="Ответить группе заявок одним действием")
+def respond_incident(payload: IncidentRespond, db: Session = Depends(get_db)):
+    """
+    Первая заявка в ticket_ids — ведущая: по её тексту генерируется ответ, если шаблон
+    категории не подошёл. Модель вызывается не больше одного раза на всю группу.
+    Заявки, ещё ждущие AI-обогащения, считаются обработанными этим ответом.
+    """
+    if not payload.ticket_ids or len(payload.ticket_ids) > MAX_INCIDENT_TICKETS:
+        raise HTTPException(400, f"ticket_ids: от 1 до {MAX_INCIDENT_TICKETS} заявок")
+
+    def load():
+        found = {t.id: t for t in db.execute(select(Ticket).where(Ticket.id.in_(payload.ticket_ids))).scalars()}
+        return found, [found[i] for i in dict.fromkeys(payload.ticket_ids) if i in found]
+
+    found, tickets = load()
+    if not tickets:
+        raise HTTPException(404, "Заявки не найдены")
+    lead = tickets[0]
+
+    if payload.text:
+        replies = [AIResult(payload.text, source="operator")] * len(tickets)
+    else:
+        lead_id, lead_text = lead.id, lead.text
+        ticket_ids = [t.id for t in tickets]
+        groups = [(t.category or lead.category, enrichment.ticket_fields(t)) for t in tickets]
+        # Не держим транзакцию и соединение из пула, пока ждём модель;
+        # после ответа заявки перечитываются — их могли изменить или удалить
+        db.commit()
+        replies = from_thread.run(partial(
+            enrichment.group_replies, lead_text, groups, force_ai=payload.force_ai,
+        ))
+        found, tickets = load()
+        replies = [reply for i, reply in zip(ticket_ids, replies) if i in found]
+        if not tickets:
+            raise HTTPException(404, "Заявки не найдены")
+        lead = found.get(lead_id, tickets[0])
+
+    queued, logged = [], set()
+    for ticket, reply in zip(tickets, replies):
+        ticket.ai_response = reply.value
+        if payload.status:
+            ticket.status = payload.status
+        if ticket.enrichment_status != "done":
+            ticket.category = ticket.category or lead.category
+            ticket.enrichment_status = "done"
+        if reply.source != "operator":
+            # Стоимость общего AI-ответа пишем один раз, у остальных заявок — только текст
+            fields = reply.log_fields() if id(reply) not in logged else AIResult(reply.value).log_fields()
+            logged.add(id(reply))
+            ai_log.add(db, ai_log.entry(
+                "generate_response",
+                ticket_id=ticket.id,
+                request_payload={"incident_lead": lead.id},
+                response_payload={"response": reply.value, "source": reply.source},
+                cached=reply.cached,
+                **fields
+            ))
+        queued += notifications.enqueue_ticket_reply(db, ticket, reply.value)
+    db.commit()
+    if queued:
+        notifications.worker.notify()
+
     return {
-        "client": client,
-        "payments": payments,
-        "tickets": tickets
+        "updated": len(tickets),
+        "not_found": [i for i in payload.ticket_ids if i not in found],
+        "sources": dict(Counter(r.source for r in replies)),
+        "notifications": len(queued),
+    }
+
+def _sse_event(cursor: Optional[str], event: events.Event) -> str:
+    data = {"ticket_id": event.ticket_id, **event.data, "ts": event.ts}
+    prefix = f"id: {cursor}\n" if cursor else ""
+    return f"{prefix}event: {event.type}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+@stream_router.get("/events", summary="Поток изменений заявок и комментариев (Server-Sent Events)")
+async def stream_events(
+    request: Request,
+    category:     Optional[str] = Query(None),
+    status:       Optional[str] = Query(None),
+    assigned_to:  Optional[str] = Query(None),
+    priority:     Optional[str] = Query(None),
+    channel:      Optional[str] = Query(None),
+    ticket_id:    Optional[int] = Query(None, description="Только одна заявка (карточка заявки)"),
+    types:        Optional[str] = Query(None, description="Через запятую: ticket.created,ticket.updated,comment.created; reset приходит всегда"),
+    last_event_id: Optional[str] = Query(None, description="Курсор, если клиент не умеет слать заголовок Last-Event-ID"),
+    last_event_id_header: Optional[str] = Header(None, alias="Last-Event-ID"),
+):
+    """
+    Заменяет периодический опрос /tickets. Фильтры — как у списка заявок; событие
+    приходит и когда заявка выходит из фильтра (в changes старое значение).
+    В событиях только поля для фильтрации и changes {поле: [было, стало]}, без текста заявки.
+    При переподключении браузер сам присылает Last-Event-ID и получает пропущенное;
+    `event: reset` значит, что пропущенное не восстановить — перечитайте список.
+    """
+    values = {
+        name: value
+        for name, value in (("category", category), ("status", status), ("assigned_to", assigned_to),
+                            ("priority", priority), ("channel", channel))
+        if value is not None
     }
+    filters = events.Filters(
+        types={t.strip() for t in types.split(",") if t.strip()} if types else None,
+        ticket_id=ticket_id,
+        values=values,
+    )
+    sub = events.broker.subscribe(filters, last_event_id_header or last_event_id)
+
+    async def stream():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(sub.queue.get(), timeout=settings.EVENTS_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    if sub.overflowed:
+                        break
+                    yield ": ping\n\n"
+                    continue
+                yield _sse_event(events.broker.cursor(event) if event.id else None, event)
+                if sub.overflowed and sub.queue.empty():
+                    # Не успеваем отдавать — закрываем, клиент догонит по Last-Event-ID
+                    break
+        finally:
+            events.broker.unsubscribe(sub)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,20 +1,25 @@
 # backend/routers/payments.py
 
-from fastapi import APIRouter, Depends, Query, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query
+from sqlalchemy import select, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
 from typing import List, Optional
-from datetime import datetime
+from datetime import date, datetime, timezone
 from decimal import Decimal
+import base64, json
 
-from ..services.db import get_db
-from ..models import Client, Payment
+from ..services.db import get_async_db
+from ..services.security import CurrentClient, get_current_client
+from ..models import Payment, PaymentMonthly, PaymentSummary
 
 router = APIRouter(
     prefix="/api/payments",
     tags=["payments"],
 )
 
+MAX_PAGE_SIZE = 200
+
 class PaymentResponse(BaseModel):
     id: int
     amount: Decimal
@@ -25,25 +30,126 @@ class PaymentResponse(BaseModel):
     class Config:
         orm_mode = True
 
+class PaymentPage(BaseModel):
+    items: List[PaymentResponse]
+    next_cursor: Optional[str] = None  # передать в ?cursor= для следующей страницы
+
+class MonthTotal(BaseModel):
+    month: date
+    amount: Decimal     # только проведённые (completed)
+    payments: int
+    pending: int
+    failed: int
+
+class ServiceTotal(BaseModel):
+    service: Optional[str]
+    amount: Decimal     # только проведённые (completed)
+    payments: int
+
+class PaymentSummaryResponse(BaseModel):
+    payments: int
+    completed_amount: Decimal
+    pending: int
+    failed: int
+    last_payment: Optional[PaymentResponse]
+    months: List[MonthTotal]        # от новых к старым
+    services: List[ServiceTotal]    # за всё время, по убыванию суммы
+
+def _encode_cursor(payment: Payment) -> str:
+    raw = json.dumps([payment.date.isoformat(), payment.id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor: str):
+    try:
+        paid_at, payment_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(paid_at), int(payment_id)
+    except Exception:
+        raise HTTPException(400, "Некорректный cursor")
+
 @router.get(
     "",
-    response_model=List[PaymentResponse],
-    summary="История платежей клиента"
+    response_model=PaymentPage,
+    summary="История платежей клиента (постранично)"
 )
-def list_payments(
-    client_phone: str = Query(..., description="Номер телефона клиента"),
-    db: Session = Depends(get_db)
+async def list_payments(
+    status:  Optional[str] = Query(None, description="completed, pending, failed..."),
+    service: Optional[str] = Query(None),
+    cursor:  Optional[str] = Query(None, description="next_cursor предыдущей страницы"),
+    limit:   int = Query(50, ge=1, le=MAX_PAGE_SIZE),
+    current: CurrentClient = Depends(get_current_client),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    client = db.query(Client).filter(Client.phone == client_phone).first()
-    if not client:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Клиент не найден"
-        )
-    payments = (
-        db.query(Payment)
-        .filter(Payment.client_id == client.id)
-        .order_by(Payment.date.desc())
-        .all()
-    )
-    return payments
+    """
+    Keyset-пагинация по (date, id), от новых к старым, по индексу (client_id, date, id).
+    Итоги по месяцам и услугам — в /api/payments/summary, считать их по страницам не нужно.
+    """
+    # id клиента берём из токена — отдельный запрос Client не нужен
+    q = select(Payment).where(Payment.client_id == current.id)
+    if status:  q = q.where(Payment.status  == status)
+    if service: q = q.where(Payment.service == service)
+    if cursor:
+        q = q.where(tuple_(Payment.date, Payment.id) < tuple_(*_decode_cursor(cursor)))
+    q = q.order_by(Payment.date.desc(), Payment.id.desc()).limit(limit + 1)
+
+    rows = (await db.execute(q)).scalars().all()
+    items = rows[:limit]
+    return {"items": items, "next_cursor": _encode_cursor(items[-1]) if len(rows) > limit else None}
+
+@router.get(
+    "/summary",
+    response_model=PaymentSummaryResponse,
+    summary="Итоги платежей клиента по месяцам и услугам"
+)
+async def payment_summary(
+    months: int = Query(12, ge=1, le=120, description="Сколько последних месяцев вернуть"),
+    current: CurrentClient = Depends(get_current_client),
+    db: AsyncSession = Depends(get_async_db)
+):
+    """
+    Читается из свёрток payment_summary и payment_monthly, которые триггеры обновляют
+    при каждой записи в payments, — сами платежи не агрегируются. Два запроса
+    независимо от длины истории: у клиента не больше строк свёртки, чем
+    месяцев × услуг × статусов.
+    """
+    summary, last = (await db.execute(
+        select(PaymentSummary, Payment)
+        .outerjoin(Payment, Payment.id == PaymentSummary.last_payment_id)
+        .where(PaymentSummary.client_id == current.id)
+    )).one_or_none() or (None, None)
+    rows = (await db.execute(
+        select(PaymentMonthly).where(PaymentMonthly.client_id == current.id)
+    )).scalars().all()
+
+    # Последние `months` календарных месяцев, включая текущий (UTC, как в свёртке)
+    today = datetime.now(timezone.utc).date()
+    index = today.year * 12 + today.month - months
+    since = date(index // 12, index % 12 + 1, 1)
+
+    by_month, by_service = {}, {}
+    for row in rows:
+        completed = row.status == "completed"
+        if row.month >= since:
+            month = by_month.setdefault(row.month, {
+                "month": row.month, "amount": Decimal(0), "payments": 0, "pending": 0, "failed": 0,
+            })
+            month["payments"] += row.payments
+            if completed:
+                month["amount"] += row.amount
+            elif row.status in ("pending", "failed"):
+                month[row.status] += row.payments
+        service = by_service.setdefault(row.service, {
+            "service": row.service or None, "amount": Decimal(0), "payments": 0,
+        })
+        service["payments"] += row.payments
+        if completed:
+            service["amount"] += row.amount
+
+    return {
+        "payments": summary.payments if summary else 0,
+        "completed_amount": summary.completed_amount if summary else Decimal(0),
+        "pending": summary.pending if summary else 0,
+        "failed": summary.failed if summary else 0,
+        "last_payment": last,
+        "months": sorted(by_month.values(), key=lambda m: m["month"], reverse=True),
+        "services": sorted(by_service.values(), key=lambda s: s["amount"], reverse=True),
+    }
@@ -0,0 +1,67 @@
+# backend/routers/telegram.py
+
+import hmac
+from typing import Optional
+
+from fastapi import APIRouter, Body, Depends, Header, HTTPException, status
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..services.db import get_db
+from ..services import notifications
+from ..services.security import verify_telegram_link_token
+from ..models import Client
+
+router = APIRouter(
+    prefix="/api/telegram",
+    tags=["telegram"],
+)
+
+@router.post(
+    "/webhook",
+    summary="Вебхук Telegram-бота: привязка чата к клиенту"
+)
+def telegram_webhook(
+    update: dict = Body(...),
+    secret: Optional[str] = Header(None, alias="X-Telegram-Bot-Api-Secret-Token"),
+    db: Session = Depends(get_db)
+):
+    """
+    Регистрируется через setWebhook с secret_token = APP_TELEGRAM_WEBHOOK_SECRET.
+    /start <токен> из ссылки POST /api/users/me/telegram привязывает чат к клиенту,
+    /stop отвязывает. Остальные сообщения игнорируются; Telegram всегда получает 200,
+    иначе будет повторять тот же update.
+    """
+    if not settings.TELEGRAM_WEBHOOK_SECRET or not hmac.compare_digest(secret or "", settings.TELEGRAM_WEBHOOK_SECRET):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Неверный secret_token")
+
+    message = update.get("message") or {}
+    chat_id = (message.get("chat") or {}).get("id")
+    command, _, argument = (message.get("text") or "").strip().partition(" ")
+    if chat_id is None:
+        return {"ok": True}
+    chat_id = str(chat_id)
+
+    if command == "/start" and argument:
+        client_id = verify_telegram_link_token(argument.strip())
+        client = db.get(Client, client_id) if client_id else None
+        if client is None:
+            reply = "Ссылка устарела. Получите новую в личном кабинете."
+        else:
+            # Один чат — один клиент: снимаем привязку с прежнего владельца
+            for other in db.query(Client).filter(Client.telegram_chat_id == chat_id, Client.id != client.id):
+                other.telegram_chat_id = None
+            client.telegram_chat_id = chat_id
+            reply = "Готово: ответы по заявкам будут приходить сюда. /stop — отключить."
+    elif command == "/stop":
+        for client in db.query(Client).filter(Client.telegram_chat_id == chat_id):
+            client.telegram_chat_id = None
+        reply = "Уведомления в Telegram отключены."
+    else:
+        return {"ok": True}
+
+    queued = notifications.enqueue_telegram(db, chat_id, reply)
+    db.commit()
+    if queued:
+        notifications.worker.notify()
+    return {"ok": True}
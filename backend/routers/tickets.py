@@ -1,12 +1,19 @@
 from typing import List, Optional
 from datetime import datetime
-from fastapi import APIRouter, Depends, HTTPException, status, Body, BackgroundTasks
+import json
+from functools import partial
+from anyio import from_thread
+from fastapi import APIRouter, Depends, HTTPException, status, Body, BackgroundTasks, Query
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-import smtplib, email
-from ..services.db import get_db
-from ..services import ai_classifier
-from ..models import Ticket, AILog
+from ..services.db import get_db, get_async_db, SessionLocal
+from ..services import ai_classifier, ai_log, enrichment, events, notifications, templates
+from ..services.security import CurrentClient, get_current_client, get_current_operator, get_optional_client
+from ..models import Ticket
 from ..config import settings
 router = APIRouter(
     prefix="/api/tickets",
@@ -18,13 +25,30 @@ router = APIRouter(
 # ----------------------------
 class TicketCreate(BaseModel):
     client_id: Optional[int] = Field(None, example=1)  # Assuming client_id is an integer
-    client_phone: str = Field(..., example="+71234567890")
+    # Для авторизованного клиента берётся из токена
+    client_phone: Optional[str] = Field(None, example="+71234567890")
     subject: Optional[str] = Field(None, example="Проблема с интернетом")
     text: str = Field(..., example="Нет доступа к Wi-Fi с 10 утра")
     channel: Optional[str] = Field("web", example="web")
 
 
 
+MAX_BATCH_ITEMS = 5000
+
+
+class TicketBatchItem(TicketCreate):
+    # Пакет импортирует оператор — токена клиента нет, телефон обязателен
+    client_phone: str = Field(..., example="+71234567890")
+
+
+class TicketBatchCreate(BaseModel):
+    tickets: List[TicketBatchItem] = Field(..., max_length=MAX_BATCH_ITEMS)
+
+
+class TicketReclassify(BaseModel):
+    ticket_ids: List[int] = Field(..., max_length=MAX_BATCH_ITEMS, example=[1, 2, 3])
+
+
 class TicketResponse(BaseModel):
     id: int
     client_phone: str
@@ -32,12 +56,23 @@ class TicketResponse(BaseModel):
     category: Optional[str]
     status: str
     channel: str
+    enrichment_status: str
     created_at: datetime
 
     class Config:
         orm_mode = True
 
 
+class EnrichmentStatus(BaseModel):
+    id: int
+    enrichment_status: str
+    category: Optional[str]
+    ai_response: Optional[str]
+
+    class Config:
+        orm_mode = True
+
+
 class TicketDetail(TicketResponse):
     text: str
     priority: str
@@ -48,6 +83,14 @@ class TicketDetail(TicketResponse):
         orm_mode = True
 
 
+def _get_own_ticket(db: Session, ticket_id: int, current: CurrentClient) -> Ticket:
+    ticket = db.get(Ticket, ticket_id)
+    # Чужую заявку не раскрываем: для клиента её просто нет
+    if not ticket or (ticket.client_id != current.id and ticket.client_phone != current.phone):
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ticket not found")
+    return ticket
+
+
 # ----------------------------
 # Эндпоинты
 # ----------------------------
@@ -61,73 +104,256 @@ class TicketDetail(TicketResponse):
 def create_ticket(
     payload: TicketCreate,
     background_tasks: BackgroundTasks,
+    async_enrichment: Optional[bool] = Query(
+        None,
+        description="Вернуть заявку сразу, а AI-обработку выполнить в фоне "
+                    "(по умолчанию — TICKET_INTAKE_MODE)"
+    ),
+    current: Optional[CurrentClient] = Depends(get_optional_client),
     db: Session = Depends(get_db)
 ):
-    # Classification
-    category = ai_classifier.classify_text(payload.text)
-    
-    # Create ticket
+    if async_enrichment is None:
+        async_enrichment = settings.TICKET_INTAKE_MODE == "async"
+
+    # Незарегистрированные клиенты пишут без токена, указывая телефон в теле
+    if current is not None:
+        client_id, client_phone = current.id, current.phone
+    elif payload.client_phone:
+        client_id, client_phone = None, payload.client_phone
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="client_phone is required for anonymous tickets"
+        )
+
     ticket = Ticket(
-        client_phone=payload.client_phone,
+        client_id=client_id,
+        client_phone=client_phone,
         subject=payload.subject,
         text=payload.text,
         channel=payload.channel,
-        category=category,
-        status="new"
+        status="new",
+        enrichment_status="pending" if async_enrichment else "processing",
     )
+
+    if async_enrichment:
+        # Сохраняем заявку и отдаём 201, классификацию и ответ сделает воркер
+        db.add(ticket)
+        db.commit()
+        db.refresh(ticket)
+        enrichment.worker.notify()
+        return ticket
+
+    # Синхронный режим: заявка сохраняется сразу в processing и коммитится — она
+    # видна поиску дублей в порядке id, а соединение из пула не простаивает, пока
+    # ждём модель. updated_at нужен для lease: если процесс упадёт посреди вызова,
+    # заявку заберёт воркер. Результат модели записывается вторым коммитом
+    ticket.updated_at = func.now()
     db.add(ticket)
     db.commit()
     db.refresh(ticket)
-
-    # Generate AI response
-    ai_resp = ai_classifier.generate_response(payload.text)
-    ticket.ai_response = ai_resp
-    db.commit()
-
-    # Log both actions
-    ai_log_classify = AILog(
-        ticket_id=ticket.id,
-        action="classify",
-        request_payload={"text": payload.text},
-        response_payload={"category": category},
-        confidence=None
-    )
-    
-    ai_log_response = AILog(
-        ticket_id=ticket.id,
-        action="generate_response",
-        request_payload={"text": payload.text},
-        response_payload={"response": ai_resp},
-        confidence=None
-    )
-    
-    db.add_all([ai_log_classify, ai_log_response])
+    fields = enrichment.ticket_fields(ticket)
     db.commit()
+    try:
+        category = from_thread.run(enrichment.duplicate_category, payload.text)
+        if category is None and not templates.engine.active():
+            # Ни дубля, ни шаблонов — классификация и ответ идут параллельно
+            category, ai_resp = from_thread.run(
+                partial(ai_classifier.classify_and_respond, payload.text, phone=client_phone)
+            )
+        else:
+            # Сначала категория, затем шаблон (ему нужен id заявки) или модель
+            if category is None:
+                category = from_thread.run(partial(ai_classifier.classify_text, payload.text, phone=client_phone))
+            ai_resp = from_thread.run(partial(
+                enrichment.reply, payload.text, category.value, fields, phone=client_phone,
+            ))
+    except HTTPException:
+        # Лимит AI исчерпан (429) или модель недоступна (503) — заявку не теряем:
+        # категория и ответ-шаблон, если их можно получить без модели,
+        # а полное обогащение делает фоновый воркер
+        enrichment.apply_degraded(db, ticket)
+        db.commit()
+        db.refresh(ticket)
+        enrichment.worker.notify()
+        return ticket
+    db.refresh(ticket)
+    # Модель отвечала дольше lease — заявку уже забрал воркер, его результат не затираем
+    if ticket.enrichment_status == "processing":
+        enrichment.apply_enrichment(db, ticket, category, ai_resp)
+        db.commit()
+        db.refresh(ticket)
 
     return ticket
 
 
+def _batch_line(index: int, result, ticket_id: Optional[int] = None, pending: bool = False) -> str:
+    """Одна строка NDJSON-ответа пакетных эндпоинтов."""
+    if isinstance(result, Exception):
+        item = {"index": index, "ticket_id": ticket_id, "error": getattr(result, "detail", str(result))}
+        if pending:
+            # Заявка сохранена без категории, её классифицирует фоновый воркер
+            item["enrichment_status"] = "pending"
+    else:
+        item = {
+            "index": index,
+            "ticket_id": ticket_id,
+            "category": result.value,
+            "source": result.source,
+            "cached": result.cached,
+        }
+    return json.dumps(item, ensure_ascii=False) + "\n"
+
+
+def _classify_logs(items, ticket_ids) -> List[dict]:
+    return [
+        ai_log.entry(
+            "classify",
+            ticket_id=ticket_ids[i],
+            response_payload={"category": r.value, "source": r.source, "batch": True},
+            confidence=r.confidence,
+            cached=r.cached,
+            **r.log_fields(),
+        )
+        for i, r in items
+    ]
+
+
+def _insert_group(tickets: List[TicketBatchItem], items) -> List[int]:
+    """
+    Вставляет группу заявок одним multi-row INSERT; AILog уйдут в фоновую запись после коммита.
+    Пункты с ошибкой классификации сохраняются без категории в очередь воркера (pending).
+    """
+    with SessionLocal() as db:
+        ids = db.execute(
+            insert(Ticket).returning(Ticket.id, sort_by_parameter_order=True),
+            [
+                {
+                    "client_id": tickets[i].client_id,
+                    "client_phone": tickets[i].client_phone,
+                    "subject": tickets[i].subject,
+                    "text": tickets[i].text,
+                    "channel": tickets[i].channel,
+                    **_group_fields(r),
+                    "status": "new",
+                }
+                for i, r in items
+            ],
+        ).scalars().all()
+        ticket_ids = {i: ticket_id for (i, _), ticket_id in zip(items, ids)}
+        ok, _ = _split_errors(items)
+        ai_log.add(db, *_classify_logs(ok, ticket_ids))
+        # Core-вставка мимо ORM — события для операторов добавляем сами
+        for i, r in items:
+            events.add(
+                db, "ticket.created", ticket_ids[i], category=_group_fields(r)["category"], status="new",
+                assigned_to=None, priority="normal", channel=tickets[i].channel,
+            )
+        db.commit()
+        return [ticket_ids[i] for i, _ in items]
+
+
+def _group_fields(result) -> dict:
+    if isinstance(result, Exception):
+        return {"category": None, "category_source": None, "enrichment_status": "pending"}
+    return {"category": result.value, "category_source": result.source, "enrichment_status": "done"}
+
+
+def _update_classified(ticket_ids: List[int], items) -> None:
+    """Массово обновляет категории группы заявок; AILog уйдут в фоновую запись после коммита."""
+    with SessionLocal() as db:
+        db.execute(update(Ticket), [{"id": ticket_ids[i], "category": r.value, "category_source": r.source} for i, r in items])
+        ai_log.add(db, *_classify_logs(items, ticket_ids))
+        for i, r in items:
+            events.add(db, "ticket.updated", ticket_ids[i], changed=["category"], category=r.value)
+        db.commit()
+
+
+def _split_errors(group):
+    ok = [(i, r) for i, r in group if not isinstance(r, Exception)]
+    failed = [(i, r) for i, r in group if isinstance(r, Exception)]
+    return ok, failed
+
+
+@router.post(
+    "/batch",
+    dependencies=[Depends(get_current_operator)],
+    summary="Массовый импорт заявок с пакетной AI-классификацией (NDJSON-поток)"
+)
+async def create_tickets_batch(payload: TicketBatchCreate):
+    tickets = payload.tickets
+
+    async def stream():
+        async for group in ai_classifier.classify_batch([t.text for t in tickets]):
+            ids = await run_in_threadpool(_insert_group, tickets, group)
+            for (i, result), ticket_id in zip(group, ids):
+                yield _batch_line(i, result, ticket_id, pending=True)
+            if any(isinstance(result, Exception) for _, result in group):
+                enrichment.worker.notify()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@router.post(
+    "/reclassify",
+    dependencies=[Depends(get_current_operator)],
+    summary="Пакетная переклассификация существующих заявок (NDJSON-поток)"
+)
+async def reclassify_tickets(payload: TicketReclassify):
+    def load():
+        with SessionLocal() as db:
+            return db.execute(
+                select(Ticket.id, Ticket.text).where(Ticket.id.in_(payload.ticket_ids))
+            ).all()
+
+    rows = await run_in_threadpool(load)
+    ticket_ids = [row.id for row in rows]
+    texts = [row.text for row in rows]
+    missing = set(payload.ticket_ids) - set(ticket_ids)
+
+    async def stream():
+        for ticket_id in missing:
+            yield json.dumps({"ticket_id": ticket_id, "error": "Ticket not found"}, ensure_ascii=False) + "\n"
+        async for group in ai_classifier.classify_batch(texts):
+            ok, failed = _split_errors(group)
+            if ok:
+                await run_in_threadpool(_update_classified, ticket_ids, ok)
+            for i, result in group:
+                yield _batch_line(i, result, ticket_ids[i])
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+@router.get(
+    "/{ticket_id}/enrichment",
+    response_model=EnrichmentStatus,
+    summary="Статус AI-обработки заявки"
+)
+def get_enrichment_status(
+    ticket_id: int,
+    current: CurrentClient = Depends(get_current_client),
+    db: Session = Depends(get_db)
+):
+    return _get_own_ticket(db, ticket_id, current)
+
+
 
 @router.get(
     "",
     response_model=List[TicketResponse],
-    summary="Список заявок по номеру телефона"
+    summary="Список заявок текущего клиента"
 )
-def list_tickets(
-    client_phone: Optional[str] = None,
-    db: Session = Depends(get_db)
+async def list_tickets(
+    current: CurrentClient = Depends(get_current_client),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    if not client_phone:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="Query parameter 'client_phone' is required"
-        )
     records = (
-        db.query(Ticket)
-        .filter(Ticket.client_phone == client_phone)
-        .order_by(Ticket.created_at.desc())
-        .all()
-    )
+        await db.execute(
+            select(Ticket)
+            .where(Ticket.client_phone == current.phone)
+            .order_by(Ticket.created_at.desc())
+        )
+    ).scalars().all()
     return records
 
 
@@ -138,15 +364,10 @@ def list_tickets(
 )
 def get_ticket(
     ticket_id: int,
+    current: CurrentClient = Depends(get_current_client),
     db: Session = Depends(get_db)
 ):
-    ticket = db.get(Ticket, ticket_id)
-    if not ticket:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Ticket not found"
-        )
-    return ticket
+    return _get_own_ticket(db, ticket_id, current)
 
 
 @router.patch(
@@ -157,11 +378,10 @@ def get_ticket(
 def update_status(
     ticket_id: int,
     data: dict = Body(..., example={"status": "in_progress"}),
+    current: CurrentClient = Depends(get_current_client),
     db: Session = Depends(get_db)
 ):
-    ticket = db.get(Ticket, ticket_id)
-    if not ticket:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ticket not found")
+    ticket = _get_own_ticket(db, ticket_id, current)
 
     ticket.status = data.get("status", ticket.status)
     db.commit()
@@ -175,56 +395,59 @@ def update_status(
 )
 def generate_response(
     ticket_id: int,
+    force_ai: bool = Query(False, description="Сгенерировать ответ моделью, даже если подходит шаблон"),
+    current: CurrentClient = Depends(get_current_client),
     db: Session = Depends(get_db)
 ):
-    ticket = db.get(Ticket, ticket_id)
-    if not ticket:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Ticket not found")
+    ticket = _get_own_ticket(db, ticket_id, current)
+    ticket_text, category, fields = ticket.text, ticket.category, enrichment.ticket_fields(ticket)
+    # Не держим транзакцию и соединение, пока ждём модель
+    db.commit()
 
-    ai_resp = ai_classifier.generate_response(ticket.text)
+    ai_resp = from_thread.run(partial(
+        enrichment.reply, ticket_text, category, fields, phone=current.phone, force_ai=force_ai,
+    ))
 
-    ticket.ai_response = ai_resp
-    db.commit()
+    ticket.ai_response = ai_resp.value
 
-    ai_log = AILog(
+    ai_log.add(db, ai_log.entry(
+        "generate_response",
         ticket_id=ticket.id,
-        action="generate_response",
-        request_payload={"text": ticket.text},
-        response_payload={"response": ai_resp},
-        confidence=None
-    )
-    db.add(ai_log)
+        response_payload={"response": ai_resp.value, "source": ai_resp.source},
+        cached=ai_resp.cached,
+        **ai_resp.log_fields()
+    ))
     db.commit()
 
-    return {"ai_response": ai_resp}
+    return {"ai_response": ai_resp.value, "source": ai_resp.source}
 
 @router.post("/{ticket_id}/send_response", summary="Сгенерировать + отправить ответ")
 def respond_and_notify(
     ticket_id: int,
-    background_tasks: BackgroundTasks,
+    force_ai: bool = Query(False, description="Сгенерировать ответ моделью, даже если подходит шаблон"),
+    current: CurrentClient = Depends(get_current_client),
     db: Session = Depends(get_db)
 ):
-    ticket = db.get(Ticket, ticket_id)
-    if not ticket:
-        raise HTTPException(404, "Заявка не найдена")
-
-    # 1) Генерим AI-ответ
-    answer = ai_classifier.generate_response(ticket.text)
-    ticket.ai_response = answer
+    ticket = _get_own_ticket(db, ticket_id, current)
+    ticket_text, category, fields = ticket.text, ticket.category, enrichment.ticket_fields(ticket)
+    # Не держим транзакцию и соединение, пока ждём модель
     db.commit()
 
-    # 2) Отправляем email в фоне
-    def send_mail(to_address: str, subject: str, body: str):
-        msg = email.message.EmailMessage()
-        msg["From"] = settings.EMAIL_USER
-        msg["To"]   = to_address
-        msg["Subject"] = f"Ответ по заявке #{ticket.id}"
-        msg.set_content(body)
-        with smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT) as smtp:
-            smtp.starttls()
-            smtp.login(settings.EMAIL_USER, settings.EMAIL_PASSWORD)
-            smtp.send_message(msg)
-
-    background_tasks.add_task(send_mail, ticket.client.email, f"Ответ на заявку #{ticket.id}", answer)
-    return {"ai_response": answer, "message": "Ответ сгенерирован и отправляется клиенту"}
+    # 1) Ответ: шаблон категории или AI
+    answer = from_thread.run(partial(
+        enrichment.reply, ticket_text, category, fields, phone=current.phone, force_ai=force_ai,
+    )).value
+    ticket.ai_response = answer
 
+    # 2) Ставим уведомления в outbox той же транзакцией — отправит воркер
+    queued = notifications.enqueue_ticket_reply(db, ticket, answer)
+    db.commit()
+    if queued:
+        notifications.worker.notify()
+
+    return {
+        "ai_response": answer,
+        "message": "Ответ сгенерирован и отправляется клиенту" if queued
+                   else "Ответ сгенерирован, каналов для уведомления нет",
+        "notifications": [{"id": n.id, "channel": n.channel} for n in queued],
+    }
@@ -1,14 +1,17 @@
 # backend/routers/users.py
 
-from fastapi import APIRouter, Depends, Header, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status
+from sqlalchemy.ext.asyncio import AsyncSession
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Optional
 from datetime import datetime
 from decimal import Decimal
 
-from ..services.db import get_db
-from ..models import Client, Payment
+from ..services.db import get_async_db
+from ..services import client_cache
+from ..config import settings
+from ..services.security import CurrentClient, create_telegram_link_token, get_current_client
+from ..models import Client
 
 router = APIRouter(
     prefix="/api/users",
@@ -34,14 +37,54 @@ class UserResponse(BaseModel):
     response_model=UserResponse,
     summary="Профиль текущего клиента"
 )
-def get_me(
-    x_client_phone: str = Header(..., description="Номер телефона клиента"),
-    db: Session = Depends(get_db)
+async def get_me(
+    current: CurrentClient = Depends(get_current_client),
+    db: AsyncSession = Depends(get_async_db)
 ):
-    client = db.query(Client).filter(Client.phone == x_client_phone).first()
+    client = await client_cache.get_profile(db, current.phone)
     if not client:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Клиент не найден"
         )
     return client
+
+
+class TelegramLink(BaseModel):
+    url: str          # открыть в Telegram и нажать «Start»
+    expires_in: int
+
+@router.post(
+    "/me/telegram",
+    response_model=TelegramLink,
+    summary="Ссылка для привязки Telegram к уведомлениям"
+)
+async def link_telegram(current: CurrentClient = Depends(get_current_client)):
+    """
+    Бот получит /start <токен> и через вебхук /api/telegram/webhook запишет
+    chat_id клиенту; после этого ответы и коды входа приходят и в Telegram.
+    """
+    if not (settings.TELEGRAM_BOT_TOKEN and settings.TELEGRAM_BOT_USERNAME and settings.TELEGRAM_WEBHOOK_SECRET):
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Telegram-уведомления не настроены"
+        )
+    token = create_telegram_link_token(current.id)
+    return TelegramLink(
+        url=f"https://t.me/{settings.TELEGRAM_BOT_USERNAME}?start={token}",
+        expires_in=settings.TELEGRAM_LINK_TTL_SECONDS,
+    )
+
+@router.delete(
+    "/me/telegram",
+    status_code=status.HTTP_204_NO_CONTENT,
+    summary="Отвязать Telegram"
+)
+async def unlink_telegram(
+    current: CurrentClient = Depends(get_current_client),
+    db: AsyncSession = Depends(get_async_db)
+):
+    client = await db.get(Client, current.id)
+    if client and client.telegram_chat_id:
+        client.telegram_chat_id = None
+        await db.commit()
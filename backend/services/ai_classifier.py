@@ -1,65 +1,504 @@
-import openai
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import re
+from dataclasses import dataclass
+from datetime import timedelta
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+from anyio import to_thread
 from fastapi import HTTPException
+from sqlalchemy import func, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
 from ..config import settings
+from ..models import AICacheEntry
+from . import ai_gateway, local_classifier
+from .ai_gateway import Usage
+from .cache import TTLCache
+from .db import SessionLocal
 
-# Устанавливаем ключ
-openai.api_key = settings.OPENAI_API_KEY
+logger = logging.getLogger(__name__)
 
 ALLOWED_CATEGORIES = {"подключение", "инцидент", "жалоба", "информация"}
 
-def classify_text(text: str) -> str:
+# Версию промпта нужно поднимать при любом изменении текста промпта,
+# иначе кэш продолжит отдавать ответы старого промпта
+CLASSIFY_MODEL = "gpt-3.5-turbo"
+CLASSIFY_TEMPERATURE = 0
+CLASSIFY_PROMPT_VERSION = "v1"
+CLASSIFY_PROMPT = (
+    "Ты — классификатор обращений клиентского портала. "
+    "Ответь только ОДНИМ словом, без пояснений: "
+    "подключение, инцидент, жалоба или информация. "
+    "Только одно слово из этого списка."
+)
+
+CLASSIFY_BATCH_PROMPT = (
+    "Ты — классификатор обращений клиентского портала. "
+    "Тебе дан пронумерованный список обращений. Для каждого выбери ровно одну категорию: "
+    "подключение, инцидент, жалоба или информация. "
+    'Ответь JSON-объектом вида {"1": "инцидент", "2": "информация"} без пояснений.'
+)
+
+RESPONSE_MODEL = "gpt-3.5-turbo"
+RESPONSE_TEMPERATURE = 0.7
+RESPONSE_PROMPT_VERSION = "v1"
+RESPONSE_PROMPT = (
+    "Ты — AI-ассистент клиентского портала. "
+    "Сформулируй вежливый и информативный ответ на обращение."
+)
+
+
+@dataclass
+class AIResult:
     """
-    Отправляет в OpenAI запрос на классификацию обращения.
-    Возвращает одну из 4 категорий: 'подключение', 'инцидент', 'жалоба', 'информация'.
+    Результат AI-вызова.
+    source — кто ответил: openai или local (локальный классификатор).
+    usage — учёт вызова модели; None, если ответ из кэша или локальный.
     """
+    value: str
+    cached: bool = False
+    confidence: Optional[float] = None
+    source: str = "openai"
+    usage: Optional[Usage] = None
+
+    def log_fields(self) -> dict:
+        """Поля учёта для AILog (все ключи всегда есть — удобно для multi-row INSERT)."""
+        if self.usage is None:
+            return {"model": None, "prompt_tokens": None, "completion_tokens": None, "latency_ms": None, "cost": None}
+        return self.usage.log_fields()
+
+
+# Локальный классификатор перед OpenAI (None, если не обучен или выключен)
+local_model = local_classifier.load_default()
+
+
+# ----------------------------
+# Кэш результатов
+# ----------------------------
+_local_cache = TTLCache(
+    maxsize=settings.AI_CACHE_MAX_ENTRIES,
+    ttl=settings.AI_CACHE_TTL_SECONDS,
+)
+_shared_stats = {"hits": 0, "misses": 0, "errors": 0}
+_inflight: Dict[str, "asyncio.Future[str]"] = {}
+
+_PUNCT_RE = re.compile(r"[^\w\s]+")
+_SPACE_RE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Приводит текст обращения к виду, по которому почти одинаковые заявки совпадают."""
+    text = text.lower().replace("ё", "е")
+    text = _PUNCT_RE.sub(" ", text)
+    return _SPACE_RE.sub(" ", text).strip()
+
+
+def cache_key(action: str, text: str, model: str, prompt_version: str, temperature: float) -> str:
+    raw = "\x1f".join([action, model, prompt_version, str(temperature), normalize_text(text)])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def cache_stats() -> dict:
+    """Счётчики попаданий/промахов обоих уровней кэша."""
+    return {
+        "local": _local_cache.stats(),
+        "shared": dict(_shared_stats, enabled=settings.AI_CACHE_SHARED),
+    }
+
+
+def _shared_get_many(keys: List[str]) -> Dict[str, AIResult]:
+    with SessionLocal() as db:
+        rows = db.execute(
+            select(AICacheEntry.key, AICacheEntry.value)
+            .where(AICacheEntry.key.in_(keys), AICacheEntry.expires_at > func.now())
+        ).all()
+    results = {}
+    for key, raw in rows:
+        data = json.loads(raw)
+        results[key] = AIResult(data["value"], cached=True, confidence=data.get("confidence"))
+    return results
+
+
+def _shared_get(key: str) -> Optional[AIResult]:
+    return _shared_get_many([key]).get(key)
+
+
+def _shared_set_many(action: str, results: Dict[str, AIResult]) -> None:
+    expires_at = func.now() + timedelta(seconds=settings.AI_CACHE_TTL_SECONDS)
+    stmt = pg_insert(AICacheEntry).values([
+        {
+            "key": key,
+            "action": action,
+            "value": json.dumps({"value": r.value, "confidence": r.confidence}, ensure_ascii=False),
+            "expires_at": expires_at,
+        }
+        for key, r in results.items()
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[AICacheEntry.key],
+        set_={"value": stmt.excluded.value, "expires_at": stmt.excluded.expires_at},
+    )
+    with SessionLocal() as db:
+        db.execute(stmt)
+        db.commit()
+
+
+def _shared_set(key: str, action: str, result: AIResult) -> None:
+    _shared_set_many(action, {key: result})
+
+
+async def _cached(
+    action: str,
+    key: str,
+    call: Callable[[], Awaitable[AIResult]],
+    fast_path: Optional[Callable[[], Optional[AIResult]]] = None,
+) -> AIResult:
+    """
+    Порядок: локальный LRU, быстрый локальный путь (если есть),
+    общий кэш в Postgres, затем сам вызов модели.
+    Одинаковые запросы, пришедшие одновременно, ждут один вызов модели. Делится
+    только успех: если ведущий упал (например, 429 по лимиту его телефона),
+    ожидающий сам становится ведущим и идёт в модель под своими лимитами.
+    """
+    hit = _local_cache.get(key)
+    if hit is not None:
+        value, confidence = hit
+        return AIResult(value, cached=True, confidence=confidence)
+
+    if fast_path:
+        result = fast_path()
+        if result is not None:
+            return result
+
+    while key in _inflight:
+        result = await asyncio.shield(_inflight[key])
+        if result is not None:
+            return AIResult(result.value, cached=True, confidence=result.confidence)
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
     try:
-        resp = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            temperature=0,
+        result = None
+        if settings.AI_CACHE_SHARED:
+            try:
+                result = await to_thread.run_sync(_shared_get, key)
+            except Exception as e:
+                _shared_stats["errors"] += 1
+                logger.warning("Общий AI-кэш недоступен: %s", e)
+            if result is not None:
+                _shared_stats["hits"] += 1
+                _local_cache.set(key, (result.value, result.confidence))
+                future.set_result(result)
+                return result
+            _shared_stats["misses"] += 1
+
+        result = await call()
+        _local_cache.set(key, (result.value, result.confidence))
+        future.set_result(result)
+
+        if settings.AI_CACHE_SHARED:
+            try:
+                await to_thread.run_sync(_shared_set, key, action, result)
+            except Exception as e:
+                _shared_stats["errors"] += 1
+                logger.warning("Не удалось записать в общий AI-кэш: %s", e)
+        return result
+    except BaseException:
+        if not future.done():
+            # Ожидающим — None: ошибка ведущего (его лимит, отмена) не их ошибка
+            future.set_result(None)
+        raise
+    finally:
+        _inflight.pop(key, None)
+
+
+def _classify_locally(text: str) -> Optional[AIResult]:
+    """Ответ локального классификатора, если он уверен не меньше порога."""
+    if local_model is None:
+        return None
+    category, confidence = local_model.predict(text)
+    if confidence < settings.LOCAL_CLASSIFIER_THRESHOLD or category not in ALLOWED_CATEGORIES:
+        return None
+    return AIResult(category, confidence=round(confidence, 4), source="local")
+
+
+def classify_offline(text: str) -> Optional[AIResult]:
+    """Категория без вызова модели — из локального кэша или локального классификатора."""
+    key = cache_key("classify", text, CLASSIFY_MODEL, CLASSIFY_PROMPT_VERSION, CLASSIFY_TEMPERATURE)
+    hit = _local_cache.get(key)
+    if hit is not None:
+        value, confidence = hit
+        return AIResult(value, cached=True, confidence=confidence)
+    return _classify_locally(text)
+
+
+def reload_local_model() -> None:
+    """Перечитывает модель после python -m backend.services.local_classifier retrain."""
+    global local_model
+    local_model = local_classifier.load_default()
+
+
+# ----------------------------
+# Вызовы модели
+# ----------------------------
+def _max_wait(phone: Optional[str]) -> Optional[float]:
+    # Запрос клиента ждёт очередь к модели ограниченно, фоновые задачи — сколько нужно
+    return settings.AI_QUEUE_TIMEOUT if phone else None
+
+
+async def _classify_uncached(text: str, timeout: Optional[float], phone: Optional[str] = None) -> AIResult:
+    try:
+        resp, usage = await ai_gateway.chat_completion(
+            model=CLASSIFY_MODEL,
+            temperature=CLASSIFY_TEMPERATURE,
+            logprobs=True,
             messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Ты — классификатор обращений клиентского портала. "
-                        "Ответь только ОДНИМ словом, без пояснений: "
-                        "подключение, инцидент, жалоба или информация. "
-                        "Только одно слово из этого списка."
-                    )
-                },
+                {"role": "system", "content": CLASSIFY_PROMPT},
                 {"role": "user", "content": text}
-            ]
+            ],
+            phone=phone,
+            max_wait=_max_wait(phone),
+            timeout=timeout,
         )
-        category = resp.choices[0].message.content.strip().lower()
+        choice = resp.choices[0]
+        category = choice.message.content.strip().lower()
 
         # Проверка на допустимые значения
         if category not in ALLOWED_CATEGORIES:
             raise ValueError(f"Unexpected category from AI: {category}")
 
-        return category
+        # Уверенность модели — вероятность всей последовательности токенов ответа
+        confidence = None
+        if choice.logprobs and choice.logprobs.content:
+            confidence = round(math.exp(sum(t.logprob for t in choice.logprobs.content)), 4)
+
+        return AIResult(category, confidence=confidence, usage=usage)
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="AI classification timed out")
     except Exception as e:
         # пробросим как HTTP-ошибку для FastAPI
         raise HTTPException(status_code=500, detail=f"AI classification error: {e}")
 
-def generate_response(text: str) -> str:
-    """
-    Генерирует вежливый ответ на обращение клиента.
-    """
+
+async def _respond_uncached(
+    text: str,
+    timeout: Optional[float],
+    phone: Optional[str] = None,
+    temperature: float = RESPONSE_TEMPERATURE,
+) -> AIResult:
     try:
-        resp = openai.chat.completions.create(
-            model="gpt-3.5-turbo",
-            temperature=0.7,
+        resp, usage = await ai_gateway.chat_completion(
+            model=RESPONSE_MODEL,
+            temperature=temperature,
             messages=[
-                {
-                    "role": "system",
-                    "content": (
-                        "Ты — AI-ассистент клиентского портала. "
-                        "Сформулируй вежливый и информативный ответ на обращение."
-                    )
-                },
+                {"role": "system", "content": RESPONSE_PROMPT},
                 {"role": "user", "content": text}
-            ]
+            ],
+            phone=phone,
+            max_wait=_max_wait(phone),
+            timeout=timeout,
         )
         answer = resp.choices[0].message.content.strip()
-        return answer
+        return AIResult(answer, usage=usage)
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="AI response generation timed out")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"AI response generation error: {e}")
+
+
+async def classify_text(text: str, timeout: Optional[float] = None, phone: Optional[str] = None) -> AIResult:
+    """
+    Отправляет в OpenAI запрос на классификацию обращения.
+    Возвращает одну из 4 категорий: 'подключение', 'инцидент', 'жалоба', 'информация'.
+    Классификация детерминирована (temperature=0), поэтому всегда кэшируется.
+    Если локальный классификатор уверен выше LOCAL_CLASSIFIER_THRESHOLD,
+    OpenAI не вызывается.
+    phone — телефон клиента для его лимита вызовов (ai_gateway); без него вызов фоновый.
+    """
+    key = cache_key("classify", text, CLASSIFY_MODEL, CLASSIFY_PROMPT_VERSION, CLASSIFY_TEMPERATURE)
+    return await _cached(
+        "classify", key,
+        lambda: _classify_uncached(text, timeout, phone),
+        fast_path=lambda: _classify_locally(text),
+    )
+
+
+async def generate_response(
+    text: str,
+    timeout: Optional[float] = None,
+    use_cache: bool = True,
+    phone: Optional[str] = None,
+) -> AIResult:
+    """
+    Генерирует вежливый ответ на обращение клиента.
+    Кэшируются только детерминированные вызовы: при AI_CACHE_RESPONSES ответ
+    генерируется с temperature=0, иначе каждый вызов идёт в модель с
+    RESPONSE_TEMPERATURE и разные заявки получают разные формулировки.
+    """
+    if not (use_cache and settings.AI_CACHE_RESPONSES):
+        return await _respond_uncached(text, timeout, phone)
+    key = cache_key("generate_response", text, RESPONSE_MODEL, RESPONSE_PROMPT_VERSION, 0)
+    return await _cached("generate_response", key, lambda: _respond_uncached(text, timeout, phone, temperature=0))
+
+
+async def classify_and_respond(text: str, phone: Optional[str] = None) -> Tuple[AIResult, AIResult]:
+    """
+    Запускает классификацию и генерацию ответа одновременно.
+    Если один из вызовов упал или вышел по таймауту, второй отменяется.
+    """
+    tasks = [
+        asyncio.ensure_future(classify_text(text, phone=phone)),
+        asyncio.ensure_future(generate_response(text, phone=phone)),
+    ]
+    try:
+        category, answer = await asyncio.gather(*tasks)
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
+    return category, answer
+
+
+# ----------------------------
+# Пакетная классификация
+# ----------------------------
+async def _classify_group(texts: List[str], timeout: Optional[float] = None) -> List[Optional[AIResult]]:
+    """
+    Один запрос к модели на несколько обращений.
+    Для пунктов, которые модель пропустила или разметила не той категорией, возвращает None.
+    """
+    numbered = "\n".join(f"{n}. {' '.join(t.split())}" for n, t in enumerate(texts, start=1))
+    try:
+        # Один вызов на несколько заявок — учёт пишем отдельной строкой AILog без ticket_id
+        resp, _ = await ai_gateway.chat_completion(
+            model=CLASSIFY_MODEL,
+            temperature=CLASSIFY_TEMPERATURE,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": CLASSIFY_BATCH_PROMPT},
+                {"role": "user", "content": numbered}
+            ],
+            max_wait=None,
+            timeout=timeout,
+            log_action="classify_batch",
+        )
+        labels = json.loads(resp.choices[0].message.content)
+        # Модель может вернуть не объект, а, например, список — это тоже ошибка группы
+        results: List[Optional[AIResult]] = []
+        for n in range(1, len(texts) + 1):
+            category = str(labels.get(str(n), "")).strip().lower()
+            results.append(AIResult(category) if category in ALLOWED_CATEGORIES else None)
+    except HTTPException:
+        raise
+    except asyncio.TimeoutError:
+        raise HTTPException(status_code=504, detail="AI batch classification timed out")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"AI batch classification error: {e}")
+    return results
+
+
+BatchItem = Tuple[int, Union[AIResult, Exception]]
+
+
+async def classify_batch(
+    texts: List[str],
+    batch_size: Optional[int] = None,
+    concurrency: Optional[int] = None,
+) -> AsyncIterator[List[BatchItem]]:
+    """
+    Классифицирует много обращений сразу.
+
+    Отдаёт результаты группами по мере готовности: (индекс текста, AIResult или ошибка).
+    Сначала всё, что нашлось в кэше или уверенно решено локальным классификатором,
+    затем группы по batch_size текстов на запрос к модели, не больше concurrency
+    запросов одновременно. Одинаковые тексты отправляются в модель один раз.
+    """
+    batch_size = batch_size or settings.AI_BATCH_SIZE
+    concurrency = concurrency or settings.AI_BATCH_CONCURRENCY
+
+    ready: List[BatchItem] = []
+    pending: Dict[str, List[int]] = {}
+    for i, text in enumerate(texts):
+        key = cache_key("classify", text, CLASSIFY_MODEL, CLASSIFY_PROMPT_VERSION, CLASSIFY_TEMPERATURE)
+        if key in pending:
+            pending[key].append(i)
+            continue
+        hit = _local_cache.get(key)
+        if hit is not None:
+            ready.append((i, AIResult(hit[0], cached=True, confidence=hit[1])))
+            continue
+        local = _classify_locally(text)
+        if local is not None:
+            ready.append((i, local))
+            continue
+        pending[key] = [i]
+
+    if pending and settings.AI_CACHE_SHARED:
+        try:
+            found = await to_thread.run_sync(_shared_get_many, list(pending))
+        except Exception as e:
+            _shared_stats["errors"] += 1
+            logger.warning("Общий AI-кэш недоступен: %s", e)
+            found = {}
+        _shared_stats["hits"] += len(found)
+        _shared_stats["misses"] += len(pending) - len(found)
+        for key, result in found.items():
+            _local_cache.set(key, (result.value, result.confidence))
+            ready.extend((i, result) for i in pending.pop(key))
+
+    if ready:
+        yield ready
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(group: List[str]) -> List[BatchItem]:
+        async with semaphore:
+            try:
+                results = await _classify_group([texts[pending[k][0]] for k in group])
+            except Exception as e:
+                return [(i, e) for k in group for i in pending[k]]
+
+        out: List[BatchItem] = []
+        fresh: Dict[str, AIResult] = {}
+        for key, result in zip(group, results):
+            if result is None:
+                # Пункт потерялся в пакетном ответе — добираем одиночным запросом
+                try:
+                    result = await classify_text(texts[pending[key][0]])
+                except Exception as e:
+                    out.extend((i, e) for i in pending[key])
+                    continue
+            else:
+                _local_cache.set(key, (result.value, result.confidence))
+                fresh[key] = result
+            first, *duplicates = pending[key]
+            out.append((first, result))
+            out.extend((i, AIResult(result.value, cached=True, confidence=result.confidence)) for i in duplicates)
+
+        if fresh and settings.AI_CACHE_SHARED:
+            try:
+                await to_thread.run_sync(_shared_set_many, "classify", fresh)
+            except Exception as e:
+                _shared_stats["errors"] += 1
+                logger.warning("Не удалось записать в общий AI-кэш: %s", e)
+        return out
+
+    keys = list(pending)
+    tasks = [
+        asyncio.ensure_future(run(keys[n:n + batch_size]))
+        for n in range(0, len(keys), batch_size)
+    ]
+    try:
+        for finished in asyncio.as_completed(tasks):
+            yield await finished
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,442 @@
+"""
+Единая точка вызова модели OpenAI.
+
+Каждый вызов проходит через admission:
+- token bucket на телефон клиента (AI_CLIENT_REQUESTS_PER_MINUTE) — превышение сразу даёт 429;
+- общий token bucket по токенам модели (AI_GLOBAL_TOKENS_PER_MINUTE) и лимит одновременных
+  вызовов (AI_MAX_CONCURRENT_CALLS) — запрос ждёт в очереди до max_wait секунд,
+  потом получает 429 с Retry-After. Фоновые задачи (max_wait=None) ждут без ограничения.
+Сам вызов защищён resilience: circuit breaker, повторы с jitter на сетевых ошибках,
+429 и 5xx, и hedged-запрос, если ответ задерживается дольше p95. Когда модель
+недоступна, бросается AIUnavailableError (503) — вызывающий код решает, как деградировать.
+После вызова usage (токены, стоимость, латентность, модель) попадает в счётчики
+процесса и в AILog — либо через вызывающий код (Usage.log_fields), либо сам (log_action)
+через фоновую запись ai_log.
+"""
+import asyncio
+import logging
+import math
+import time
+from dataclasses import asdict, dataclass
+from typing import AsyncIterator, Dict, List, Optional
+
+from fastapi import HTTPException
+from openai import AsyncOpenAI
+
+from ..config import settings
+from .cache import TTLCache
+from . import ai_log, metrics
+from .ratelimit import TokenBucket
+from .resilience import AIUnavailableError, CircuitBreaker, LatencyWindow, backoff_delay, hedged, is_retryable
+
+logger = logging.getLogger(__name__)
+
+# Общий асинхронный клиент: один пул HTTP-соединений на процесс.
+# Свои повторы SDK выключены — ими управляет _call_with_retries.
+async_client = AsyncOpenAI(
+    api_key=settings.OPENAI_API_KEY,
+    base_url=settings.OPENAI_BASE_URL,
+    max_retries=0,
+)
+
+# Цена в долларах за 1M токенов: (prompt, completion)
+PRICES = {
+    "gpt-4": (30.0, 60.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+# Сколько токенов закладывать на ответ, если max_tokens не задан
+_DEFAULT_COMPLETION_ESTIMATE = 256
+
+try:
+    import tiktoken
+
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except ImportError:
+    _encoding = None
+
+
+def count_tokens(text: str) -> int:
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    # Без tiktoken — грубая оценка: для русского текста около 2.5 символа на токен
+    return max(1, int(len(text) / 2.5))
+
+
+class RateLimited(HTTPException):
+    """429 с заголовком Retry-After."""
+
+    def __init__(self, detail: str, retry_after: float):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(
+            status_code=429,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+
+@dataclass
+class Usage:
+    model: str
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    latency_ms: int = 0
+    cost: Optional[float] = None
+
+    def log_fields(self) -> dict:
+        """Поля AILog для этого вызова."""
+        return asdict(self)
+
+
+def price(model: str, prompt_tokens: int, completion_tokens: int) -> Optional[float]:
+    # Снапшоты вида gpt-4-0613 считаем по цене базовой модели
+    base = max((name for name in PRICES if model.startswith(name)), key=len, default=None)
+    if base is None:
+        return None
+    prompt_price, completion_price = PRICES[base]
+    return round((prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000, 6)
+
+
+# ----------------------------
+# Admission
+# ----------------------------
+_client_buckets = TTLCache(maxsize=100_000, ttl=600)
+_global_tokens = TokenBucket(
+    rate=settings.AI_GLOBAL_TOKENS_PER_MINUTE / 60,
+    capacity=settings.AI_GLOBAL_TOKENS_PER_MINUTE,
+)
+_slots: Optional[asyncio.Semaphore] = None
+
+_stats = {
+    "errors": 0,
+    "rejected_client": 0,
+    "rejected_overload": 0,
+    "queued": 0,
+    "in_flight": 0,
+    "queue_wait_ms_total": 0,
+    "retries": 0,
+    "hedged": 0,
+    "unavailable": 0,
+}
+_model_stats: Dict[str, Dict[str, float]] = {}
+
+
+def _slots_semaphore() -> asyncio.Semaphore:
+    # Создаём лениво, внутри работающего event loop
+    global _slots
+    if _slots is None:
+        _slots = asyncio.Semaphore(settings.AI_MAX_CONCURRENT_CALLS)
+    return _slots
+
+
+def _client_bucket(phone: str) -> TokenBucket:
+    bucket = _client_buckets.get(phone)
+    if bucket is None:
+        bucket = TokenBucket(
+            rate=settings.AI_CLIENT_REQUESTS_PER_MINUTE / 60,
+            capacity=settings.AI_CLIENT_BURST,
+        )
+        _client_buckets.set(phone, bucket)
+    return bucket
+
+
+def estimate_tokens(messages: List[dict], max_tokens: Optional[int]) -> int:
+    prompt = sum(count_tokens(m.get("content") or "") + 4 for m in messages)
+    return prompt + (max_tokens or _DEFAULT_COMPLETION_ESTIMATE)
+
+
+async def admit(phone: Optional[str], estimated_tokens: int, max_wait: Optional[float]) -> None:
+    """
+    Пропускает вызов или бросает RateLimited. При успехе занимает слот
+    одновременных вызовов — его нужно вернуть через release().
+    """
+    if phone:
+        wait = _client_bucket(phone).try_acquire()
+        if wait:
+            _stats["rejected_client"] += 1
+            raise RateLimited("Слишком много запросов к AI, попробуйте позже", wait)
+
+    started = time.monotonic()
+    if not await _global_tokens.acquire(estimated_tokens, max_wait=max_wait):
+        _stats["rejected_overload"] += 1
+        raise RateLimited("AI-сервис перегружен, попробуйте позже", _global_tokens.retry_after(estimated_tokens))
+
+    slots = _slots_semaphore()
+    if not slots.locked():
+        # Свободный слот занимается сразу, без переключения задач
+        await slots.acquire()
+    else:
+        _stats["queued"] += 1
+        try:
+            remaining = None if max_wait is None else max(0.0, max_wait - (time.monotonic() - started))
+            await asyncio.wait_for(slots.acquire(), timeout=remaining)
+        except asyncio.TimeoutError:
+            _stats["rejected_overload"] += 1
+            raise RateLimited("AI-сервис перегружен, попробуйте позже", settings.AI_REQUEST_TIMEOUT / 2)
+    _stats["in_flight"] += 1
+    _stats["queue_wait_ms_total"] += int((time.monotonic() - started) * 1000)
+
+
+def release() -> None:
+    _stats["in_flight"] -= 1
+    _slots_semaphore().release()
+
+
+# ----------------------------
+# Учёт
+# ----------------------------
+def record(
+    usage: Usage,
+    log_action: Optional[str] = None,
+    ticket_id: Optional[int] = None,
+    phone: Optional[str] = None,
+) -> None:
+    """Добавляет вызов в счётчики и, если задан log_action, ставит строку AILog в буфер записи."""
+    stats = _model_stats.setdefault(usage.model, {
+        "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0, "latency_ms_total": 0,
+    })
+    stats["calls"] += 1
+    stats["prompt_tokens"] += usage.prompt_tokens
+    stats["completion_tokens"] += usage.completion_tokens
+    stats["cost"] += usage.cost or 0.0
+    stats["latency_ms_total"] += usage.latency_ms
+    metrics.observe_ai(usage.model, usage.latency_ms, usage.prompt_tokens, usage.completion_tokens, usage.cost)
+
+    if log_action is not None:
+        ai_log.writer.put(ai_log.entry(
+            log_action, ticket_id, request_payload={"phone": phone} if phone else None, **usage.log_fields()
+        ))
+
+
+def _usage_from(model: str, raw_usage, latency_ms: int) -> Usage:
+    prompt = getattr(raw_usage, "prompt_tokens", 0) or 0
+    completion = getattr(raw_usage, "completion_tokens", 0) or 0
+    return Usage(
+        model=model,
+        prompt_tokens=prompt,
+        completion_tokens=completion,
+        latency_ms=latency_ms,
+        cost=price(model, prompt, completion),
+    )
+
+
+def stats() -> dict:
+    models = {
+        model: dict(values, cost=round(values["cost"], 6))
+        for model, values in _model_stats.items()
+    }
+    return {
+        **_stats,
+        "calls": sum(m["calls"] for m in _model_stats.values()),
+        "models": models,
+        "breaker": breaker.stats(),
+        "hedge_after_seconds": _hedge_after(),
+    }
+
+
+# ----------------------------
+# Resilience
+# ----------------------------
+breaker = CircuitBreaker(
+    window=settings.AI_BREAKER_WINDOW,
+    min_calls=settings.AI_BREAKER_MIN_CALLS,
+    error_rate=settings.AI_BREAKER_ERROR_RATE,
+    slow_seconds=settings.AI_BREAKER_SLOW_SECONDS,
+    slow_rate=settings.AI_BREAKER_SLOW_RATE,
+    open_seconds=settings.AI_BREAKER_OPEN_SECONDS,
+)
+_latencies = LatencyWindow()
+
+# Дубль раньше этого не отправляем, даже если p95 меньше
+_MIN_HEDGE_AFTER = 0.5
+
+
+def _hedge_after() -> Optional[float]:
+    if not settings.AI_HEDGE_ENABLED:
+        return None
+    if settings.AI_HEDGE_AFTER_SECONDS is not None:
+        return settings.AI_HEDGE_AFTER_SECONDS
+    p95 = _latencies.percentile(0.95)
+    return None if p95 is None else max(_MIN_HEDGE_AFTER, p95)
+
+
+def _on_hedge() -> None:
+    _stats["hedged"] += 1
+
+
+def _check_breaker() -> None:
+    if not breaker.allow():
+        _stats["unavailable"] += 1
+        raise AIUnavailableError(retry_after=breaker.retry_after())
+
+
+async def _call_with_retries(call, hedge: bool):
+    """
+    Вызывает call() с повторами на временных ошибках и отмечает исход в breaker.
+    Ошибки запроса (400, 401 и т.п.) пробрасываются сразу и сбоем сервиса не считаются.
+    """
+    attempts = max(1, settings.AI_RETRY_ATTEMPTS)
+    for attempt in range(attempts):
+        started = time.monotonic()
+        try:
+            if hedge:
+                result = await hedged(call, _hedge_after(), on_hedge=_on_hedge)
+            else:
+                result = await call()
+        except asyncio.CancelledError:
+            breaker.release_probe()
+            raise
+        except Exception as e:
+            latency = time.monotonic() - started
+            if not is_retryable(e):
+                breaker.record(True, latency)
+                raise
+            breaker.record(False, latency)
+            _stats["errors"] += 1
+            if attempt == attempts - 1 or breaker.is_open():
+                _stats["unavailable"] += 1
+                logger.warning("Модель недоступна после %d попыток: %r", attempt + 1, e)
+                raise AIUnavailableError(retry_after=breaker.retry_after() or settings.AI_RETRY_MAX_DELAY) from e
+            _stats["retries"] += 1
+            delay = backoff_delay(attempt, settings.AI_RETRY_BASE_DELAY, settings.AI_RETRY_MAX_DELAY)
+            # Провайдер сам подсказал, сколько ждать
+            response = getattr(e, "response", None)
+            if response is not None and response.headers.get("retry-after", "").isdigit():
+                delay = min(settings.AI_RETRY_MAX_DELAY, float(response.headers["retry-after"]))
+            await asyncio.sleep(delay)
+            continue
+
+        latency = time.monotonic() - started
+        breaker.record(True, latency)
+        _latencies.add(latency)
+        return result
+
+
+# ----------------------------
+# Вызовы
+# ----------------------------
+async def chat_completion(
+    *,
+    model: str,
+    messages: List[dict],
+    phone: Optional[str] = None,
+    max_wait: Optional[float] = settings.AI_QUEUE_TIMEOUT,
+    timeout: Optional[float] = None,
+    log_action: Optional[str] = None,
+    ticket_id: Optional[int] = None,
+    **params,
+):
+    """
+    chat.completions.create через admission, resilience и учёт. Возвращает (ответ, Usage).
+    RateLimited (429) — не прошёл admission, AIUnavailableError (503) — модель недоступна,
+    прочие ошибки OpenAI (400, 401, ...) пробрасываются как есть.
+    """
+    await admit(phone, estimate_tokens(messages, params.get("max_tokens")), max_wait)
+    started = time.monotonic()
+    try:
+        _check_breaker()
+        response = await _call_with_retries(
+            lambda: asyncio.wait_for(
+                async_client.chat.completions.create(model=model, messages=messages, **params),
+                timeout=timeout or settings.AI_REQUEST_TIMEOUT,
+            ),
+            hedge=True,
+        )
+    finally:
+        release()
+
+    usage = _usage_from(response.model or model, response.usage, int((time.monotonic() - started) * 1000))
+    record(usage, log_action, ticket_id, phone)
+    return response, usage
+
+
+async def stream_chat_completion(
+    *,
+    model: str,
+    messages: List[dict],
+    phone: Optional[str] = None,
+    max_wait: Optional[float] = settings.AI_QUEUE_TIMEOUT,
+    log_action: Optional[str] = None,
+    ticket_id: Optional[int] = None,
+    **params,
+) -> AsyncIterator:
+    """
+    Потоковый вызов. Admission и открытие потока происходят до возврата,
+    так что 429 и 503 приходят обычным HTTP-ответом. Слот держится до
+    ModelStream.aclose(): его вызывает конец чтения, а вызывающий код обязан
+    вызвать сам на случай, если поток так и не начали читать (BackgroundTask ответа).
+    Повторяется только открытие потока — после первого чанка повтор задублировал бы текст.
+    """
+    await admit(phone, estimate_tokens(messages, params.get("max_tokens")), max_wait)
+    started = time.monotonic()
+    try:
+        _check_breaker()
+        stream = await _call_with_retries(
+            lambda: asyncio.wait_for(
+                async_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    stream=True,
+                    stream_options={"include_usage": True},
+                    **params,
+                ),
+                timeout=settings.AI_REQUEST_TIMEOUT,
+            ),
+            hedge=False,
+        )
+    except BaseException:
+        release()
+        raise
+
+    return ModelStream(stream, model, started, log_action, ticket_id, phone)
+
+
+class ModelStream:
+    """
+    Открытый поток ответа модели, держит слот admission. aclose() освобождает
+    слот и пишет учёт ровно один раз — и после чтения, и если чтение не начиналось.
+    """
+
+    def __init__(self, stream, model: str, started: float, log_action, ticket_id, phone):
+        self._stream = stream
+        self._started = started
+        self._log_action = log_action
+        self._ticket_id = ticket_id
+        self._phone = phone
+        self._raw_usage = None
+        self._model = model
+        self._closed = False
+
+    def __aiter__(self):
+        return self._relay()
+
+    async def _relay(self):
+        try:
+            async for chunk in self._stream:
+                # Последний чанк несёт usage и пустой список choices
+                if getattr(chunk, "usage", None):
+                    self._raw_usage = chunk.usage
+                self._model = getattr(chunk, "model", None) or self._model
+                yield chunk
+        except BaseException:
+            _stats["errors"] += 1
+            raise
+        finally:
+            await self.aclose()
+
+    async def aclose(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        release()
+        usage = _usage_from(self._model, self._raw_usage, int((time.monotonic() - self._started) * 1000))
+        record(usage, self._log_action, self._ticket_id, self._phone)
+        close = getattr(self._stream, "close", None)
+        if close is not None:
+            try:
+                # Недочитанный поток закрываем, чтобы не держать HTTP-соединение к OpenAI
+                await close()
+            except Exception as e:
+                logger.debug("Не удалось закрыть поток модели: %s", e)
@@ -0,0 +1,277 @@
+"""
+Фоновая запись AILog.
+
+Строки AILog не пишутся в транзакции запроса: они копятся в ограниченном буфере
+и раз в AI_LOG_FLUSH_SECONDS (или как только набралось AI_LOG_BATCH_SIZE)
+уходят в ai_logs одним multi-row INSERT из фонового цикла. При остановке
+приложения буфер дописывается. Если буфер переполнен (БД недоступна), новые
+строки отбрасываются и считаются в stats()["dropped"] — учёт вызовов модели не
+должен тормозить и ронять приём заявок.
+
+Пачка, упавшая из-за связи с БД, ждёт следующей попытки целиком. Если же она
+AI_LOG_MAX_ATTEMPTS раз подряд падает по другой причине (в ней строка, которую
+БД не принимает), она пишется половинами, а не записываемые строки отбрасываются
+с ошибкой в логе — иначе одна строка навсегда заблокировала бы буфер.
+
+    ai_log.add(db, ai_log.entry("classify", ticket_id=..., ...))  # после коммита db
+    ai_log.writer.put(ai_log.entry("chat", ...))                   # сразу в буфер
+
+add() откладывает строки до коммита сессии: при откате они пропадают, а
+ticket_id к моменту записи уже закоммичен. Текст заявки в payload не копируется —
+его можно взять по ticket_id.
+"""
+import asyncio
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from anyio import to_thread
+from sqlalchemy import event, insert
+from sqlalchemy.exc import IntegrityError, InterfaceError, OperationalError, TimeoutError as PoolTimeoutError
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models import AILog
+from .db import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def entry(
+    action: str,
+    ticket_id: Optional[int] = None,
+    request_payload: Optional[dict] = None,
+    response_payload: Optional[dict] = None,
+    confidence: Optional[float] = None,
+    cached: bool = False,
+    model: Optional[str] = None,
+    prompt_tokens: Optional[int] = None,
+    completion_tokens: Optional[int] = None,
+    latency_ms: Optional[int] = None,
+    cost: Optional[float] = None,
+) -> dict:
+    """Строка ai_logs; все ключи всегда есть — так пачка уходит одним INSERT."""
+    return {
+        "ticket_id": ticket_id,
+        "action": action,
+        "request_payload": request_payload,
+        "response_payload": response_payload,
+        "confidence": confidence,
+        "cached": cached,
+        "model": model,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "latency_ms": latency_ms,
+        "cost": cost,
+        # Время вызова, а не записи пачки
+        "created_at": datetime.now(timezone.utc),
+    }
+
+
+def add(session: Session, *rows: dict) -> None:
+    """Строки уйдут в буфер после коммита session; при откате — пропадут."""
+    session.info.setdefault("pending_ai_logs", []).extend(rows)
+
+
+def _is_disconnect(error: Exception) -> bool:
+    """БД недоступна или пул исчерпан — строки пачки тут ни при чём."""
+    return (
+        isinstance(error, (OperationalError, InterfaceError, PoolTimeoutError))
+        or getattr(error, "connection_invalidated", False)
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def _queue_committed(session):
+    pending = session.info.pop("pending_ai_logs", None)
+    if pending:
+        writer.put(*pending)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_logs(session):
+    session.info.pop("pending_ai_logs", None)
+
+
+class AILogWriter:
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        max_size: int = settings.AI_LOG_QUEUE_SIZE,
+        batch_size: int = settings.AI_LOG_BATCH_SIZE,
+        flush_seconds: float = settings.AI_LOG_FLUSH_SECONDS,
+        max_attempts: int = settings.AI_LOG_MAX_ATTEMPTS,
+    ):
+        self.session_factory = session_factory
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self.max_attempts = max_attempts
+        self._rows: deque = deque()
+        # Пачки, уже падавшие при записи: (строки, ошибок подряд); пишутся первыми
+        self._retry: deque = deque()
+        self._retry_rows = 0
+        self._lock = threading.Lock()
+        self._stats = {"queued": 0, "written": 0, "dropped": 0, "batches": 0, "errors": 0}
+        self._reported_dropped = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wake: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def put(self, *rows: dict) -> None:
+        """Добавляет строки в буфер. Вызывается из любого потока."""
+        with self._lock:
+            accepted = rows[:max(self.max_size - len(self._rows) - self._retry_rows, 0)]
+            self._rows.extend(accepted)
+            self._stats["queued"] += len(accepted)
+            self._stats["dropped"] += len(rows) - len(accepted)
+            full = len(self._rows) >= self.batch_size
+        if self._task is None:
+            # Цикл не запущен (скрипты, CLI) — пишем сразу, как раньше
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Не удалось записать AILog")
+        elif full:
+            try:
+                self._loop.call_soon_threadsafe(self._wake.set)
+            except RuntimeError:
+                pass  # цикл событий уже закрыт; допишет stop()
+
+    def flush(self) -> int:
+        """Пишет весь буфер пачками. Возвращает число записанных строк."""
+        written = 0
+        while True:
+            with self._lock:
+                if self._retry:
+                    batch, attempts = self._retry.popleft()
+                    self._retry_rows -= len(batch)
+                else:
+                    batch = [self._rows.popleft() for _ in range(min(self.batch_size, len(self._rows)))]
+                    attempts = 0
+            if not batch:
+                return written
+            try:
+                written += self._write(batch)
+            except Exception as e:
+                if _is_disconnect(e):
+                    self._requeue(batch, attempts)
+                    raise
+                attempts += 1
+                if attempts < self.max_attempts:
+                    self._requeue(batch, attempts)
+                    raise
+                logger.warning("Пачка AILog из %d строк не записалась %d раз подряд (%s), пишу половинами",
+                               len(batch), attempts, e)
+                written += self._bisect(batch)
+
+    def _write(self, batch: List[dict]) -> int:
+        try:
+            with self.session_factory() as db:
+                db.execute(insert(AILog), batch)
+                db.commit()
+        except IntegrityError:
+            # Заявку успели удалить — пишем по одной и теряем только такие строки
+            return self._write_each(batch)
+        with self._lock:
+            self._stats["written"] += len(batch)
+            self._stats["batches"] += 1
+        return len(batch)
+
+    def _write_each(self, batch: List[dict]) -> int:
+        written = 0
+        with self.session_factory() as db:
+            for row in batch:
+                try:
+                    db.execute(insert(AILog), row)
+                    db.commit()
+                    written += 1
+                except IntegrityError:
+                    db.rollback()
+                    logger.warning("AILog %s для заявки #%s пропущен: заявки нет", row["action"], row["ticket_id"])
+        with self._lock:
+            self._stats["written"] += written
+            self._stats["dropped"] += len(batch) - written
+            self._stats["batches"] += 1
+        return written
+
+    def _bisect(self, batch: List[dict]) -> int:
+        """
+        Пишет пачку, деля пополам каждую неудачную часть; строку, которая не пишется
+        и одна, отбрасывает. Если пропала связь с БД — недописанное возвращается в буфер.
+        """
+        written = 0
+        parts = [batch]
+        while parts:
+            part = parts.pop()
+            try:
+                written += self._write(part)
+            except Exception as e:
+                if _is_disconnect(e):
+                    self._requeue(part + [row for rest in reversed(parts) for row in rest], 0)
+                    raise
+                if len(part) > 1:
+                    middle = len(part) // 2
+                    parts += [part[middle:], part[:middle]]
+                    continue
+                row = part[0]
+                with self._lock:
+                    self._stats["dropped"] += 1
+                    self._stats["errors"] += 1
+                logger.error("AILog %s для заявки #%s отброшен: %s", row["action"], row["ticket_id"], e)
+        return written
+
+    def _requeue(self, batch: List[dict], attempts: int) -> None:
+        """Возвращает пачку в начало очереди, сколько поместится, — до следующей попытки."""
+        with self._lock:
+            self._stats["errors"] += 1
+            room = max(self.max_size - len(self._rows) - self._retry_rows, 0)
+            kept = batch[:room]
+            if kept:
+                self._retry.appendleft((kept, attempts))
+                self._retry_rows += len(kept)
+            self._stats["dropped"] += len(batch) - len(kept)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self._stats, "buffered": len(self._rows) + self._retry_rows}
+
+    # ---------- фоновый цикл ----------
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await to_thread.run_sync(self.flush)
+        except Exception:
+            logger.exception("Не удалось дописать AILog при остановке (%d строк)", self.stats()["buffered"])
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=self.flush_seconds)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+            try:
+                await to_thread.run_sync(self.flush)
+            except Exception:
+                logger.exception("Не удалось записать AILog, повторим через %g с", self.flush_seconds)
+            dropped = self.stats()["dropped"]
+            if dropped > self._reported_dropped:
+                logger.warning("Буфер AILog переполнен, отброшено строк: %d", dropped - self._reported_dropped)
+                self._reported_dropped = dropped
+
+
+writer = AILogWriter()
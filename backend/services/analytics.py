@@ -0,0 +1,205 @@
+"""
+Инкрементальное обновление аналитики заявок для супервизоров.
+
+Триггер на tickets (миграция 0011) пишет создание, смену статуса и категории
+в ticket_status_events. Фоновый цикл раз в ANALYTICS_REFRESH_SECONDS забирает
+журнал пачками одним запросом: удаляет события (DELETE ... RETURNING) и тут же
+добавляет их в почасовые свёртки и ticket_facts. Разобранное удаляется в той же
+транзакции, поэтому событие учитывается ровно один раз, а незакоммиченные
+события просто не видны и попадут в следующую пачку — курсор по id здесь
+терял бы их. Пачку разбирает один процесс (advisory-блокировка), остальные
+воркеры uvicorn её пропускают.
+
+События моложе ANALYTICS_SETTLE_SECONDS не берутся: к этому времени
+асинхронное обогащение обычно уже проставило категорию.
+"""
+import asyncio
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from anyio import to_thread
+from sqlalchemy import text
+
+from ..config import settings
+from .db import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+# Произвольная константа: пачки журнала разбирает один процесс за раз
+_LOCK_ID = 72_310_024
+
+_REFRESH_SQL = text("""
+    WITH batch AS (
+        DELETE FROM ticket_status_events
+        WHERE id IN (
+            SELECT id FROM ticket_status_events
+            WHERE at < now() - make_interval(secs => :settle)
+            ORDER BY at, id
+            LIMIT :batch
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, ticket_id, from_status, to_status, at
+    ),
+    events AS (
+        SELECT b.*, coalesce(t.created_at, b.at) AS created_at,
+               coalesce(t.category, '') AS category, coalesce(t.channel, '') AS channel
+        FROM batch b
+        JOIN tickets t ON t.id = b.ticket_id
+    ),
+    hourly AS (
+        INSERT INTO analytics_ticket_hourly AS h (hour, category, channel, status, tickets)
+        SELECT date_trunc('hour', at), category, channel, to_status, count(*)
+        FROM events
+        WHERE from_status IS DISTINCT FROM to_status
+        GROUP BY 1, 2, 3, 4
+        ON CONFLICT (hour, category, channel, status) DO UPDATE
+            SET tickets = h.tickets + EXCLUDED.tickets
+    ),
+    per_ticket AS (
+        SELECT ticket_id,
+               min(created_at) AS created_at,
+               min(category) AS category,
+               min(channel) AS channel,
+               (array_agg(to_status ORDER BY at DESC, id DESC))[1] AS status,
+               max(at) AS status_at,
+               min(at) FILTER (WHERE from_status = 'new' AND to_status <> 'new') AS responded_at,
+               min(at) FILTER (WHERE to_status = 'closed' AND from_status IS DISTINCT FROM 'closed') AS closed_at
+        FROM events
+        GROUP BY ticket_id
+    ),
+    merged AS (
+        SELECT p.*, f.first_response_at AS prev_response, f.closed_at AS prev_closed
+        FROM per_ticket p
+        LEFT JOIN ticket_facts f USING (ticket_id)
+    ),
+    facts AS (
+        INSERT INTO ticket_facts AS f (ticket_id, created_at, category, channel, status, status_at,
+                                       first_response_at, closed_at)
+        SELECT ticket_id, created_at, category, channel, status, status_at,
+               coalesce(prev_response, responded_at), coalesce(prev_closed, closed_at)
+        FROM merged
+        ON CONFLICT (ticket_id) DO UPDATE
+            SET category = EXCLUDED.category,
+                channel = EXCLUDED.channel,
+                -- Опоздавшая транзакция не должна откатить статус назад
+                status = CASE WHEN EXCLUDED.status_at >= f.status_at THEN EXCLUDED.status ELSE f.status END,
+                status_at = greatest(f.status_at, EXCLUDED.status_at),
+                first_response_at = EXCLUDED.first_response_at,
+                closed_at = EXCLUDED.closed_at
+    ),
+    sla AS (
+        SELECT date_trunc('hour', responded_at) AS hour, category, channel,
+               greatest(extract(epoch FROM responded_at - created_at), 0)::float8 AS response_s,
+               NULL::float8 AS close_s
+        FROM merged
+        WHERE prev_response IS NULL AND responded_at IS NOT NULL
+        UNION ALL
+        SELECT date_trunc('hour', closed_at), category, channel,
+               NULL, greatest(extract(epoch FROM closed_at - created_at), 0)::float8
+        FROM merged
+        WHERE prev_closed IS NULL AND closed_at IS NOT NULL
+    ),
+    sla_upsert AS (
+        INSERT INTO analytics_sla_hourly AS s (hour, category, channel,
+                                               first_responses, first_response_seconds, first_response_max,
+                                               closed, close_seconds, close_max)
+        SELECT hour, category, channel,
+               count(response_s), coalesce(sum(response_s), 0), max(response_s),
+               count(close_s), coalesce(sum(close_s), 0), max(close_s)
+        FROM sla
+        GROUP BY 1, 2, 3
+        ON CONFLICT (hour, category, channel) DO UPDATE
+            SET first_responses = s.first_responses + EXCLUDED.first_responses,
+                first_response_seconds = s.first_response_seconds + EXCLUDED.first_response_seconds,
+                first_response_max = greatest(s.first_response_max, EXCLUDED.first_response_max),
+                closed = s.closed + EXCLUDED.closed,
+                close_seconds = s.close_seconds + EXCLUDED.close_seconds,
+                close_max = greatest(s.close_max, EXCLUDED.close_max)
+    )
+    SELECT count(*) FROM batch
+""")
+
+
+class AnalyticsRefresher:
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        refresh_seconds: float = settings.ANALYTICS_REFRESH_SECONDS,
+        batch_size: int = settings.ANALYTICS_BATCH_SIZE,
+    ):
+        self.session_factory = session_factory
+        self.refresh_seconds = refresh_seconds
+        self.batch_size = batch_size
+        self.refreshed_at: Optional[datetime] = None
+        self._lock = threading.Lock()
+        self._stats = {"runs": 0, "events": 0, "skipped": 0, "errors": 0, "last_duration_ms": 0.0}
+        self._task: Optional[asyncio.Task] = None
+
+    def refresh_batch(self) -> Optional[int]:
+        """Разбирает одну пачку журнала. None — пачку сейчас разбирает другой процесс."""
+        with self.session_factory() as db:
+            if not db.execute(text("SELECT pg_try_advisory_xact_lock(:id)"), {"id": _LOCK_ID}).scalar():
+                db.rollback()
+                return None
+            processed = db.execute(
+                _REFRESH_SQL, {"settle": float(settings.ANALYTICS_SETTLE_SECONDS), "batch": self.batch_size}
+            ).scalar()
+            db.commit()
+            return processed
+
+    def refresh(self) -> int:
+        """Разбирает журнал, пока пачки полные. Возвращает число учтённых событий."""
+        started = time.perf_counter()
+        total = 0
+        while True:
+            processed = self.refresh_batch()
+            if processed is None:
+                with self._lock:
+                    self._stats["skipped"] += 1
+                break
+            total += processed
+            if processed < self.batch_size:
+                break
+        with self._lock:
+            self._stats["runs"] += 1
+            self._stats["events"] += total
+            self._stats["last_duration_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        self.refreshed_at = datetime.now(timezone.utc)
+        return total
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        return {**stats, "refreshed_at": self.refreshed_at}
+
+    # ---------- фоновый цикл ----------
+    def start(self) -> None:
+        if settings.ANALYTICS_ENABLED:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                processed = await to_thread.run_sync(self.refresh)
+                if processed:
+                    logger.debug("Аналитика заявок: учтено событий %d", processed)
+            except Exception:
+                with self._lock:
+                    self._stats["errors"] += 1
+                logger.exception("Не удалось обновить аналитику заявок")
+            await asyncio.sleep(self.refresh_seconds)
+
+
+refresher = AnalyticsRefresher()
@@ -0,0 +1,232 @@
+"""
+Память диалогов AI-чата.
+
+Промпт собирается из частей, которые не пересчитываются на каждой реплике:
+- SYSTEM_PROMPT — неизменный префикс;
+- профиль клиента — из client_cache, деньги всегда свежие;
+- открытые заявки и последние платежи — кэшируются в сессии на CHAT_CONTEXT_TTL_SECONDS;
+- summary — свёрнутые старые реплики;
+- последние реплики в пределах CHAT_HISTORY_TOKEN_BUDGET.
+Когда несвёрнутая история превышает CHAT_SUMMARY_TRIGGER_TOKENS, старые реплики
+сворачиваются моделью в фоне, так что размер промпта не растёт вместе с диалогом.
+"""
+import asyncio
+import logging
+import uuid
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from fastapi import HTTPException
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..models import ChatMessage, ChatSession, Payment, Ticket
+from . import ai_gateway
+from .ai_gateway import count_tokens
+from .db import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MODEL = "gpt-3.5-turbo"
+
+SYSTEM_PROMPT = (
+    "Ты персональный ассистент сервисного портала. "
+    "Отвечай кратко и по делу на русском языке, будь вежливым и профессиональным. "
+    "Используй только факты из предоставленных данных. "
+    "Если клиент спрашивает о балансе или платежах, называй конкретные цифры. "
+    "Если вопрос про заявки, опирайся на их статус из данных клиента."
+)
+
+SUMMARY_PROMPT = (
+    "Сожми диалог клиента с ассистентом сервисного портала в краткое содержание "
+    "на русском языке: о чём спрашивал клиент, какие факты и обещания прозвучали, "
+    "что осталось нерешённым. Не больше 5 предложений."
+)
+
+# Сколько последних сообщений читать из БД для окна истории
+_HISTORY_FETCH_LIMIT = 50
+
+_summarizing = set()
+_tasks = set()
+
+
+def _age_seconds(moment: Optional[datetime]) -> float:
+    if moment is None:
+        return float("inf")
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return (datetime.now(timezone.utc) - moment).total_seconds()
+
+
+async def get_session(db: AsyncSession, client_id: int, session_id: Optional[str] = None) -> ChatSession:
+    """Сессия клиента по id или новая (сразу сохраняется), если id не передан."""
+    if session_id:
+        session = await db.get(ChatSession, session_id)
+        if session is None or session.client_id != client_id:
+            raise HTTPException(status_code=404, detail="Сессия чата не найдена")
+        return session
+
+    session = ChatSession(id=str(uuid.uuid4()), client_id=client_id, summarized_until=0)
+    db.add(session)
+    await db.commit()
+    return session
+
+
+def _profile_block(profile: dict) -> str:
+    return (
+        f"Клиент: {profile['full_name']}\n"
+        f"- Тариф: {profile['tariff'] or 'не указан'}\n"
+        f"- Баланс: {profile['balance']}₸\n"
+        f"- Долг: {profile['debt']}₸"
+    )
+
+
+async def _account_block(db: AsyncSession, session: ChatSession, profile: dict) -> str:
+    """Открытые заявки и последние платежи; пересобирается раз в CHAT_CONTEXT_TTL_SECONDS."""
+    if session.context is not None and _age_seconds(session.context_built_at) < settings.CHAT_CONTEXT_TTL_SECONDS:
+        return session.context
+
+    tickets = (await db.execute(
+        select(Ticket.id, Ticket.subject, Ticket.category, Ticket.status, Ticket.created_at)
+        .where(Ticket.client_phone == profile["phone"])
+        .where(Ticket.status != "closed")
+        .order_by(Ticket.created_at.desc())
+        .limit(5)
+    )).all()
+    payments = (await db.execute(
+        select(Payment.amount, Payment.date, Payment.service, Payment.status)
+        .where(Payment.client_id == profile["id"])
+        .order_by(Payment.date.desc())
+        .limit(5)
+    )).all()
+
+    lines = ["Открытые заявки:"]
+    lines += [
+        f"- #{t.id} {t.subject or 'без темы'} ({t.category or 'без категории'}), статус {t.status}, "
+        f"от {t.created_at:%d.%m.%Y}"
+        for t in tickets
+    ] or ["- нет"]
+    lines.append("Последние платежи:")
+    lines += [
+        f"- {p.date:%d.%m.%Y}: {p.amount}₸ за {p.service or 'услуги'} ({p.status})"
+        for p in payments
+    ] or ["- нет"]
+
+    session.context = "\n".join(lines)
+    session.context_built_at = datetime.now(timezone.utc)
+    return session.context
+
+
+async def _history(db: AsyncSession, session: ChatSession) -> List[dict]:
+    """Несвёрнутые реплики от новых к старым, пока влезают в бюджет токенов."""
+    rows = (await db.execute(
+        select(ChatMessage.role, ChatMessage.content, ChatMessage.tokens)
+        .where(ChatMessage.session_id == session.id)
+        .where(ChatMessage.id > session.summarized_until)
+        .order_by(ChatMessage.id.desc())
+        .limit(_HISTORY_FETCH_LIMIT)
+    )).all()
+    budget = settings.CHAT_HISTORY_TOKEN_BUDGET
+    window = []
+    for row in rows:
+        if row.tokens > budget:
+            break
+        budget -= row.tokens
+        window.append({"role": row.role, "content": row.content})
+    return window[::-1]
+
+
+async def build_messages(db: AsyncSession, session: ChatSession, profile: dict, message: str) -> List[dict]:
+    """
+    Сообщения для модели. Изменения кэша контекста остаются в db —
+    вызывающий код коммитит их вместе с репликами.
+    """
+    context = _profile_block(profile) + "\n" + await _account_block(db, session, profile)
+    messages = [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "system", "content": "Данные клиента:\n" + context},
+    ]
+    if session.summary:
+        messages.append({"role": "system", "content": "Краткое содержание разговора ранее:\n" + session.summary})
+    messages += await _history(db, session)
+    messages.append({"role": "user", "content": message})
+    return messages
+
+
+async def record_turn(db: AsyncSession, session_id: str, user_text: str, assistant_text: str) -> None:
+    """Сохраняет вопрос и ответ и запускает сворачивание истории, если она разрослась."""
+    db.add_all([
+        ChatMessage(session_id=session_id, role="user", content=user_text, tokens=count_tokens(user_text)),
+        ChatMessage(session_id=session_id, role="assistant", content=assistant_text,
+                    tokens=count_tokens(assistant_text)),
+    ])
+    await db.execute(update(ChatSession).where(ChatSession.id == session_id).values(updated_at=func.now()))
+    await db.commit()
+    schedule_summary(session_id)
+
+
+def schedule_summary(session_id: str) -> None:
+    if session_id in _summarizing:
+        return
+    task = asyncio.create_task(summarize(session_id))
+    # Держим ссылку, иначе задачу может собрать GC
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def summarize(session_id: str) -> None:
+    """Сворачивает старые реплики сессии в summary, оставляя CHAT_KEEP_RECENT_MESSAGES последних."""
+    _summarizing.add(session_id)
+    try:
+        # Чтение и запись — в разных сессиях: соединение из пула не занято,
+        # пока модель (max_wait=None) стоит в очереди и отвечает
+        async with AsyncSessionLocal() as db:
+            session = await db.get(ChatSession, session_id)
+            if session is None:
+                return
+            summarized_until, previous = session.summarized_until, session.summary
+            rows = (await db.execute(
+                select(ChatMessage.id, ChatMessage.role, ChatMessage.content, ChatMessage.tokens)
+                .where(ChatMessage.session_id == session_id)
+                .where(ChatMessage.id > summarized_until)
+                .order_by(ChatMessage.id)
+            )).all()
+        if sum(r.tokens for r in rows) <= settings.CHAT_SUMMARY_TRIGGER_TOKENS:
+            return
+        fold = rows[:-settings.CHAT_KEEP_RECENT_MESSAGES] if settings.CHAT_KEEP_RECENT_MESSAGES else rows
+        if not fold:
+            return
+
+        dialog = "\n".join(
+            f"{'Клиент' if r.role == 'user' else 'Ассистент'}: {r.content}" for r in fold
+        )
+        if previous:
+            dialog = f"Ранее: {previous}\n\n{dialog}"
+        # Фоновая задача: ждём очередь к модели без ограничения, в лимит клиента не входит
+        response, _ = await ai_gateway.chat_completion(
+            model=SUMMARY_MODEL,
+            messages=[
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {"role": "user", "content": dialog},
+            ],
+            temperature=0,
+            max_tokens=300,
+            max_wait=None,
+            log_action="chat_summary",
+        )
+        summary = response.choices[0].message.content.strip()
+
+        # Условие на summarized_until защищает от гонки с другим процессом
+        async with AsyncSessionLocal() as db:
+            await db.execute(
+                update(ChatSession)
+                .where(ChatSession.id == session_id)
+                .where(ChatSession.summarized_until == summarized_until)
+                .values(summary=summary, summarized_until=fold[-1].id)
+            )
+            await db.commit()
+    except Exception:
+        logger.exception("Не удалось свернуть историю чата %s", session_id)
+    finally:
+        _summarizing.discard(session_id)
@@ -0,0 +1,205 @@
+"""
+Кэш профиля клиента по телефону.
+
+Уровни: TTL-кэш в памяти процесса и, если задан CLIENT_CACHE_REDIS_URL,
+общий Redis. Любой commit, меняющий Client или Payment через ORM, сбрасывает
+запись клиента (события сессии ниже). «Клиент не найден» не кэшируется, поэтому
+новый клиент виден сразу после регистрации.
+Денежные поля (balance, debt) не отдаются старше CLIENT_CACHE_MONEY_MAX_AGE_SECONDS:
+такая запись перечитывается из БД, даже если TTL ещё не истёк. Поэтому
+локальные уровни других процессов, которые не видят чужой commit, могут
+отставать не больше TTL по остальным полям и не больше этой границы по деньгам.
+"""
+import json
+import logging
+import threading
+import time
+from typing import Optional
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy import event, inspect, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models import Client, Payment
+from .cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+PROFILE_FIELDS = ("id", "full_name", "phone", "email", "tariff", "services", "balance", "debt", "created_at")
+
+_local = TTLCache(maxsize=settings.CLIENT_CACHE_MAX_ENTRIES, ttl=settings.CLIENT_CACHE_TTL_SECONDS)
+_phone_by_id = {}
+_lock = threading.Lock()
+_stats = {
+    "hits": 0,
+    "shared_hits": 0,
+    "db_loads": 0,
+    "money_refreshes": 0,
+    "invalidations": 0,
+    "served": 0,
+    "served_age_total": 0.0,
+    "served_age_max": 0.0,
+}
+
+_redis = None
+if settings.CLIENT_CACHE_REDIS_URL:
+    try:
+        import redis
+
+        _redis = redis.Redis.from_url(settings.CLIENT_CACHE_REDIS_URL, socket_timeout=0.2)
+    except ImportError:
+        logger.warning("CLIENT_CACHE_REDIS_URL задан, но пакет redis не установлен — общий уровень выключен")
+
+
+def _redis_key(phone: str) -> str:
+    return f"client_profile:{phone}"
+
+
+def _to_profile(client: Client) -> dict:
+    return {field: getattr(client, field) for field in PROFILE_FIELDS}
+
+
+def _remember(profile: dict, cached_at: float) -> None:
+    _local.set(profile["phone"], (cached_at, profile))
+    with _lock:
+        # Карта id -> телефон нужна, чтобы сбрасывать кэш по Payment.client_id.
+        # Если она разрослась, её проще очистить: записи всё равно ограничены TTL.
+        if len(_phone_by_id) > 2 * settings.CLIENT_CACHE_MAX_ENTRIES:
+            _phone_by_id.clear()
+        _phone_by_id[profile["id"]] = profile["phone"]
+
+
+def _shared_get(phone: str) -> Optional[tuple]:
+    try:
+        raw = _redis.get(_redis_key(phone))
+    except Exception as e:
+        logger.warning("Redis недоступен: %s", e)
+        return None
+    if raw is None:
+        return None
+    data = json.loads(raw)
+    return data["cached_at"], data["profile"]
+
+
+def _shared_set(profile: dict, cached_at: float) -> None:
+    try:
+        _redis.set(
+            _redis_key(profile["phone"]),
+            json.dumps({"cached_at": cached_at, "profile": profile}, default=str, ensure_ascii=False),
+            ex=settings.CLIENT_CACHE_TTL_SECONDS,
+        )
+    except Exception as e:
+        logger.warning("Redis недоступен: %s", e)
+
+
+def _served(cached_at: float, from_cache: bool) -> None:
+    age = time.time() - cached_at
+    with _lock:
+        _stats["hits"] += from_cache
+        _stats["served"] += 1
+        _stats["served_age_total"] += age
+        _stats["served_age_max"] = max(_stats["served_age_max"], age)
+
+
+async def get_profile(db: AsyncSession, phone: str, need_money: bool = True) -> Optional[dict]:
+    """
+    Профиль клиента (dict с полями PROFILE_FIELDS) или None.
+    need_money=False — вызывающему не нужны balance/debt, граница свежести денег не применяется.
+    """
+    entry = _local.get(phone)
+    if entry is None and _redis is not None:
+        entry = await run_in_threadpool(_shared_get, phone)
+        if entry is not None:
+            with _lock:
+                _stats["shared_hits"] += 1
+            _remember(entry[1], entry[0])
+
+    if entry is not None:
+        cached_at, profile = entry
+        if not need_money or time.time() - cached_at <= settings.CLIENT_CACHE_MONEY_MAX_AGE_SECONDS:
+            _served(cached_at, from_cache=True)
+            return profile
+        with _lock:
+            _stats["money_refreshes"] += 1
+
+    client = (await db.execute(select(Client).where(Client.phone == phone))).scalar_one_or_none()
+    with _lock:
+        _stats["db_loads"] += 1
+    if client is None:
+        return None
+
+    profile = _to_profile(client)
+    cached_at = time.time()
+    _remember(profile, cached_at)
+    if _redis is not None:
+        await run_in_threadpool(_shared_set, profile, cached_at)
+    _served(cached_at, from_cache=False)
+    return profile
+
+
+def invalidate(phone: str) -> None:
+    _local.delete(phone)
+    if _redis is not None:
+        try:
+            _redis.delete(_redis_key(phone))
+        except Exception as e:
+            logger.warning("Redis недоступен: %s", e)
+    with _lock:
+        _stats["invalidations"] += 1
+
+
+def invalidate_client_id(client_id: int) -> None:
+    with _lock:
+        phone = _phone_by_id.pop(client_id, None)
+    if phone:
+        invalidate(phone)
+
+
+def stats() -> dict:
+    with _lock:
+        snapshot = dict(_stats)
+    served = snapshot.pop("served")
+    age_total = snapshot.pop("served_age_total")
+    lookups = snapshot["hits"] + snapshot["db_loads"]
+    snapshot.update({
+        "local": _local.stats(),
+        "shared_enabled": _redis is not None,
+        "hit_ratio": round(snapshot["hits"] / lookups, 4) if lookups else 0.0,
+        "served_age_avg": round(age_total / served, 3) if served else 0.0,
+        "served_age_max": round(snapshot["served_age_max"], 3),
+        "money_max_age": settings.CLIENT_CACHE_MONEY_MAX_AGE_SECONDS,
+    })
+    return snapshot
+
+
+# ----------------------------
+# Инвалидация по событиям ORM-сессии
+# ----------------------------
+@event.listens_for(Session, "after_flush")
+def _collect_changes(session, flush_context):
+    pending = session.info.setdefault("client_cache_invalidate", (set(), set()))
+    phones, client_ids = pending
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Client):
+            phones.add(obj.phone)
+            # Телефон мог измениться — старую запись тоже сбрасываем
+            history = inspect(obj).attrs.phone.history
+            phones.update(p for p in history.deleted if p)
+        elif isinstance(obj, Payment):
+            client_ids.add(obj.client_id)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_committed(session):
+    phones, client_ids = session.info.pop("client_cache_invalidate", (set(), set()))
+    for phone in phones:
+        invalidate(phone)
+    for client_id in client_ids:
+        invalidate_client_id(client_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changes(session):
+    session.info.pop("client_cache_invalidate", None)
@@ -0,0 +1,59 @@
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+# Вся история клиента по заявке — одним запросом: клиент через LEFT JOIN,
+# последние платежи и заявки (с числом комментариев) через LATERAL-подзапросы,
+# каждый из которых берёт индекс (client_id, date) / (client_phone, created_at).
+HISTORY_SQL = text("""
+SELECT
+    t.id AS ticket_id,
+    CASE WHEN c.id IS NULL THEN NULL ELSE json_build_object(
+        'id', c.id,
+        'full_name', c.full_name,
+        'phone', c.phone,
+        'email', c.email,
+        'tariff', c.tariff,
+        'services', c.services,
+        'balance', c.balance,
+        'debt', c.debt,
+        'created_at', c.created_at
+    ) END AS client,
+    COALESCE(p.items, '[]'::json) AS payments,
+    COALESCE(h.items, '[]'::json) AS tickets
+FROM tickets t
+LEFT JOIN clients c ON c.phone = t.client_phone
+LEFT JOIN LATERAL (
+    SELECT json_agg(x ORDER BY x.date DESC, x.id DESC) AS items
+    FROM (
+        SELECT id, amount, date, service, status
+        FROM payments
+        WHERE client_id = c.id
+        ORDER BY date DESC, id DESC
+        LIMIT :limit
+    ) x
+) p ON true
+LEFT JOIN LATERAL (
+    SELECT json_agg(y ORDER BY y.created_at DESC, y.id DESC) AS items
+    FROM (
+        SELECT
+            t2.id, t2.subject, t2.category, t2.status, t2.priority, t2.channel, t2.created_at,
+            (SELECT count(*) FROM comments cm WHERE cm.ticket_id = t2.id) AS comments_count
+        FROM tickets t2
+        WHERE t2.client_phone = t.client_phone
+        ORDER BY t2.created_at DESC, t2.id DESC
+        LIMIT :limit
+    ) y
+) h ON true
+WHERE t.id = :ticket_id
+""")
+
+
+async def load_client_history(db: AsyncSession, ticket_id: int, limit: int = 10) -> Optional[dict]:
+    """
+    Клиент, его последние платежи и заявки по id заявки.
+    None, если заявки нет; client = None, если телефон заявки не принадлежит клиенту.
+    """
+    row = (await db.execute(HISTORY_SQL, {"ticket_id": ticket_id, "limit": limit})).mappings().first()
+    return dict(row) if row else None
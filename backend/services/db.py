@@ -1,23 +1,177 @@
-import os
-from sqlalchemy import create_engine
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional
+from uuid import uuid4
+
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
 from ..config import settings
 
-# Создаём SQLAlchemy Engine на основе настроек из config.py
-print("DATABASE_URL (str):", settings.DATABASE_URL)
-print("DATABASE_URL (bytes):", settings.DATABASE_URL.encode("utf-8", errors="replace"))
-print("DB_USER (repr):", repr(settings.DB_USER))
-print("DB_PASSWORD (repr):", repr(settings.DB_PASSWORD))
-print("DB_HOST (repr):", repr(settings.DB_HOST))
-print("DB_PORT (repr):", repr(settings.DB_PORT))
-print("DB_NAME (repr):", repr(settings.DB_NAME))
+logger = logging.getLogger(__name__)
+
+
+class PoolStats:
+    """Счётчики ожидания соединения из пула."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def observe(self, seconds: float, timed_out: bool = False) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "checkouts": self.checkouts,
+                "timeouts": self.timeouts,
+                "wait_avg_ms": round(self.wait_total / self.checkouts * 1000, 3) if self.checkouts else 0.0,
+                "wait_max_ms": round(self.wait_max * 1000, 3),
+            }
+
+
+pool_stats = PoolStats()
+async_pool_stats = PoolStats()
+
+
+class _TimedPoolMixin:
+    """Замеряет, сколько запрос ждал свободное соединение из пула."""
+    stats: PoolStats
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.stats.observe(time.perf_counter() - started, timed_out=True)
+            raise
+        self.stats.observe(time.perf_counter() - started)
+        return conn
+
+
+class TimedQueuePool(_TimedPoolMixin, QueuePool):
+    stats = pool_stats
 
+
+class TimedAsyncQueuePool(_TimedPoolMixin, AsyncAdaptedQueuePool):
+    stats = async_pool_stats
+
+
+def _engine_options(is_async: bool = False) -> dict:
+    """
+    Параметры пула из Settings.
+    В режиме PgBouncer пулом управляет сам PgBouncer, поэтому на стороне
+    приложения пула нет, а statement_timeout задаётся на транзакцию (SET LOCAL):
+    startup-параметр options через PgBouncer не проходит.
+    """
+    if settings.DB_PGBOUNCER:
+        if is_async:
+            # PgBouncer в transaction mode не переносит кэш prepared statements
+            # между транзакциями, поэтому кэши выключены, а имена уникальны
+            return {
+                "poolclass": NullPool,
+                "connect_args": {
+                    "statement_cache_size": 0,
+                    "prepared_statement_cache_size": 0,
+                    "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+                },
+            }
+        return {"poolclass": NullPool}
+
+    options = {
+        "poolclass": TimedAsyncQueuePool if is_async else TimedQueuePool,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+    }
+    if settings.DB_STATEMENT_TIMEOUT_MS:
+        if is_async:
+            options["connect_args"] = {"server_settings": {"statement_timeout": str(settings.DB_STATEMENT_TIMEOUT_MS)}}
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={settings.DB_STATEMENT_TIMEOUT_MS}"}
+    return options
+
+
+# Создаём SQLAlchemy Engine на основе настроек из config.py.
+# SQL-лог включается только в DEBUG: на нагрузке он заметно ест CPU.
 engine = create_engine(
     settings.DATABASE_URL,
-    echo=True,
-    future=True
+    echo=settings.DEBUG,
+    future=True,
+    **_engine_options()
+)
+
+# Асинхронный движок (asyncpg) для горячих эндпоинтов чтения:
+# запрос не держит поток threadpool, пока ждёт Postgres
+async_engine = create_async_engine(
+    settings.ASYNC_DATABASE_URL,
+    echo=settings.DEBUG,
+    **_engine_options(is_async=True)
 )
 
+if settings.DB_PGBOUNCER and settings.DB_STATEMENT_TIMEOUT_MS:
+    @event.listens_for(engine, "begin")
+    @event.listens_for(async_engine.sync_engine, "begin")
+    def _set_statement_timeout(conn):
+        conn.exec_driver_sql(f"SET LOCAL statement_timeout = {int(settings.DB_STATEMENT_TIMEOUT_MS)}")
+
+logger.info("Database engine: %s", engine.url.render_as_string(hide_password=True))
+
+
+# ----------------------------
+# Учёт запросов в рамках одного HTTP-запроса
+# ----------------------------
+class QueryStats:
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+
+_query_stats: ContextVar[Optional[QueryStats]] = ContextVar("query_stats", default=None)
+
+
+@contextmanager
+def track_queries() -> Iterator[QueryStats]:
+    """
+    Считает SQL-запросы и их суммарное время внутри блока
+    (для sync и async движка, в т.ч. в threadpool — контекст копируется).
+    """
+    stats = QueryStats()
+    token = _query_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _query_stats.reset(token)
+
+
+@event.listens_for(engine, "before_cursor_execute")
+@event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+@event.listens_for(engine, "after_cursor_execute")
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = _query_stats.get()
+    if stats is not None:
+        stats.count += 1
+        stats.duration += time.perf_counter() - context._query_started
+
 # Готовим фабрику сессий
 SessionLocal = sessionmaker(
     bind=engine,
@@ -26,6 +180,12 @@ SessionLocal = sessionmaker(
     future=True
 )
 
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine,
+    autoflush=False,
+    expire_on_commit=False
+)
+
 def get_db():
     """
     Зависимость FastAPI для получения сессии БД.
@@ -36,3 +196,37 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+async def get_async_db():
+    """
+    Асинхронная сессия БД.
+    Использовать так: db: AsyncSession = Depends(get_async_db)
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def pool_metrics() -> dict:
+    """Загрузка пулов (sync и async) и время ожидания соединения."""
+    return {
+        "sync": _pool_metrics(engine.pool, pool_stats),
+        "async": _pool_metrics(async_engine.sync_engine.pool, async_pool_stats),
+    }
+
+
+def _pool_metrics(pool, stats: PoolStats) -> dict:
+    metrics = {"pool": type(pool).__name__, "pgbouncer": settings.DB_PGBOUNCER}
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + settings.DB_MAX_OVERFLOW
+        checked_out = pool.checkedout()
+        metrics.update({
+            "size": pool.size(),
+            "max_overflow": settings.DB_MAX_OVERFLOW,
+            "checked_out": checked_out,
+            "checked_in": pool.checkedin(),
+            "overflow": pool.overflow(),
+            "utilization": round(checked_out / capacity, 4) if capacity else 0.0,
+        })
+    metrics.update(stats.snapshot())
+    return metrics
@@ -0,0 +1,313 @@
+import asyncio
+import logging
+from datetime import timedelta
+from typing import List, Optional, Tuple
+
+from anyio import to_thread
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models import Ticket
+from . import ai_classifier, ai_gateway, ai_log, client_cache, search, templates
+from .ai_classifier import AIResult
+from .ai_gateway import RateLimited
+from .resilience import AIUnavailableError
+from .db import AsyncSessionLocal, SessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+def apply_enrichment(db: Session, ticket: Ticket, category: AIResult, ai_resp: AIResult) -> None:
+    """
+    Записывает результат классификации и ответа в заявку и оба AILog.
+    Коммит остаётся за вызывающим кодом; AILog уйдут в фоновую запись после него.
+    """
+    ticket.category = category.value
+    ticket.category_source = category.source
+    ticket.ai_response = ai_resp.value
+    ticket.enrichment_status = "done"
+
+    # Текст обращения не копируем: он в заявке по ticket_id
+    ai_log.add(
+        db,
+        ai_log.entry(
+            "classify",
+            ticket_id=ticket.id,
+            response_payload={"category": category.value, "source": category.source},
+            confidence=category.confidence,
+            cached=category.cached,
+            **category.log_fields()
+        ),
+        ai_log.entry(
+            "generate_response",
+            ticket_id=ticket.id,
+            response_payload={"response": ai_resp.value, "source": ai_resp.source},
+            cached=ai_resp.cached,
+            **ai_resp.log_fields()
+        ),
+    )
+
+def ticket_fields(ticket: Ticket) -> dict:
+    """Поля заявки для шаблонов ответа."""
+    return {"ticket_id": ticket.id, "subject": ticket.subject, "phone": ticket.client_phone}
+
+
+async def template_reply(category: str, fields: dict) -> Optional[AIResult]:
+    """Ответ шаблоном категории или None, если подходящего шаблона нет."""
+    if not templates.engine.has(category):
+        return None
+    needed = templates.engine.fields(category)
+    values = dict(fields, category=category)
+    if needed & templates.CLIENT_FIELDS and fields.get("phone"):
+        async with AsyncSessionLocal() as db:
+            profile = await client_cache.get_profile(
+                db, fields["phone"], need_money=bool(needed & templates.MONEY_FIELDS)
+            )
+        if profile:
+            values.update({name: profile[name] for name in templates.CLIENT_FIELDS})
+    rendered = templates.engine.render(category, values)
+    return AIResult(rendered.text, source="template") if rendered else None
+
+
+async def reply(
+    text: str,
+    category: Optional[str],
+    fields: dict,
+    phone: Optional[str] = None,
+    force_ai: bool = False,
+) -> AIResult:
+    """Ответ на обращение: шаблон категории, если он подходит, иначе модель."""
+    if category and not force_ai:
+        result = await template_reply(category, fields)
+        if result is not None:
+            return result
+    return await ai_classifier.generate_response(text, phone=phone)
+
+
+async def duplicate_category(text: str) -> Optional[AIResult]:
+    """
+    Категория недавней почти такой же заявки (search.duplicate_candidates).
+    При массовой аварии сотни одинаковых обращений не классифицируются моделью по отдельности.
+    """
+    candidates = search.duplicate_candidates(text)
+    if not candidates:
+        return None
+    async with AsyncSessionLocal() as db:
+        categories = dict((await db.execute(
+            select(Ticket.id, Ticket.category)
+            .where(Ticket.id.in_([ticket_id for ticket_id, _ in candidates]))
+            .where(Ticket.category.isnot(None))
+            .where(Ticket.enrichment_status == "done")
+        )).all())
+    for ticket_id, score in candidates:
+        if ticket_id in categories:
+            return AIResult(categories[ticket_id], confidence=round(score, 4), source="duplicate")
+    return None
+
+
+async def classify_and_reply(text: str, fields: dict, phone: Optional[str] = None) -> Tuple[AIResult, AIResult]:
+    """
+    Категория и ответ. Если шаблонов нет и дубля не нашлось, оба вызова модели идут
+    параллельно; иначе сначала категория (дубль, локально или из кэша), потом шаблон или модель.
+    """
+    category = await duplicate_category(text)
+    if category is None and not templates.engine.active():
+        return await ai_classifier.classify_and_respond(text, phone=phone)
+    if category is None:
+        category = await ai_classifier.classify_text(text, phone=phone)
+    return category, await reply(text, category.value, fields, phone=phone)
+
+
+async def group_replies(text: str, items: List[Tuple[Optional[str], dict]], force_ai: bool = False) -> List[AIResult]:
+    """
+    Ответы группе похожих заявок: items — (категория, поля) каждой заявки.
+    Шаблон подбирается для каждой заявки отдельно, модель вызывается не больше одного раза на группу.
+    """
+    generated = None
+    results = []
+    for category, fields in items:
+        result = None
+        if category and not force_ai:
+            result = await template_reply(category, fields)
+        if result is None:
+            if generated is None:
+                generated = await ai_classifier.generate_response(text)
+            result = generated
+        results.append(result)
+    return results
+
+
+def apply_degraded(db: Session, ticket: Ticket) -> None:
+    """
+    Деградированный режим, когда модель недоступна: категория — если её знает
+    локальный кэш или классификатор, ответ — шаблон категории (или шаблон default).
+    Заявка остаётся pending, полное обогащение сделает воркер.
+    """
+    category = ai_classifier.classify_offline(ticket.text)
+    ticket.category = category.value if category else None
+    ticket.category_source = category.source if category else None
+
+    values = dict(ticket_fields(ticket), category=ticket.category)
+    rendered = None
+    if ticket.category:
+        rendered = templates.engine.render(ticket.category, values)
+    if rendered is None:
+        rendered = templates.engine.render(templates.DEFAULT_CATEGORY, values)
+    ticket.ai_response = rendered.text if rendered else None
+    ticket.enrichment_status = "pending"
+
+
+class EnrichmentWorker:
+    """
+    Фоновый воркер AI-обогащения заявок.
+
+    Очередь хранится в самой таблице tickets (enrichment_status = 'pending'),
+    поэтому переживает рестарт процесса. Заявки забираются через
+    FOR UPDATE SKIP LOCKED, так что воркеры в разных процессах не мешают друг другу.
+    """
+
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        poll_interval: float = settings.ENRICHMENT_POLL_SECONDS,
+        batch_size: int = settings.ENRICHMENT_BATCH_SIZE,
+        max_attempts: int = settings.ENRICHMENT_MAX_ATTEMPTS,
+        lease_seconds: int = settings.ENRICHMENT_LEASE_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def notify(self) -> None:
+        """
+        Будит воркер сразу после сохранения новой заявки.
+        Можно вызывать из любого потока (синхронные роуты работают в threadpool).
+        """
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def _run(self) -> None:
+        while True:
+            if ai_gateway.breaker.is_open():
+                # Модель недоступна — не забираем заявки, чтобы не тратить на них попытки
+                await asyncio.sleep(min(self.poll_interval, max(ai_gateway.breaker.retry_after(), 0.1)))
+                continue
+            try:
+                claimed = await to_thread.run_sync(self._claim)
+            except Exception:
+                logger.exception("Не удалось забрать заявки на обогащение")
+                claimed = []
+
+            # Заявки пачки обогащаются параллельно
+            await asyncio.gather(*(self._process(ticket_id) for ticket_id in claimed))
+
+            if len(claimed) < self.batch_size:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _claim(self) -> List[int]:
+        """
+        Помечает пачку заявок как processing и возвращает их id.
+        Зависшие в processing дольше lease_seconds забираются повторно.
+        """
+        stale_before = func.now() - timedelta(seconds=self.lease_seconds)
+        with self.session_factory() as db:
+            tickets = db.execute(
+                select(Ticket)
+                # Первое условие дублирует второе, но позволяет взять
+                # частичный индекс ix_tickets_enrichment_queue
+                .where(Ticket.enrichment_status.in_(("pending", "processing")))
+                .where(or_(
+                    Ticket.enrichment_status == "pending",
+                    Ticket.updated_at < stale_before,
+                ))
+                .order_by(Ticket.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).scalars().all()
+            for ticket in tickets:
+                ticket.enrichment_status = "processing"
+                ticket.enrichment_attempts += 1
+                ticket.updated_at = func.now()
+            db.commit()
+            return [t.id for t in tickets]
+
+    async def _process(self, ticket_id: int) -> None:
+        # Ошибка одной заявки (например, БД отвалилась на _save) не должна ронять
+        # gather и весь цикл: заявка остаётся в processing и вернётся в очередь по lease
+        try:
+            await self._enrich(ticket_id)
+        except Exception:
+            logger.exception("Не удалось обработать заявку #%s, повторим после lease", ticket_id)
+
+    async def _enrich(self, ticket_id: int) -> None:
+        loaded = await to_thread.run_sync(self._load, ticket_id)
+        if loaded is None:
+            return
+        text, fields = loaded
+        try:
+            category, ai_resp = await classify_and_reply(text, fields)
+        except (AIUnavailableError, RateLimited) as e:
+            # Недоступность модели — не вина заявки, попытку не засчитываем
+            await to_thread.run_sync(self._release, ticket_id, e, False)
+            return
+        except Exception as e:
+            await to_thread.run_sync(self._release, ticket_id, e)
+            return
+        await to_thread.run_sync(self._save, ticket_id, category, ai_resp)
+
+    def _load(self, ticket_id: int) -> Optional[Tuple[str, dict]]:
+        with self.session_factory() as db:
+            ticket = db.get(Ticket, ticket_id)
+            if not ticket or ticket.enrichment_status != "processing":
+                return None
+            return ticket.text, ticket_fields(ticket)
+
+    def _save(self, ticket_id: int, category: AIResult, ai_resp: AIResult) -> None:
+        with self.session_factory() as db:
+            ticket = db.get(Ticket, ticket_id)
+            if not ticket or ticket.enrichment_status != "processing":
+                return
+            apply_enrichment(db, ticket, category, ai_resp)
+            db.commit()
+
+    def _release(self, ticket_id: int, error: Exception, count_attempt: bool = True) -> None:
+        """Возвращает заявку в очередь или помечает failed после max_attempts."""
+        with self.session_factory() as db:
+            ticket = db.get(Ticket, ticket_id)
+            if not ticket:
+                return
+            if not count_attempt:
+                ticket.enrichment_attempts -= 1
+            failed = ticket.enrichment_attempts >= self.max_attempts
+            ticket.enrichment_status = "failed" if failed else "pending"
+            db.commit()
+            logger.warning("Обогащение заявки #%s не удалось (%s): %s",
+                           ticket_id, ticket.enrichment_status, error)
+
+
+worker = EnrichmentWorker()
+
@@ -0,0 +1,319 @@
+"""
+События об изменениях заявок и комментариев для панели оператора (SSE).
+
+Изменения собираются из ORM-сессии (after_flush), как инвалидация в client_cache,
+поэтому роутам не нужно ничего публиковать вручную; Core-запросы (пакетный импорт)
+добавляют события через add(). Подписчики получают событие только после коммита.
+
+Два режима (EVENTS_BACKEND):
+- memory — брокер в процессе; подходит, когда API работает одним процессом;
+- postgres — события уходят через NOTIFY в той же транзакции, что и изменение,
+  и каждый процесс раздаёт их своим подписчикам из LISTEN.
+
+Брокер хранит последние EVENTS_BUFFER_SIZE событий: переподключившийся клиент
+присылает Last-Event-ID и получает пропущенное. Если курсор из другого процесса
+или уже вытеснен из буфера, клиент получает событие reset и перечитывает список.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, List, Optional, Set
+
+from sqlalchemy import event, func, inspect, select
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models import Comment, Ticket
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "ticket_events"
+
+# Поля заявки, по которым фильтруют подписчики; они есть в каждом событии заявки
+FILTER_FIELDS = ("category", "status", "assigned_to", "priority", "channel")
+# Изменения этих полей публикуются; текст ответа не пересылается, только факт изменения
+WATCHED_FIELDS = FILTER_FIELDS + ("ai_response", "enrichment_status")
+
+# Лимит NOTIFY — 8000 байт, оставляем запас
+_NOTIFY_MAX_BYTES = 7000
+
+
+def _ticket_fields(ticket: Ticket) -> dict:
+    return {name: getattr(ticket, name) for name in FILTER_FIELDS}
+
+
+def add(session: Session, type: str, ticket_id: int, **data) -> None:
+    """Событие уйдёт подписчикам после коммита session; при откате — пропадёт."""
+    session.info.setdefault("pending_events", []).append({"type": type, "ticket_id": ticket_id, **data})
+
+
+# ----------------------------
+# Сбор событий из ORM-сессии
+# ----------------------------
+@event.listens_for(Session, "after_flush")
+def _collect_events(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, Ticket):
+            add(session, "ticket.created", obj.id, **_ticket_fields(obj))
+        elif isinstance(obj, Comment):
+            add(session, "comment.created", obj.ticket_id, comment_id=obj.id, author=obj.author)
+
+    for obj in session.dirty:
+        if not isinstance(obj, Ticket):
+            continue
+        state = inspect(obj)
+        changed, changes = set(), {}
+        for name in WATCHED_FIELDS:
+            history = state.attrs[name].history
+            if not history.has_changes():
+                continue
+            new = getattr(obj, name)
+            if not history.deleted:
+                # Атрибут не был загружен до присваивания — старое значение неизвестно
+                changed.add(name)
+                continue
+            old = history.deleted[0]
+            if name == "ai_response":
+                old, new = old is not None, new is not None
+            if old != new or name == "ai_response":
+                changed.add(name)
+                changes[name] = [old, new]
+        # Взятие заявки воркером в работу операторам неинтересно
+        if not changed or (changed == {"enrichment_status"}
+                           and obj.enrichment_status in ("pending", "processing")):
+            continue
+        add(session, "ticket.updated", obj.id, changed=sorted(changed), changes=changes, **_ticket_fields(obj))
+
+
+@event.listens_for(Session, "before_commit")
+def _notify_in_transaction(session):
+    if settings.EVENTS_BACKEND != "postgres" or not session.info.get("pending_events"):
+        return
+    # Последний flush ещё не случился — before_commit вызывается до него
+    session.flush()
+    pending = session.info.pop("pending_events", [])
+    # NOTIFY доставляется только после коммита и пропадает при откате
+    for chunk in _chunks(pending):
+        session.connection().execute(select(func.pg_notify(CHANNEL, chunk)))
+
+
+@event.listens_for(Session, "after_commit")
+def _publish_committed(session):
+    pending = session.info.pop("pending_events", None)
+    if pending:
+        broker.publish_threadsafe(pending)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_events(session):
+    session.info.pop("pending_events", None)
+
+
+def _chunks(items: List[dict]) -> Iterable[str]:
+    chunk, size = [], 2
+    for item in items:
+        encoded = json.dumps(item, ensure_ascii=False, default=str)
+        if chunk and size + len(encoded.encode()) + 1 > _NOTIFY_MAX_BYTES:
+            yield "[" + ",".join(chunk) + "]"
+            chunk, size = [], 2
+        chunk.append(encoded)
+        size += len(encoded.encode()) + 1
+    if chunk:
+        yield "[" + ",".join(chunk) + "]"
+
+
+# ----------------------------
+# Брокер и подписки
+# ----------------------------
+@dataclass
+class Event:
+    id: int
+    type: str
+    ticket_id: Optional[int]
+    data: dict
+    ts: float = field(default_factory=time.time)
+
+
+@dataclass
+class Filters:
+    types: Optional[Set[str]] = None  # ticket.created, ticket.updated, comment.created
+    ticket_id: Optional[int] = None
+    values: Dict[str, str] = field(default_factory=dict)  # category=..., status=... из FILTER_FIELDS
+
+    def matches(self, event: Event) -> bool:
+        # reset касается всех: что бы подписчик ни фильтровал, его картина устарела
+        if event.type == "reset":
+            return True
+        if self.types and event.type not in self.types:
+            return False
+        if self.ticket_id is not None and event.ticket_id != self.ticket_id:
+            return False
+        changes = event.data.get("changes", {})
+        for name, expected in self.values.items():
+            # Поля нет в событии (комментарий, пакетное обновление) — не отсекаем
+            if name not in event.data:
+                continue
+            # Заявка, ушедшая из фильтра (была status=new, стала closed), тоже интересна подписчику
+            if event.data[name] != expected and expected not in changes.get(name, ()):
+                return False
+        return True
+
+
+class Subscription:
+    def __init__(self, filters: Filters, queue_size: int):
+        self.filters = filters
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+    def offer(self, event: Event) -> bool:
+        """Кладёт событие в очередь; False, если подписчик не успевает читать."""
+        try:
+            self.queue.put_nowait(event)
+            return True
+        except asyncio.QueueFull:
+            self.overflowed = True
+            return False
+
+
+class Broker:
+    def __init__(
+        self,
+        buffer_size: int = settings.EVENTS_BUFFER_SIZE,
+        queue_size: int = settings.EVENTS_QUEUE_SIZE,
+    ):
+        # Курсоры другого процесса или до рестарта не подходят — отличаем их по epoch
+        self.epoch = uuid.uuid4().hex[:8]
+        self.queue_size = queue_size
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self._next_id = 1
+        self._subscribers: Set[Subscription] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._stats = {"published": 0, "delivered": 0, "dropped_subscribers": 0, "resets": 0}
+
+    def cursor(self, event: Event) -> str:
+        return f"{self.epoch}-{event.id}"
+
+    # ---------- публикация ----------
+    def publish_threadsafe(self, items: List[dict]) -> None:
+        """Можно вызывать из любого потока; без запущенного брокера (CLI, скрипты) события теряются."""
+        if self._loop is None or self._loop.is_closed():
+            return
+        if settings.EVENTS_BACKEND == "postgres":
+            # Свои события придут через LISTEN вместе с чужими
+            return
+        self._loop.call_soon_threadsafe(self._dispatch, items)
+
+    def _dispatch(self, items: List[dict]) -> None:
+        for item in items:
+            item = dict(item)
+            event = Event(self._next_id, item.pop("type"), item.pop("ticket_id", None), item)
+            self._next_id += 1
+            self._buffer.append(event)
+            self._stats["published"] += 1
+            for sub in list(self._subscribers):
+                if not sub.filters.matches(event):
+                    continue
+                if sub.offer(event):
+                    self._stats["delivered"] += 1
+                else:
+                    # Медленный клиент отключается и догоняет по Last-Event-ID
+                    self._subscribers.discard(sub)
+                    self._stats["dropped_subscribers"] += 1
+
+    # ---------- подписка ----------
+    def subscribe(self, filters: Filters, last_event_id: Optional[str] = None) -> Subscription:
+        """
+        Новая подписка. Если передан курсор, пропущенные события из буфера сразу
+        кладутся в очередь; если их уже не восстановить — первым придёт reset.
+        """
+        sub = Subscription(filters, self.queue_size)
+        if last_event_id:
+            missed = self._since(last_event_id)
+            if missed is None:
+                self._stats["resets"] += 1
+                sub.offer(Event(0, "reset", None, {"reason": "cursor_expired"}))
+            else:
+                for event in missed:
+                    if filters.matches(event) and not sub.offer(event):
+                        sub.queue = asyncio.Queue(maxsize=self.queue_size)
+                        sub.overflowed = False
+                        sub.offer(Event(0, "reset", None, {"reason": "too_many_missed"}))
+                        self._stats["resets"] += 1
+                        break
+        self._subscribers.add(sub)
+        return sub
+
+    def unsubscribe(self, sub: Subscription) -> None:
+        self._subscribers.discard(sub)
+
+    def _since(self, cursor: str) -> Optional[List[Event]]:
+        epoch, _, raw_id = cursor.partition("-")
+        if epoch != self.epoch or not raw_id.isdigit():
+            return None
+        last_id = int(raw_id)
+        if self._buffer and last_id < self._buffer[0].id - 1:
+            return None
+        return [e for e in self._buffer if e.id > last_id]
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "backend": settings.EVENTS_BACKEND,
+            "subscribers": len(self._subscribers),
+            "buffered": len(self._buffer),
+            "last_id": self._next_id - 1,
+        }
+
+    # ---------- жизненный цикл ----------
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        if settings.EVENTS_BACKEND == "postgres":
+            self._listener = asyncio.create_task(self._listen())
+
+    async def stop(self) -> None:
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        self._loop = None
+
+    async def _listen(self) -> None:
+        """LISTEN на отдельном соединении asyncpg, с переподключением."""
+        import asyncpg
+
+        def on_notify(connection, pid, channel, payload):
+            try:
+                self._dispatch(json.loads(payload))
+            except Exception:
+                logger.exception("Некорректное событие из NOTIFY")
+
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(settings.DATABASE_URL)
+                await conn.add_listener(CHANNEL, on_notify)
+                logger.info("Подписка на события заявок (LISTEN %s)", CHANNEL)
+                while not conn.is_closed():
+                    await asyncio.sleep(settings.EVENTS_HEARTBEAT_SECONDS)
+                    await conn.execute("SELECT 1")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Соединение LISTEN потеряно: %s", e)
+            finally:
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            # Пока соединения не было, события могли потеряться — подписчики перечитают список
+            self._dispatch([{"type": "reset", "reason": "listener_reconnected"}])
+            await asyncio.sleep(1)
+
+
+broker = Broker()
@@ -0,0 +1,230 @@
+"""
+Локальный классификатор обращений (мультиномиальный наивный Байес).
+
+Обучается только на разметке OpenAI (AILog с action='classify') и категориях,
+которые поставил оператор, — не на собственных предсказаниях. Отвечает за
+микросекунды; если уверенность ниже порога, ai_classifier уходит в OpenAI.
+
+Переобучение и отчёт по точности/задержке:
+    python -m backend.services.local_classifier retrain
+    python -m backend.services.local_classifier report
+"""
+import argparse
+import hashlib
+import json
+import logging
+import math
+import os
+import re
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+")
+_STEM_LEN = 5
+
+
+def tokenize(text: str) -> List[str]:
+    """
+    Слова, их грубые «основы» (первые 5 букв — хватает для русских окончаний)
+    и биграммы основ.
+    """
+    words = _WORD_RE.findall(text.lower().replace("ё", "е"))
+    stems = [w[:_STEM_LEN] for w in words]
+    features = words + [f"~{s}" for s in stems if len(s) >= 3]
+    features += [f"{a}_{b}" for a, b in zip(stems, stems[1:])]
+    return features
+
+
+class LocalClassifier:
+    """Мультиномиальный наивный Байес со сглаживанием Лапласа."""
+
+    def __init__(self, class_docs: Dict[str, int], feature_counts: Dict[str, Dict[str, int]], alpha: float = 1.0):
+        self.class_docs = class_docs
+        self.feature_counts = feature_counts
+        self.alpha = alpha
+        self._prepare()
+
+    def _prepare(self) -> None:
+        vocab = set()
+        for counts in self.feature_counts.values():
+            vocab.update(counts)
+        total_docs = sum(self.class_docs.values())
+        self._priors = {c: math.log(n / total_docs) for c, n in self.class_docs.items()}
+        self._totals = {
+            c: sum(self.feature_counts.get(c, {}).values()) + self.alpha * len(vocab)
+            for c in self.class_docs
+        }
+        self._vocab = vocab
+
+    @classmethod
+    def train(cls, samples: Iterable[Tuple[str, str]], alpha: float = 1.0) -> "LocalClassifier":
+        class_docs: Counter = Counter()
+        feature_counts: Dict[str, Counter] = defaultdict(Counter)
+        for text, label in samples:
+            class_docs[label] += 1
+            feature_counts[label].update(tokenize(text))
+        if not class_docs:
+            raise ValueError("No training samples")
+        return cls(dict(class_docs), {c: dict(f) for c, f in feature_counts.items()}, alpha)
+
+    def predict(self, text: str) -> Tuple[str, float]:
+        """
+        Категория и апостериорная вероятность (0..1). Если ни одного признака
+        нет в словаре, уверенность 0: остались бы одни априорные вероятности.
+        """
+        features = [f for f in tokenize(text) if f in self._vocab]
+        if not features:
+            return max(self._priors, key=self._priors.get), 0.0
+        scores = {}
+        for label, prior in self._priors.items():
+            counts = self.feature_counts.get(label, {})
+            total = self._totals[label]
+            scores[label] = prior + sum(
+                math.log((counts.get(f, 0) + self.alpha) / total) for f in features
+            )
+        best = max(scores, key=scores.get)
+        norm = sum(math.exp(s - scores[best]) for s in scores.values())
+        return best, 1.0 / norm
+
+    def to_dict(self) -> dict:
+        return {"class_docs": self.class_docs, "feature_counts": self.feature_counts, "alpha": self.alpha}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "LocalClassifier":
+        return cls(data["class_docs"], data["feature_counts"], data.get("alpha", 1.0))
+
+    def save(self, path: str) -> None:
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: str) -> "LocalClassifier":
+        with open(path, encoding="utf-8") as f:
+            return cls.from_dict(json.load(f))
+
+
+def load_default() -> Optional[LocalClassifier]:
+    """Модель из LOCAL_CLASSIFIER_PATH или None, если она выключена или не обучена."""
+    from ..config import settings
+
+    if not settings.LOCAL_CLASSIFIER_ENABLED or not os.path.exists(settings.LOCAL_CLASSIFIER_PATH):
+        return None
+    try:
+        return LocalClassifier.load(settings.LOCAL_CLASSIFIER_PATH)
+    except Exception as e:
+        logger.warning("Не удалось загрузить локальный классификатор: %s", e)
+        return None
+
+
+def load_training_data(db) -> List[Tuple[str, str]]:
+    """
+    Размеченные тексты: ответы OpenAI из AILog (classify) и категории заявок,
+    поставленные оператором. Предсказания local/duplicate не берутся — иначе модель
+    учится на самой себе. Дубликаты по тексту схлопываются, приоритет у оператора.
+    """
+    from ..models import AILog, Ticket
+    from .ai_classifier import ALLOWED_CATEGORIES
+
+    samples: Dict[str, Tuple[str, str]] = {}
+    # Новые записи не копируют текст в request_payload — он берётся из заявки
+    logs = (
+        db.query(AILog.request_payload, AILog.response_payload, Ticket.text)
+        .outerjoin(Ticket, Ticket.id == AILog.ticket_id)
+        .filter(AILog.action == "classify")
+    )
+    for log in logs:
+        text = (log.request_payload or {}).get("text") or log.text
+        response = log.response_payload or {}
+        label = response.get("category")
+        # Записи до появления локального классификатора source не несут — это OpenAI
+        if response.get("source", "openai") != "openai":
+            continue
+        if text and label in ALLOWED_CATEGORIES:
+            samples[text.strip().lower()] = (text, label)
+    operator_labels = (
+        db.query(Ticket.text, Ticket.category)
+        .filter(Ticket.category.isnot(None), Ticket.category_source == "operator")
+    )
+    for text, label in operator_labels:
+        if label in ALLOWED_CATEGORIES:
+            samples[text.strip().lower()] = (text, label)
+    return list(samples.values())
+
+
+def _split(samples: List[Tuple[str, str]], holdout: float) -> Tuple[list, list]:
+    """Детерминированное разбиение по хэшу текста, чтобы отчёты были сравнимы."""
+    train, test = [], []
+    for sample in samples:
+        bucket = int(hashlib.md5(sample[0].encode("utf-8")).hexdigest(), 16) % 1000
+        (test if bucket < holdout * 1000 else train).append(sample)
+    return train, test
+
+
+def report(model: LocalClassifier, samples: List[Tuple[str, str]], threshold: float) -> dict:
+    """Точность, покрытие на пороге и задержка предсказания."""
+    latencies, correct, confident, confident_correct = [], 0, 0, 0
+    per_class: Dict[str, Counter] = defaultdict(Counter)
+    for text, label in samples:
+        started = time.perf_counter()
+        predicted, confidence = model.predict(text)
+        latencies.append((time.perf_counter() - started) * 1e6)
+        hit = predicted == label
+        correct += hit
+        per_class[label]["total"] += 1
+        per_class[label]["correct"] += hit
+        if confidence >= threshold:
+            confident += 1
+            confident_correct += hit
+
+    latencies.sort()
+    n = len(samples)
+
+    def pct(p: float) -> float:
+        return round(latencies[min(n - 1, int(p * n))], 1) if n else 0.0
+
+    return {
+        "samples": n,
+        "accuracy": round(correct / n, 4) if n else None,
+        "threshold": threshold,
+        "coverage": round(confident / n, 4) if n else None,
+        "accuracy_above_threshold": round(confident_correct / confident, 4) if confident else None,
+        "latency_us": {"p50": pct(0.5), "p95": pct(0.95), "p99": pct(0.99)},
+        "per_class": {c: round(v["correct"] / v["total"], 4) for c, v in per_class.items()},
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    from ..config import settings
+    from .db import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Локальный классификатор обращений")
+    parser.add_argument("command", choices=["retrain", "report"])
+    parser.add_argument("--path", default=settings.LOCAL_CLASSIFIER_PATH)
+    parser.add_argument("--holdout", type=float, default=0.2, help="Доля выборки для проверки")
+    parser.add_argument("--threshold", type=float, default=settings.LOCAL_CLASSIFIER_THRESHOLD)
+    args = parser.parse_args(argv)
+
+    with SessionLocal() as db:
+        samples = load_training_data(db)
+    if not samples:
+        raise SystemExit("Нет размеченных заявок для обучения")
+
+    if args.command == "retrain":
+        model = LocalClassifier.train(samples)
+        model.save(args.path)
+        print(f"Модель обучена на {len(samples)} примерах и сохранена в {args.path}")
+    else:
+        train, test = _split(samples, args.holdout)
+        if not train or not test:
+            train = test = samples
+        model = LocalClassifier.train(train)
+        print(json.dumps(report(model, test, args.threshold), ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+"""
+Метрики в формате Prometheus (GET /metrics) и лог медленных запросов.
+
+Что меряется:
+- каждый HTTP-запрос: латентность по шаблону маршрута, число и время SQL-запросов
+  (события движков из services.db), время и число вызовов модели;
+- вызовы модели (из ai_gateway.record): латентность и токены по модели;
+- отправка уведомлений: латентность и результат по каналу;
+- при сборе /metrics — снимки уже существующих stats(): пулы, шлюз модели, кэши,
+  воркеры. Их регистрирует main.py через register_collector.
+
+Запрос дольше METRICS_SLOW_REQUEST_MS попадает в лог с разбивкой по фазам (SQL,
+модель, остальное); та же разбивка отдаётся в заголовке Server-Timing.
+Библиотека prometheus_client не нужна: текстовый формат собирается здесь.
+"""
+import bisect
+import logging
+import math
+import threading
+import time
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+
+from ..config import settings
+from .db import async_engine, engine
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+# ----------------------------
+# Типы метрик
+# ----------------------------
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labels)
+
+    def _label_str(self, key: Tuple[str, ...], extra: str = "") -> str:
+        parts = [f'{name}="{_escape(value)}"' for name, value in zip(self.labels, key)]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        super().__init__(name, help, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = dict(self._values)
+        return self.header() + [f"{self.name}{self._label_str(k)} {_fmt(v)}" for k, v in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> [счётчики по корзинам (не накопленные) + корзина +Inf, сумма]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def render(self) -> List[str]:
+        with self._lock:
+            values = {k: (list(counts), total) for k, (counts, total) in self._values.items()}
+        lines = self.header()
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else _fmt(bound)
+                labels = self._label_str(key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{self._label_str(key)} {_fmt(total)}")
+            lines.append(f"{self.name}_count{self._label_str(key)} {cumulative}")
+        return lines
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt(value: float) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# ----------------------------
+# Метрики приложения
+# ----------------------------
+http_requests = Histogram(
+    "app_http_request_duration_seconds", "Латентность HTTP-запросов", ("method", "route", "status"),
+)
+http_sql_queries = Histogram(
+    "app_http_request_sql_queries", "Число SQL-запросов на HTTP-запрос", ("method", "route"), COUNT_BUCKETS,
+)
+http_sql_seconds = Histogram(
+    "app_http_request_sql_seconds", "Суммарное время SQL на HTTP-запрос", ("method", "route"),
+)
+http_ai_seconds = Histogram(
+    "app_http_request_ai_seconds", "Суммарное время вызовов модели на HTTP-запрос (только запросы с вызовами)",
+    ("method", "route"),
+)
+slow_requests = Counter("app_http_slow_requests_total", "Запросы дольше METRICS_SLOW_REQUEST_MS", ("method", "route"))
+sql_queries = Histogram("app_sql_query_duration_seconds", "Латентность SQL-запросов (включая фоновые воркеры)", ("engine",))
+ai_calls = Histogram("app_ai_call_duration_seconds", "Латентность успешных вызовов модели", ("model",))
+ai_tokens = Counter("app_ai_tokens_total", "Токены вызовов модели", ("model", "kind"))
+ai_cost = Counter("app_ai_cost_total", "Стоимость вызовов модели, USD", ("model",))
+notification_sends = Histogram(
+    "app_notification_send_duration_seconds", "Отправка уведомлений", ("channel", "outcome"),
+)
+
+_METRICS = (
+    http_requests, http_sql_queries, http_sql_seconds, http_ai_seconds, slow_requests,
+    sql_queries, ai_calls, ai_tokens, ai_cost, notification_sends,
+)
+
+# Снимки stats() других сервисов: имя -> функция, возвращающая dict
+_collectors: Dict[str, Callable[[], dict]] = {}
+
+
+def register_collector(name: str, collect: Callable[[], dict]) -> None:
+    """Числовые поля collect() попадут в /metrics как app_<name>_<поле>."""
+    _collectors[name] = collect
+
+
+# ----------------------------
+# Фазы текущего запроса
+# ----------------------------
+class RequestTimings:
+    __slots__ = ("sql_count", "sql_seconds", "ai_calls", "ai_seconds")
+
+    def __init__(self):
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.ai_calls = 0
+        self.ai_seconds = 0.0
+
+
+# Объект общий для запроса: run_in_threadpool копирует контекст, но не сам объект
+_current: ContextVar[Optional[RequestTimings]] = ContextVar("request_timings", default=None)
+
+
+@event.listens_for(engine, "after_cursor_execute")
+@event.listens_for(async_engine.sync_engine, "after_cursor_execute")
+def _observe_query(conn, cursor, statement, parameters, context, executemany):
+    # Начало запроса отмечает слушатель before_cursor_execute в services.db
+    started = getattr(context, "_query_started", None)
+    if started is None:
+        return
+    seconds = time.perf_counter() - started
+    sql_queries.observe(seconds, engine="async" if conn.engine is async_engine.sync_engine else "sync")
+    timings = _current.get()
+    if timings is not None:
+        timings.sql_count += 1
+        timings.sql_seconds += seconds
+
+
+def observe_ai(model: str, latency_ms: int, prompt_tokens: int, completion_tokens: int, cost: Optional[float]) -> None:
+    """Вызывается из ai_gateway.record для каждого успешного вызова модели."""
+    seconds = latency_ms / 1000
+    ai_calls.observe(seconds, model=model)
+    ai_tokens.inc(prompt_tokens, model=model, kind="prompt")
+    ai_tokens.inc(completion_tokens, model=model, kind="completion")
+    if cost:
+        ai_cost.inc(cost, model=model)
+    timings = _current.get()
+    if timings is not None:
+        timings.ai_calls += 1
+        timings.ai_seconds += seconds
+
+
+# ----------------------------
+# Middleware
+# ----------------------------
+class MetricsMiddleware:
+    """
+    Чистый ASGI-middleware (не BaseHTTPMiddleware): контекст запроса доходит до
+    эндпоинта и threadpool, а стриминговые ответы меряются до последнего байта.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.METRICS_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        started = time.perf_counter()
+        status = 500
+        streaming = False
+
+        async def send_wrapper(message):
+            nonlocal status, streaming
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                headers = list(message.get("headers", []))
+                streaming = any(
+                    k.lower() == b"content-type" and v.startswith(b"text/event-stream") for k, v in headers
+                )
+                headers.append((b"server-timing", _server_timing(timings, time.perf_counter() - started).encode()))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            self._observe(scope, status, time.perf_counter() - started, timings, streaming)
+
+    def _observe(self, scope, status: int, seconds: float, timings: RequestTimings, streaming: bool) -> None:
+        route = _route_label(scope)
+        method = scope["method"]
+        http_requests.observe(seconds, method=method, route=route, status=status)
+        http_sql_queries.observe(timings.sql_count, method=method, route=route)
+        http_sql_seconds.observe(timings.sql_seconds, method=method, route=route)
+        if timings.ai_calls:
+            http_ai_seconds.observe(timings.ai_seconds, method=method, route=route)
+
+        # Подписка на SSE живёт минутами — это не медленный запрос
+        slow_ms = settings.METRICS_SLOW_REQUEST_MS
+        if slow_ms and not streaming and seconds * 1000 >= slow_ms:
+            slow_requests.inc(method=method, route=route)
+            logger.warning(
+                "Медленный запрос %s %s → %s: %.0f мс (SQL: %d запр. %.0f мс; модель: %d выз. %.0f мс; прочее %.0f мс)",
+                method, scope.get("path"), status, seconds * 1000,
+                timings.sql_count, timings.sql_seconds * 1000,
+                timings.ai_calls, timings.ai_seconds * 1000,
+                max(0.0, seconds - timings.sql_seconds - timings.ai_seconds) * 1000,
+            )
+
+
+def _route_label(scope) -> str:
+    # Шаблон маршрута, а не путь: /api/tickets/{ticket_id}, иначе метки разрастаются
+    route = scope.get("route")
+    if route is not None and getattr(route, "path", None):
+        return route.path
+    return "unmatched"
+
+
+def _server_timing(timings: RequestTimings, seconds: float) -> str:
+    return (
+        f"db;desc=\"{timings.sql_count} queries\";dur={timings.sql_seconds * 1000:.1f}, "
+        f"ai;dur={timings.ai_seconds * 1000:.1f}, "
+        f"app;dur={seconds * 1000:.1f}"
+    )
+
+
+# ----------------------------
+# Экспорт
+# ----------------------------
+def render() -> str:
+    lines: List[str] = []
+    for metric in _METRICS:
+        lines += metric.render()
+    for name, collect in _collectors.items():
+        try:
+            snapshot = collect()
+        except Exception:
+            logger.exception("Не удалось собрать метрики %s", name)
+            continue
+        for key, value in _flatten(snapshot):
+            metric = f"app_{name}_{key}"
+            lines.append(f"# TYPE {metric} gauge")
+            lines.append(f"{metric} {_fmt(value)}")
+    return "\n".join(lines) + "\n"
+
+
+def _flatten(values: dict, prefix: str = ""):
+    """Числовые листья вложенного dict; строки и списки пропускаются."""
+    for key, value in values.items():
+        name = f"{prefix}{_metric_name(key)}"
+        if isinstance(value, dict):
+            yield from _flatten(value, f"{name}_")
+        elif isinstance(value, (bool, int, float)) and not (isinstance(value, float) and math.isnan(value)):
+            yield name, value
+
+
+def _metric_name(key) -> str:
+    return "".join(c if c.isalnum() else "_" for c in str(key)).lower()
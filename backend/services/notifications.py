@@ -0,0 +1,411 @@
+"""
+Исходящие уведомления клиентам через outbox-таблицу notifications.
+
+Роуты только добавляют строки в outbox в своей транзакции (enqueue_ticket_reply),
+поэтому письмо не теряется при рестарте. NotificationWorker забирает пачки через
+FOR UPDATE SKIP LOCKED и отправляет их:
+- email — через пул постоянных SMTP-соединений (STARTTLS и логин один раз на соединение);
+- telegram — через Bot API одним общим httpx-клиентом.
+Неудачные отправки повторяются с экспоненциальной задержкой, скорость по каждому
+каналу ограничена token bucket.
+"""
+import asyncio
+import logging
+import random
+import smtplib
+import threading
+import time
+from datetime import timedelta
+from email.message import EmailMessage
+from typing import List, Optional
+
+import httpx
+from anyio import to_thread
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+from ..config import settings
+from ..models import Client, Notification, Ticket
+from . import metrics
+from .db import SessionLocal
+from .ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class PermanentError(Exception):
+    """Повтор не поможет (адрес отклонён, бот заблокирован, канал не настроен)."""
+
+
+class RetryLater(Exception):
+    """Сервер просит повторить не раньше чем через retry_after секунд."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+# ----------------------------
+# Постановка в очередь
+# ----------------------------
+def enqueue_ticket_reply(db: Session, ticket: Ticket, body: str) -> List[Notification]:
+    """
+    Ставит ответ по заявке в outbox по всем доступным каналам клиента.
+    Коммит остаётся за вызывающим кодом, после него нужно вызвать worker.notify().
+    """
+    client = ticket.client
+    if client is None and ticket.client_phone:
+        client = db.query(Client).filter(Client.phone == ticket.client_phone).first()
+    if client is None:
+        return []
+
+    subject = f"Ответ по заявке #{ticket.id}"
+    rows = []
+    if client.email and settings.EMAIL_HOST:
+        rows.append(Notification(
+            ticket_id=ticket.id, channel="email", recipient=client.email, subject=subject, body=body,
+        ))
+    if client.telegram_chat_id and settings.TELEGRAM_BOT_TOKEN:
+        rows.append(Notification(
+            ticket_id=ticket.id, channel="telegram", recipient=client.telegram_chat_id,
+            subject=subject, body=f"{subject}\n\n{body}",
+        ))
+    db.add_all(rows)
+    return rows
+
+
+def enqueue_telegram(db: Session, chat_id: str, body: str) -> List[Notification]:
+    """Служебное сообщение в чат Telegram (подтверждение привязки и т.п.)."""
+    if not settings.TELEGRAM_BOT_TOKEN:
+        return []
+    row = Notification(channel="telegram", recipient=chat_id, body=body)
+    db.add(row)
+    return [row]
+
+
+def enqueue_login_code(db: Session, client: Client, code: str) -> List[Notification]:
+    """Код входа — теми же каналами, что и ответы; без заявки. Коммит и notify() — за вызывающим."""
+    minutes = settings.LOGIN_CODE_TTL_SECONDS // 60
+    body = f"Код входа: {code}. Действует {minutes} мин. Никому его не сообщайте."
+    rows = []
+    if client.email and settings.EMAIL_HOST:
+        rows.append(Notification(channel="email", recipient=client.email, subject="Код входа", body=body))
+    if client.telegram_chat_id and settings.TELEGRAM_BOT_TOKEN:
+        rows.append(Notification(channel="telegram", recipient=client.telegram_chat_id, subject="Код входа", body=body))
+    db.add_all(rows)
+    return rows
+
+
+# ----------------------------
+# Email
+# ----------------------------
+class _PooledSMTP:
+    def __init__(self, smtp: smtplib.SMTP):
+        self.smtp = smtp
+        self.sent = 0
+        self.last_used = time.monotonic()
+
+
+class SMTPPool:
+    """
+    Пул открытых SMTP-соединений. Соединение переиспользуется для следующих писем
+    и закрывается после max_messages писем, простоя idle_seconds или ошибки.
+    Сколько соединений занято одновременно, ограничивает вызывающий код.
+    """
+
+    def __init__(
+        self,
+        max_messages: int = settings.SMTP_MAX_MESSAGES_PER_CONNECTION,
+        idle_seconds: float = settings.SMTP_IDLE_SECONDS,
+    ):
+        self.max_messages = max_messages
+        self.idle_seconds = idle_seconds
+        self._idle: List[_PooledSMTP] = []
+        self._lock = threading.Lock()
+        self.connects = 0
+
+    def _connect(self) -> _PooledSMTP:
+        smtp = smtplib.SMTP(settings.EMAIL_HOST, settings.EMAIL_PORT, timeout=settings.SMTP_TIMEOUT)
+        try:
+            if settings.SMTP_STARTTLS:
+                smtp.starttls()
+            if settings.EMAIL_USER and settings.EMAIL_PASSWORD:
+                smtp.login(settings.EMAIL_USER, settings.EMAIL_PASSWORD)
+        except Exception:
+            self._quit(smtp)
+            raise
+        with self._lock:
+            self.connects += 1
+        return _PooledSMTP(smtp)
+
+    @staticmethod
+    def _quit(smtp: smtplib.SMTP) -> None:
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+    def _checkout(self) -> _PooledSMTP:
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        return conn or self._connect()
+
+    def _checkin(self, conn: _PooledSMTP) -> None:
+        conn.sent += 1
+        conn.last_used = time.monotonic()
+        if conn.sent >= self.max_messages:
+            self._quit(conn.smtp)
+            return
+        with self._lock:
+            self._idle.append(conn)
+
+    def send(self, msg: EmailMessage) -> None:
+        if not settings.EMAIL_HOST:
+            raise PermanentError("SMTP не настроен")
+        conn = self._checkout()
+        try:
+            try:
+                conn.smtp.send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                # Сервер закрыл простаивающее соединение — одна попытка на свежем
+                self._quit(conn.smtp)
+                conn = self._connect()
+                conn.smtp.send_message(msg)
+        except smtplib.SMTPRecipientsRefused as e:
+            self._checkin(conn)
+            # Постоянная ошибка — только 5xx; 4xx (ящик переполнен, greylisting) повторяем
+            if all(code >= 500 for code, _ in e.recipients.values()):
+                raise PermanentError(f"Адрес отклонён: {e.recipients}")
+            raise
+        except smtplib.SMTPResponseException as e:
+            self._checkin(conn)
+            if e.smtp_code >= 500:
+                raise PermanentError(f"SMTP {e.smtp_code}: {e.smtp_error!r}")
+            raise
+        except Exception:
+            self._quit(conn.smtp)
+            raise
+        self._checkin(conn)
+
+    def close_idle(self) -> None:
+        deadline = time.monotonic() - self.idle_seconds
+        with self._lock:
+            stale = [c for c in self._idle if c.last_used < deadline]
+            self._idle = [c for c in self._idle if c.last_used >= deadline]
+        for conn in stale:
+            self._quit(conn.smtp)
+
+    def close(self) -> None:
+        with self._lock:
+            conns, self._idle = self._idle, []
+        for conn in conns:
+            self._quit(conn.smtp)
+
+
+def build_email(recipient: str, subject: Optional[str], body: str) -> EmailMessage:
+    msg = EmailMessage()
+    msg["From"] = settings.EMAIL_FROM or settings.EMAIL_USER or "noreply@localhost"
+    msg["To"] = recipient
+    msg["Subject"] = subject or ""
+    msg.set_content(body)
+    return msg
+
+
+# ----------------------------
+# Telegram
+# ----------------------------
+async def send_telegram(http: httpx.AsyncClient, chat_id: str, text: str) -> None:
+    if not settings.TELEGRAM_BOT_TOKEN:
+        raise PermanentError("Telegram-бот не настроен")
+    response = await http.post(
+        f"{settings.TELEGRAM_API_URL}/bot{settings.TELEGRAM_BOT_TOKEN}/sendMessage",
+        json={"chat_id": chat_id, "text": text},
+    )
+    if response.status_code == 200:
+        return
+    try:
+        data = response.json()
+    except ValueError:
+        data = {}
+    description = data.get("description") or response.text[:200]
+    if response.status_code == 429:
+        raise RetryLater(description, data.get("parameters", {}).get("retry_after", 1))
+    if response.status_code in (400, 403):
+        # Чат не найден или бот заблокирован пользователем
+        raise PermanentError(description)
+    raise RuntimeError(f"Telegram {response.status_code}: {description}")
+
+
+# ----------------------------
+# Воркер
+# ----------------------------
+class NotificationWorker:
+    """
+    Фоновый воркер outbox-таблицы notifications.
+
+    Как и EnrichmentWorker, забирает пачки через FOR UPDATE SKIP LOCKED и переживает
+    рестарт: запись в статусе sending с истёкшей арендой забирается повторно.
+    """
+
+    def __init__(
+        self,
+        session_factory=SessionLocal,
+        poll_interval: float = settings.NOTIFY_POLL_SECONDS,
+        batch_size: int = settings.NOTIFY_BATCH_SIZE,
+        max_attempts: int = settings.NOTIFY_MAX_ATTEMPTS,
+        lease_seconds: int = settings.NOTIFY_LEASE_SECONDS,
+    ):
+        self.session_factory = session_factory
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.lease_seconds = lease_seconds
+        self.smtp = SMTPPool()
+        self.email_bucket = TokenBucket(settings.NOTIFY_EMAIL_RATE)
+        self.telegram_bucket = TokenBucket(settings.NOTIFY_TELEGRAM_RATE)
+        self.counters = {"sent": 0, "retried": 0, "failed": 0}
+        self._http: Optional[httpx.AsyncClient] = None
+        self._smtp_slots: Optional[asyncio.Semaphore] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._smtp_slots = asyncio.Semaphore(settings.SMTP_POOL_SIZE)
+        self._http = httpx.AsyncClient(timeout=settings.SMTP_TIMEOUT)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._http:
+            await self._http.aclose()
+            self._http = None
+        await to_thread.run_sync(self.smtp.close)
+
+    def notify(self) -> None:
+        """Будит воркер после коммита новых уведомлений. Можно вызывать из любого потока."""
+        if self._loop and self._wakeup:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def stats(self) -> dict:
+        return {**self.counters, "smtp_connects": self.smtp.connects}
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                claimed = await to_thread.run_sync(self._claim)
+            except Exception:
+                logger.exception("Не удалось забрать уведомления")
+                claimed = []
+
+            if claimed:
+                results = await asyncio.gather(*(self._deliver(item) for item in claimed))
+                try:
+                    await to_thread.run_sync(self._finish, results)
+                except Exception:
+                    # Записи останутся в sending и вернутся в очередь по истечении аренды
+                    logger.exception("Не удалось сохранить результаты отправки")
+
+            if len(claimed) < self.batch_size:
+                await to_thread.run_sync(self.smtp.close_idle)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _claim(self) -> List[dict]:
+        with self.session_factory() as db:
+            rows = db.execute(
+                select(Notification)
+                .where(Notification.status.in_(("pending", "sending")))
+                .where(Notification.next_attempt_at <= func.now())
+                .order_by(Notification.next_attempt_at)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).scalars().all()
+            items = []
+            for row in rows:
+                row.status = "sending"
+                row.attempts += 1
+                row.next_attempt_at = func.now() + timedelta(seconds=self.lease_seconds)
+                items.append({
+                    "id": row.id,
+                    "channel": row.channel,
+                    "recipient": row.recipient,
+                    "subject": row.subject,
+                    "body": row.body,
+                    "attempts": row.attempts,
+                })
+            db.commit()
+            return items
+
+    async def _deliver(self, item: dict) -> tuple:
+        """(item, ошибка или None)."""
+        started = time.perf_counter()
+        try:
+            if item["channel"] == "email":
+                await self.email_bucket.acquire()
+                msg = build_email(item["recipient"], item["subject"], item["body"])
+                async with self._smtp_slots:
+                    await to_thread.run_sync(self.smtp.send, msg)
+            elif item["channel"] == "telegram":
+                await self.telegram_bucket.acquire()
+                await send_telegram(self._http, item["recipient"], item["body"])
+            else:
+                raise PermanentError(f"Неизвестный канал {item['channel']}")
+        except RetryLater as e:
+            if item["channel"] == "telegram":
+                self.telegram_bucket.penalize(e.retry_after)
+            metrics.notification_sends.observe(time.perf_counter() - started, channel=item["channel"], outcome="retry")
+            return item, e
+        except Exception as e:
+            metrics.notification_sends.observe(time.perf_counter() - started, channel=item["channel"], outcome="error")
+            return item, e
+        metrics.notification_sends.observe(time.perf_counter() - started, channel=item["channel"], outcome="sent")
+        return item, None
+
+    def _backoff(self, attempts: int, error: Exception) -> float:
+        if isinstance(error, RetryLater):
+            return error.retry_after
+        delay = min(settings.NOTIFY_BACKOFF_SECONDS * 2 ** (attempts - 1), settings.NOTIFY_BACKOFF_MAX_SECONDS)
+        return delay * random.uniform(0.8, 1.2)
+
+    def _finish(self, results: List[tuple]) -> None:
+        with self.session_factory() as db:
+            ids = [item["id"] for item, _ in results]
+            rows = {
+                row.id: row
+                for row in db.execute(select(Notification).where(Notification.id.in_(ids))).scalars()
+            }
+            for item, error in results:
+                row = rows.get(item["id"])
+                if row is None:
+                    continue
+                if error is None:
+                    row.status = "sent"
+                    row.sent_at = func.now()
+                    row.last_error = None
+                    self.counters["sent"] += 1
+                    continue
+                row.last_error = str(error)[:1000]
+                if isinstance(error, PermanentError) or item["attempts"] >= self.max_attempts:
+                    row.status = "failed"
+                    self.counters["failed"] += 1
+                    logger.warning("Уведомление #%s не отправлено: %s", item["id"], error)
+                else:
+                    row.status = "pending"
+                    row.next_attempt_at = func.now() + timedelta(seconds=self._backoff(item["attempts"], error))
+                    self.counters["retried"] += 1
+            db.commit()
+
+
+worker = NotificationWorker()
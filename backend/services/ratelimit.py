@@ -0,0 +1,61 @@
+import asyncio
+import threading
+import time
+from typing import Optional
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: rate токенов в секунду, не больше capacity в запасе.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_acquire(self, tokens: float = 1.0) -> float:
+        """
+        Забирает токены, если они есть, и возвращает 0.
+        Иначе ничего не забирает и возвращает, сколько секунд ждать.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    async def acquire(self, tokens: float = 1.0, max_wait: Optional[float] = None) -> bool:
+        """
+        Ждёт, пока токены появятся, и забирает их.
+        Если ждать пришлось бы дольше max_wait, сразу возвращает False, ничего не забрав.
+        """
+        tokens = min(tokens, self.capacity)
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        while True:
+            wait = self.try_acquire(tokens)
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def retry_after(self, tokens: float = 1.0) -> float:
+        """Через сколько секунд наберётся tokens, не забирая их."""
+        with self._lock:
+            self._refill(time.monotonic())
+            return max(0.0, (min(tokens, self.capacity) - self._tokens) / self.rate)
+
+    def penalize(self, seconds: float) -> None:
+        """Опустошает bucket так, чтобы следующий токен появился не раньше чем через seconds."""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, 1.0 - seconds * self.rate)
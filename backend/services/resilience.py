@@ -0,0 +1,175 @@
+"""
+Устойчивость вызовов модели: повторы с jitter, hedged-запросы и circuit breaker.
+Используется в ai_gateway; сам по себе ничего не знает про OpenAI, кроме is_retryable.
+"""
+import asyncio
+import math
+import random
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional, TypeVar
+
+import openai
+from fastapi import HTTPException
+
+T = TypeVar("T")
+
+
+class AIUnavailableError(HTTPException):
+    """Модель недоступна (breaker открыт или повторы исчерпаны): 503 с Retry-After."""
+
+    def __init__(self, detail: str = "AI-сервис временно недоступен", retry_after: float = 30):
+        self.retry_after = max(1, math.ceil(retry_after))
+        super().__init__(
+            status_code=503,
+            detail=detail,
+            headers={"Retry-After": str(self.retry_after)},
+        )
+
+
+def is_retryable(error: BaseException) -> bool:
+    """Сетевые ошибки, таймауты, 429 и 5xx провайдера — повтор может помочь."""
+    if isinstance(error, (asyncio.TimeoutError, openai.APIConnectionError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in (408, 409, 429) or error.status_code >= 500
+    return False
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Экспоненциальная задержка с full jitter: случайное число от 0 до base * 2^attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class LatencyWindow:
+    """Латентности последних успешных вызовов — для порога hedged-запросов."""
+
+    def __init__(self, size: int = 200):
+        self._values = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._values.append(seconds)
+
+    def percentile(self, q: float, min_samples: int = 20) -> Optional[float]:
+        if len(self._values) < min_samples:
+            return None
+        ordered = sorted(self._values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+async def hedged(call: Callable[[], Awaitable[T]], hedge_after: Optional[float], on_hedge=None) -> T:
+    """
+    Запускает call(); если за hedge_after секунд ответа нет, запускает второй такой же
+    и возвращает первый успешный результат, отменяя оставшийся.
+    """
+    first = asyncio.ensure_future(call())
+    tasks = {first}
+    try:
+        if hedge_after is not None:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+            if not done:
+                if on_hedge:
+                    on_hedge()
+                tasks.add(asyncio.ensure_future(call()))
+
+        error = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = error or task.exception()
+        raise error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # Ошибку проигравшего запроса никто не заберёт — гасим warning
+                task.exception()
+
+
+class CircuitBreaker:
+    """
+    closed → open, когда в окне последних window вызовов (не меньше min_calls)
+    доля ошибок или медленных вызовов достигает порога. Через open_seconds —
+    half_open: пропускается один пробный вызов; успех закрывает breaker, неудача
+    снова открывает. Используется только из event loop, блокировки не нужны.
+    """
+
+    def __init__(
+        self,
+        window: int,
+        min_calls: int,
+        error_rate: float,
+        slow_seconds: float,
+        slow_rate: float,
+        open_seconds: float,
+    ):
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self.state = "closed"
+        self.trips = 0
+        self._outcomes = deque(maxlen=window)
+        self._opened_at = 0.0
+        self._probe = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open":
+            if time.monotonic() - self._opened_at < self.open_seconds:
+                return False
+            self.state = "half_open"
+        if self._probe:
+            return False
+        self._probe = True
+        return True
+
+    def is_open(self) -> bool:
+        return self.state == "open" and time.monotonic() - self._opened_at < self.open_seconds
+
+    def retry_after(self) -> float:
+        return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def record(self, ok: bool, latency: float = 0.0) -> None:
+        slow = latency >= self.slow_seconds
+        if self.state == "half_open":
+            self._probe = False
+            if ok and not slow:
+                self.state = "closed"
+                self._outcomes.clear()
+            else:
+                self._open()
+            return
+
+        self._outcomes.append((ok, slow))
+        if len(self._outcomes) < self.min_calls:
+            return
+        errors = sum(1 for ok_, _ in self._outcomes if not ok_)
+        slows = sum(1 for _, slow_ in self._outcomes if slow_)
+        if errors / len(self._outcomes) >= self.error_rate or slows / len(self._outcomes) >= self.slow_rate:
+            self._open()
+
+    def release_probe(self) -> None:
+        """Пробный вызов отменён, не дойдя до результата."""
+        if self.state == "half_open":
+            self._probe = False
+
+    def _open(self) -> None:
+        self.state = "open"
+        self.trips += 1
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+
+    def stats(self) -> dict:
+        return {
+            "state": "open" if self.is_open() else ("half_open" if self.state != "closed" else "closed"),
+            "trips": self.trips,
+            "window": len(self._outcomes),
+            "errors": sum(1 for ok, _ in self._outcomes if not ok),
+        }
@@ -0,0 +1,355 @@
+"""
+Поиск по заявкам и поиск дублей.
+
+- Полнотекстовый поиск Postgres по subject и text (GIN-индекс ix_tickets_search).
+- Векторный индекс в памяти: хэшированные эмбеддинги из признаков локального
+  классификатора (слова, основы, биграммы) и косинусное сходство на NumPy.
+  Без numpy или при SEARCH_VECTOR_ENABLED=false похожие заявки ищутся через
+  полнотекстовый поиск, а кластеризация и поиск дублей выключены.
+- Кластеризация инцидентов: заявки за окно времени группируются по сходству,
+  чтобы массовую аварию разобрать и ответить на неё один раз.
+"""
+import asyncio
+import logging
+import math
+import threading
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Sequence, Tuple
+
+from anyio import to_thread
+from sqlalchemy import String, func, literal_column, select
+from sqlalchemy.dialects.postgresql import TSQUERY
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from ..config import settings
+from ..models import Ticket
+from .db import SessionLocal
+from .local_classifier import tokenize
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+_CONFIG = literal_column("'russian'::regconfig")
+
+
+# ----------------------------
+# Полнотекстовый поиск
+# ----------------------------
+def document():
+    """Выражение индекса ix_tickets_search (миграция 0008) — менять только вместе с ней."""
+    return func.to_tsvector(
+        _CONFIG,
+        func.coalesce(Ticket.subject, literal_column("''")).op("||")(literal_column("' '")).op("||")(Ticket.text),
+    )
+
+
+async def full_text(
+    db: AsyncSession,
+    q: str,
+    limit: int,
+    category: Optional[str] = None,
+    status: Optional[str] = None,
+) -> List[Tuple[Ticket, float, str]]:
+    """Заявки по запросу в синтаксисе websearch (кавычки, OR, -слово): (заявка, rank, фрагмент)."""
+    query = func.websearch_to_tsquery(_CONFIG, q)
+    rank = func.ts_rank_cd(document(), query)
+    matched = select(Ticket.id, rank.label("rank")).where(document().op("@@")(query))
+    if category:
+        matched = matched.where(Ticket.category == category)
+    if status:
+        matched = matched.where(Ticket.status == status)
+    # Фрагменты считаются только для отобранной страницы, а не для всех совпадений
+    top = matched.order_by(rank.desc(), Ticket.id.desc()).limit(limit).subquery()
+    snippet = func.ts_headline(_CONFIG, Ticket.text, query, "MaxWords=30, MinWords=10")
+    rows = (await db.execute(
+        select(Ticket, top.c.rank, snippet)
+        .join(top, top.c.id == Ticket.id)
+        .order_by(top.c.rank.desc(), Ticket.id.desc())
+    )).all()
+    return [(ticket, float(rank), snippet) for ticket, rank, snippet in rows]
+
+
+async def similar_full_text(db: AsyncSession, ticket: Ticket, limit: int) -> List[Tuple[Ticket, float]]:
+    """Похожие заявки без векторного индекса: любое из слов заявки, по убыванию rank."""
+    words = func.plainto_tsquery(_CONFIG, f"{ticket.subject or ''} {ticket.text}")
+    query = func.replace(words.cast(String), "&", "|").cast(TSQUERY)
+    rank = func.ts_rank_cd(document(), query)
+    rows = (await db.execute(
+        select(Ticket, rank)
+        .where(document().op("@@")(query))
+        .where(Ticket.id != ticket.id)
+        .order_by(rank.desc(), Ticket.id.desc())
+        .limit(limit)
+    )).all()
+    return [(t, float(r)) for t, r in rows]
+
+
+# ----------------------------
+# Эмбеддинги
+# ----------------------------
+def embed(text: str, dim: int = settings.SEARCH_EMBEDDING_DIM):
+    """
+    Хэшированный вектор признаков tokenize() с сублинейным tf, нормированный по L2.
+    Знак признака — отдельный бит хэша, чтобы коллизии в среднем гасили друг друга.
+    """
+    vector = np.zeros(dim, dtype=np.float32)
+    for feature, count in Counter(tokenize(text)).items():
+        h = zlib.crc32(feature.encode())
+        vector[h % dim] += (1.0 if h & 0x80000000 else -1.0) * (1.0 + math.log(count))
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _epoch(moment: Optional[datetime]) -> float:
+    if moment is None:
+        return 0.0
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return moment.timestamp()
+
+
+class VectorIndex:
+    """
+    Эмбеддинги последних max_items заявок в одной матрице.
+    Новые заявки дочитываются по id > последнего загруженного; заявки не редактируются,
+    так что пересчитывать старые векторы не нужно. Id выдаются при вставке, а видны
+    заявки после коммита — не по порядку, и курсор по id терял бы закоммиченные позже
+    соседей. Поэтому каждый проход ещё перечитывает заявки за последние overlap_seconds
+    с id не выше курсора и добавляет те, которых в индексе нет.
+    Поиск — одно умножение матрицы на вектор.
+    """
+
+    def __init__(
+        self,
+        dim: int = settings.SEARCH_EMBEDDING_DIM,
+        max_items: int = settings.SEARCH_INDEX_MAX_TICKETS,
+        session_factory=SessionLocal,
+        refresh_seconds: float = settings.SEARCH_INDEX_REFRESH_SECONDS,
+        overlap_seconds: float = settings.SEARCH_INDEX_OVERLAP_SECONDS,
+    ):
+        self.dim = dim
+        self.max_items = max_items
+        self.session_factory = session_factory
+        self.refresh_seconds = refresh_seconds
+        self.overlap_seconds = overlap_seconds
+        self._lock = threading.Lock()
+        self._vectors = np.zeros((0, dim), dtype=np.float32) if np else None
+        self._ids = np.zeros(0, dtype=np.int64) if np else None
+        self._created = np.zeros(0, dtype=np.float64) if np else None
+        self._size = 0
+        self._last_id = 0
+        self._loaded = False
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return np is not None and settings.SEARCH_VECTOR_ENABLED and self._loaded
+
+    def add(self, ids: Sequence[int], texts: Sequence[str], created: Sequence[float]) -> None:
+        if not ids:
+            return
+        vectors = np.stack([embed(t, self.dim) for t in texts])
+        with self._lock:
+            need = self._size + len(ids)
+            if need > len(self._vectors):
+                # Запас вдвое, чтобы не копировать матрицу на каждой пачке
+                capacity = min(max(need, 2 * len(self._vectors), 1024), self.max_items + len(ids))
+                self._vectors = self._grow(self._vectors, capacity)
+                self._ids = self._grow(self._ids, capacity)
+                self._created = self._grow(self._created, capacity)
+            self._vectors[self._size:need] = vectors
+            self._ids[self._size:need] = ids
+            self._created[self._size:need] = created
+            self._size = need
+            self._last_id = max(self._last_id, int(max(ids)))
+            if self._size > self.max_items:
+                # Выбрасываем самые старые с запасом в 10%, чтобы не копировать матрицу
+                # на каждой следующей пачке. Новые массивы — снимки, которые сейчас читают, не меняются
+                keep = int(self.max_items * 0.9)
+                start = self._size - keep
+                for name in ("_vectors", "_ids", "_created"):
+                    array = getattr(self, name)
+                    trimmed = np.zeros((self.max_items,) + array.shape[1:], dtype=array.dtype)
+                    trimmed[:keep] = array[start:self._size]
+                    setattr(self, name, trimmed)
+                self._size = keep
+
+    def _grow(self, array, capacity: int):
+        grown = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+        grown[:self._size] = array[:self._size]
+        return grown
+
+    def _snapshot(self):
+        with self._lock:
+            n = self._size
+            return self._vectors[:n], self._ids[:n], self._created[:n]
+
+    def refresh(self, batch_size: int = 5000) -> int:
+        """Добавляет заявки, появившиеся с прошлого раза. Возвращает, сколько добавлено."""
+        added = 0
+        with self.session_factory() as db:
+            if self._last_id == 0:
+                # Первая загрузка — только последние max_items заявок
+                floor = db.execute(
+                    select(Ticket.id).order_by(Ticket.id.desc()).offset(self.max_items).limit(1)
+                ).scalar_one_or_none()
+                self._last_id = floor or 0
+            else:
+                added += self._add_late(db)
+            while True:
+                rows = db.execute(
+                    select(Ticket.id, Ticket.subject, Ticket.text, Ticket.created_at)
+                    .where(Ticket.id > self._last_id)
+                    .order_by(Ticket.id)
+                    .limit(batch_size)
+                ).all()
+                if not rows:
+                    break
+                self.add(
+                    [r.id for r in rows],
+                    [f"{r.subject or ''} {r.text}" for r in rows],
+                    [_epoch(r.created_at) for r in rows],
+                )
+                added += len(rows)
+                if len(rows) < batch_size:
+                    break
+        self._loaded = True
+        return added
+
+    def _add_late(self, db) -> int:
+        """Заявки из окна overlap_seconds, закоммиченные после соседей с большим id."""
+        rows = db.execute(
+            select(Ticket.id, Ticket.subject, Ticket.text, Ticket.created_at)
+            .where(Ticket.id <= self._last_id)
+            .where(Ticket.created_at >= func.now() - timedelta(seconds=self.overlap_seconds))
+            .order_by(Ticket.id)
+        ).all()
+        if not rows:
+            return 0
+        _, known, _ = self._snapshot()
+        late = [r for r, seen in zip(rows, np.isin([r.id for r in rows], known)) if not seen]
+        self.add(
+            [r.id for r in late],
+            [f"{r.subject or ''} {r.text}" for r in late],
+            [_epoch(r.created_at) for r in late],
+        )
+        return len(late)
+
+    def search(
+        self,
+        vector,
+        k: int,
+        since: Optional[datetime] = None,
+        exclude: Sequence[int] = (),
+        min_score: float = 0.0,
+    ) -> List[Tuple[int, float]]:
+        """k ближайших заявок: (id, косинусное сходство) по убыванию."""
+        vectors, ids, created = self._snapshot()
+        if not len(ids):
+            return []
+        scores = vectors @ vector
+        mask = scores >= min_score
+        if since is not None:
+            mask &= created >= _epoch(since)
+        if exclude:
+            mask &= ~np.isin(ids, exclude)
+        candidates = np.flatnonzero(mask)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind="stable")]
+        return [(int(ids[i]), float(scores[i])) for i in candidates]
+
+    def vectors_for(self, ticket_ids: Sequence[int]) -> dict:
+        """Векторы заявок из индекса: {id: вектор}; отсутствующих в индексе нет в ответе."""
+        vectors, ids, _ = self._snapshot()
+        positions = np.flatnonzero(np.isin(ids, ticket_ids))
+        return {int(ids[i]): vectors[i] for i in positions}
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.ready,
+            "tickets": self._size,
+            "last_id": self._last_id,
+            "dim": self.dim,
+            "memory_mb": round(self._vectors.nbytes / 2 ** 20, 1) if self._vectors is not None else 0,
+        }
+
+    # ---------- фоновый цикл ----------
+    def start(self) -> None:
+        if np is None or not settings.SEARCH_VECTOR_ENABLED:
+            logger.info("Векторный индекс заявок выключен")
+            return
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await to_thread.run_sync(self.refresh)
+            except Exception:
+                logger.exception("Не удалось обновить векторный индекс заявок")
+            await asyncio.sleep(self.refresh_seconds)
+
+
+index = VectorIndex()
+
+
+# ----------------------------
+# Дубли и инциденты
+# ----------------------------
+def nearest(text: str, since: Optional[datetime], min_score: float, k: int = 3) -> List[Tuple[int, float]]:
+    if not index.ready:
+        return []
+    return index.search(embed(text, index.dim), k, since=since, min_score=min_score)
+
+
+def duplicate_candidates(text: str) -> List[Tuple[int, float]]:
+    """Недавние заявки, почти совпадающие с текстом, — кандидаты в дубли."""
+    since = datetime.now(timezone.utc) - timedelta(hours=settings.SEARCH_DUPLICATE_WINDOW_HOURS)
+    return nearest(text, since, settings.SEARCH_DUPLICATE_THRESHOLD)
+
+
+def cluster(ids: Sequence[int], vectors, threshold: float, min_size: int) -> List[List[int]]:
+    """
+    Жадная кластеризация по порогу сходства: центром очередного кластера становится
+    заявка с наибольшим числом ещё не распределённых соседей, в кластер уходят все её
+    соседи. В отличие от связных компонент, цепочки «A похожа на B, B на C» не
+    склеивают разные инциденты. Первая заявка каждого кластера — его центр.
+    """
+    if not len(ids):
+        return []
+    adjacency = (vectors @ vectors.T) >= threshold
+    free = np.ones(len(ids), dtype=bool)
+    clusters = []
+    for center in np.argsort(-adjacency.sum(axis=1), kind="stable"):
+        if not free[center]:
+            continue
+        members = np.flatnonzero(adjacency[center] & free)
+        if len(members) < min_size:
+            continue
+        free[members] = False
+        clusters.append([ids[center]] + [ids[m] for m in members if m != center])
+    return clusters
+
+
+def vectors_for_rows(rows) -> "np.ndarray":
+    """Матрица векторов для строк (id, subject, text): из индекса, недостающие — считаются."""
+    known = index.vectors_for([r.id for r in rows]) if index.ready else {}
+    return np.stack([
+        known[r.id] if r.id in known else embed(f"{r.subject or ''} {r.text}", index.dim)
+        for r in rows
+    ])
@@ -0,0 +1,254 @@
+"""
+Токены доступа клиентов и операторов.
+
+Клиент получает JWT с id и телефоном только после ввода одноразового кода
+(/api/auth/login → /api/auth/login/verify), оператор — по логину и паролю
+(/api/auth/operator/login). Зависимости get_current_client и get_current_operator
+проверяют токен в памяти, без запроса к БД; роль в токене не даёт использовать
+токен клиента в панели оператора и наоборот.
+
+Оператора заводит администратор:
+
+    python -m backend.services.security create-operator <login>
+"""
+import argparse
+import base64
+import getpass
+import hashlib
+import hmac
+import secrets
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Optional
+
+import jwt
+from fastapi import Depends, HTTPException, Query, status
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+
+from ..config import settings
+
+bearer_scheme = HTTPBearer(auto_error=False, description="Токен из /api/auth/login/verify или /api/auth/operator/login")
+
+CLIENT_ROLE = "client"
+OPERATOR_ROLE = "operator"
+
+_PBKDF2_ITERATIONS = 200_000
+
+
+@dataclass(frozen=True)
+class CurrentClient:
+    id: int
+    phone: str
+
+
+@dataclass(frozen=True)
+class CurrentOperator:
+    id: int
+    login: str
+
+
+def _encode(claims: dict, minutes: int) -> str:
+    now = datetime.now(timezone.utc)
+    claims = {**claims, "iat": now, "exp": now + timedelta(minutes=minutes)}
+    return jwt.encode(claims, settings.JWT_SECRET_KEY, algorithm=settings.JWT_ALGORITHM)
+
+
+def create_access_token(client_id: int, phone: str) -> str:
+    return _encode(
+        {"sub": str(client_id), "phone": phone, "role": CLIENT_ROLE},
+        settings.ACCESS_TOKEN_EXPIRE_MINUTES,
+    )
+
+
+def create_operator_token(operator_id: int, login: str) -> str:
+    return _encode(
+        {"sub": str(operator_id), "login": login, "role": OPERATOR_ROLE},
+        settings.OPERATOR_TOKEN_EXPIRE_MINUTES,
+    )
+
+
+# ----------------------------
+# Пароли операторов и коды входа
+# ----------------------------
+def hash_password(password: str) -> str:
+    salt = secrets.token_hex(16)
+    digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), _PBKDF2_ITERATIONS)
+    return f"pbkdf2_sha256${_PBKDF2_ITERATIONS}${salt}${digest.hex()}"
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    try:
+        _, iterations, salt, expected = password_hash.split("$")
+        digest = hashlib.pbkdf2_hmac("sha256", password.encode(), bytes.fromhex(salt), int(iterations))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest.hex(), expected)
+
+
+def new_login_code() -> str:
+    return f"{secrets.randbelow(10 ** 6):06d}"
+
+
+def hash_login_code(phone: str, code: str) -> str:
+    """HMAC на секрете JWT: по утёкшей таблице login_codes код не подобрать."""
+    return hmac.new(settings.JWT_SECRET_KEY.encode(), f"{phone}:{code}".encode(), hashlib.sha256).hexdigest()
+
+
+# ----------------------------
+# Привязка Telegram
+# ----------------------------
+def _telegram_link_signature(payload: str) -> str:
+    digest = hmac.new(settings.JWT_SECRET_KEY.encode(), f"telegram:{payload}".encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:16]).decode().rstrip("=")
+
+
+def create_telegram_link_token(client_id: int) -> str:
+    """
+    Короткий подписанный токен для t.me/<бот>?start=<токен>: JWT не влезает
+    в 64 символа параметра start, поэтому client_id, срок и усечённый HMAC.
+    """
+    expires = int(time.time()) + settings.TELEGRAM_LINK_TTL_SECONDS
+    payload = f"{client_id}_{expires}"
+    return f"{payload}_{_telegram_link_signature(payload)}"
+
+
+def verify_telegram_link_token(token: str) -> Optional[int]:
+    """client_id из токена или None, если подпись не сходится или срок истёк."""
+    client_id, _, rest = token.partition("_")
+    expires, _, signature = rest.partition("_")
+    payload = f"{client_id}_{expires}"
+    if not hmac.compare_digest(signature, _telegram_link_signature(payload)):
+        return None
+    try:
+        if int(expires) < time.time():
+            return None
+        return int(client_id)
+    except ValueError:
+        return None
+
+
+def _unauthorized(detail: str) -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail=detail,
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+
+
+def _decode(token: str, role: str) -> dict:
+    try:
+        claims = jwt.decode(
+            token,
+            settings.JWT_SECRET_KEY,
+            algorithms=[settings.JWT_ALGORITHM],
+            options={"require": ["sub", "exp", "role"]},
+        )
+    except jwt.ExpiredSignatureError:
+        raise _unauthorized("Срок действия токена истёк")
+    except jwt.InvalidTokenError:
+        raise _unauthorized("Недействительный токен")
+    if claims["role"] != role:
+        raise _unauthorized("Недействительный токен")
+    return claims
+
+
+def decode_access_token(token: str) -> CurrentClient:
+    claims = _decode(token, CLIENT_ROLE)
+    try:
+        return CurrentClient(id=int(claims["sub"]), phone=claims["phone"])
+    except (KeyError, ValueError):
+        raise _unauthorized("Недействительный токен")
+
+
+def decode_operator_token(token: str) -> CurrentOperator:
+    claims = _decode(token, OPERATOR_ROLE)
+    try:
+        return CurrentOperator(id=int(claims["sub"]), login=claims["login"])
+    except (KeyError, ValueError):
+        raise _unauthorized("Недействительный токен")
+
+
+def get_optional_client(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme),
+) -> Optional[CurrentClient]:
+    """Клиент из токена или None, если заголовка Authorization нет."""
+    if credentials is None:
+        return None
+    return decode_access_token(credentials.credentials)
+
+
+def get_current_client(
+    client: Optional[CurrentClient] = Depends(get_optional_client),
+) -> CurrentClient:
+    if client is None:
+        raise _unauthorized("Требуется авторизация")
+    return client
+
+
+def get_current_operator(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme),
+) -> CurrentOperator:
+    if credentials is None:
+        raise _unauthorized("Требуется авторизация оператора")
+    return decode_operator_token(credentials.credentials)
+
+
+def get_stream_operator(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(bearer_scheme),
+    access_token: Optional[str] = Query(None, description="Токен оператора для EventSource, который не умеет заголовки"),
+) -> CurrentOperator:
+    """Как get_current_operator, но токен можно передать и в ?access_token=."""
+    if credentials is not None:
+        return decode_operator_token(credentials.credentials)
+    if access_token:
+        return decode_operator_token(access_token)
+    raise _unauthorized("Требуется авторизация оператора")
+
+
+# ----------------------------
+# CLI: заведение операторов
+# ----------------------------
+def main(argv=None) -> int:
+    from ..models import Operator
+    from .db import SessionLocal
+
+    parser = argparse.ArgumentParser(prog="python -m backend.services.security", description="Операторы панели")
+    parser.add_argument("command", choices=["create-operator", "set-password", "deactivate"])
+    parser.add_argument("login")
+    args = parser.parse_args(argv)
+
+    with SessionLocal() as db:
+        operator = db.query(Operator).filter(Operator.login == args.login).first()
+        if args.command == "deactivate":
+            if operator is None:
+                print(f"Оператор {args.login} не найден")
+                return 1
+            operator.is_active = False
+            db.commit()
+            print(f"Оператор {args.login} отключён; выданные токены действуют до истечения срока")
+            return 0
+        if args.command == "create-operator" and operator is not None:
+            print(f"Оператор {args.login} уже есть")
+            return 1
+        if args.command == "set-password" and operator is None:
+            print(f"Оператор {args.login} не найден")
+            return 1
+        password = getpass.getpass("Пароль: ")
+        if len(password) < 8 or password != getpass.getpass("Ещё раз: "):
+            print("Пароль короче 8 символов или не совпадает")
+            return 1
+        if operator is None:
+            operator = Operator(login=args.login, password_hash=hash_password(password))
+            db.add(operator)
+        else:
+            operator.password_hash = hash_password(password)
+            operator.is_active = True
+        db.commit()
+    print(f"Готово: {args.login}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,263 @@
+"""
+Движок шаблонов ответов из таблицы templates.
+
+Шаблоны целиком держатся в памяти, сгруппированные по категории, плейсхолдеры
+разобраны заранее — подбор и подстановка занимают микросекунды, без БД и модели.
+Плейсхолдеры — в синтаксисе str.format: {full_name}, {ticket_id}, {balance:.2f}.
+Из шаблонов категории выбирается самый конкретный (больше всего плейсхолдеров),
+для которого известны все значения; если подходящего нет, отвечает модель.
+
+Изменения таблицы подхватываются без рестарта: фоновый цикл раз в
+TEMPLATES_RELOAD_SECONDS сверяет отпечаток таблицы и перечитывает её, если он
+изменился. Там же в templates.uses сбрасываются накопленные счётчики использования.
+"""
+import asyncio
+import logging
+import string
+import threading
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import Dict, FrozenSet, List, Optional, Tuple
+
+from anyio import to_thread
+from sqlalchemy import bindparam, select, text, update
+
+from ..config import settings
+from ..models import Template
+from .db import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+TICKET_FIELDS = frozenset({"ticket_id", "subject", "category", "phone"})
+CLIENT_FIELDS = frozenset({"full_name", "email", "tariff", "balance", "debt"})
+MONEY_FIELDS = frozenset({"balance", "debt"})
+ALLOWED_FIELDS = TICKET_FIELDS | CLIENT_FIELDS
+
+# Значения тех же типов, что приходят при подстановке: на них шаблон пробно
+# рендерится при сохранении, и {balance:d} (Decimal) отклоняется сразу, а не на заявке
+SAMPLE_VALUES = {
+    "ticket_id": 12345,
+    "subject": "Нет интернета",
+    "category": "инцидент",
+    "phone": "+70000000000",
+    "full_name": "Иван Иванов",
+    "email": "ivan@example.com",
+    "tariff": "Базовый",
+    "balance": Decimal("1234.50"),
+    "debt": Decimal("0.00"),
+}
+
+# Что может бросить str.format на неподходящем формате или значении
+_FORMAT_ERRORS = (ValueError, TypeError, KeyError, IndexError, AttributeError)
+
+# Категория шаблона для деградированного режима, когда категория заявки неизвестна
+DEFAULT_CATEGORY = "default"
+
+# Меняется при любом изменении строк, но не при обновлении счётчиков uses
+_FINGERPRINT_SQL = text(
+    "SELECT count(*), md5(coalesce(string_agg("
+    "id::text || ':' || name || ':' || category || ':' || md5(text), ',' ORDER BY id), '')) "
+    "FROM templates"
+)
+
+
+class TemplateError(ValueError):
+    pass
+
+
+def parse_fields(body: str) -> FrozenSet[str]:
+    """
+    Плейсхолдеры шаблона; TemplateError, если синтаксис неверный, поле неизвестно
+    или формат не подходит к типу значения (пробный рендер на SAMPLE_VALUES).
+    """
+    try:
+        names = {name for _, name, _, _ in string.Formatter().parse(body) if name is not None}
+    except ValueError as e:
+        raise TemplateError(f"Некорректный шаблон: {e}")
+    unknown = names - ALLOWED_FIELDS
+    if unknown:
+        raise TemplateError(
+            f"Неизвестные поля: {', '.join(sorted(unknown))}; доступны: {', '.join(sorted(ALLOWED_FIELDS))}"
+        )
+    try:
+        body.format_map(SAMPLE_VALUES)
+    except _FORMAT_ERRORS as e:
+        raise TemplateError(f"Шаблон не подставляется: {e}")
+    return frozenset(names)
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    id: int
+    name: str
+    category: str
+    text: str
+    fields: FrozenSet[str]
+
+
+@dataclass(frozen=True)
+class Rendered:
+    template_id: int
+    name: str
+    text: str
+
+
+class TemplateEngine:
+    def __init__(self, session_factory=SessionLocal, reload_seconds: float = settings.TEMPLATES_RELOAD_SECONDS):
+        self.session_factory = session_factory
+        self.reload_seconds = reload_seconds
+        # Индекс заменяется целиком, читатели без блокировок видят либо старый, либо новый
+        self._by_category: Dict[str, List[CompiledTemplate]] = {}
+        self._fingerprint = None
+        self.loaded_at: Optional[datetime] = None
+        self._lock = threading.Lock()
+        self._pending: Dict[int, int] = {}
+        self._last_used: Dict[int, datetime] = {}
+        self._stats = {"hits": 0, "misses": 0, "reloads": 0, "invalid": 0, "render_errors": 0}
+        self._task: Optional[asyncio.Task] = None
+
+    # ---------- загрузка ----------
+    def reload(self, force: bool = False) -> bool:
+        """Перечитывает таблицу, если она изменилась. Возвращает True, если индекс обновлён."""
+        with self.session_factory() as db:
+            fingerprint = tuple(db.execute(_FINGERPRINT_SQL).one())
+            if not force and fingerprint == self._fingerprint:
+                return False
+            rows = db.execute(select(Template).order_by(Template.id)).scalars().all()
+
+        by_category: Dict[str, List[CompiledTemplate]] = {}
+        invalid = 0
+        for row in rows:
+            try:
+                fields = parse_fields(row.text)
+            except TemplateError as e:
+                invalid += 1
+                logger.warning("Шаблон %s пропущен: %s", row.name, e)
+                continue
+            by_category.setdefault(row.category, []).append(
+                CompiledTemplate(row.id, row.name, row.category, row.text, fields)
+            )
+        for templates in by_category.values():
+            # Сначала самые конкретные
+            templates.sort(key=lambda t: (-len(t.fields), t.id))
+
+        self._by_category = by_category
+        self._fingerprint = fingerprint
+        self.loaded_at = datetime.now(timezone.utc)
+        self._stats["reloads"] += 1
+        self._stats["invalid"] = invalid
+        logger.info("Шаблоны ответов загружены: %d", sum(len(t) for t in by_category.values()))
+        return True
+
+    # ---------- подбор ----------
+    def active(self) -> bool:
+        """Есть ли шаблоны для обычных ответов (не только default)."""
+        return settings.TEMPLATES_ENABLED and any(c != DEFAULT_CATEGORY for c in self._by_category)
+
+    def has(self, category: str) -> bool:
+        return settings.TEMPLATES_ENABLED and category in self._by_category
+
+    def fields(self, category: str) -> FrozenSet[str]:
+        """Все плейсхолдеры шаблонов категории — чтобы не грузить профиль клиента зря."""
+        return frozenset().union(*(t.fields for t in self._by_category.get(category, ())))
+
+    def render(self, category: str, values: dict) -> Optional[Rendered]:
+        """
+        Самый конкретный подходящий шаблон или None. Ошибка подстановки (значение
+        не того типа) значит «шаблон не подходит»: берётся следующий, затем модель.
+        """
+        if not settings.TEMPLATES_ENABLED:
+            return None
+        known = {name for name, value in values.items() if value is not None}
+        for template in self._by_category.get(category, ()):
+            if template.fields <= known:
+                try:
+                    body = template.text.format_map(values)
+                except _FORMAT_ERRORS as e:
+                    with self._lock:
+                        self._stats["render_errors"] += 1
+                    logger.warning("Шаблон %s не подставился: %s", template.name, e)
+                    continue
+                self._used(template.id)
+                return Rendered(template.id, template.name, body)
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def _used(self, template_id: int) -> None:
+        with self._lock:
+            self._stats["hits"] += 1
+            self._pending[template_id] = self._pending.get(template_id, 0) + 1
+            self._last_used[template_id] = datetime.now(timezone.utc)
+
+    # ---------- статистика ----------
+    def flush_usage(self) -> None:
+        """Добавляет накопленные счётчики в templates.uses."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            last_used = {tid: self._last_used[tid] for tid in pending}
+        if not pending:
+            return
+        try:
+            with self.session_factory() as db:
+                db.connection().execute(
+                    update(Template.__table__)
+                    .where(Template.__table__.c.id == bindparam("tid"))
+                    .values(uses=Template.__table__.c.uses + bindparam("n"), last_used_at=bindparam("at")),
+                    [{"tid": tid, "n": n, "at": last_used[tid]} for tid, n in pending.items()],
+                )
+                db.commit()
+        except Exception:
+            # Не теряем счётчики: вернём их в следующий сброс
+            with self._lock:
+                for tid, n in pending.items():
+                    self._pending[tid] = self._pending.get(tid, 0) + n
+            raise
+
+    def pending_usage(self) -> Dict[int, Tuple[int, datetime]]:
+        """Использования этого процесса, ещё не сброшенные в БД: {id: (число, когда последнее)}."""
+        with self._lock:
+            return {tid: (n, self._last_used[tid]) for tid, n in self._pending.items()}
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        return {
+            **stats,
+            "templates": sum(len(t) for t in self._by_category.values()),
+            "categories": sorted(self._by_category),
+            "loaded_at": self.loaded_at,
+        }
+
+    # ---------- фоновый цикл ----------
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await to_thread.run_sync(self.flush_usage)
+        except Exception:
+            logger.exception("Не удалось сохранить счётчики шаблонов")
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await to_thread.run_sync(self.reload)
+            except Exception:
+                logger.exception("Не удалось загрузить шаблоны ответов")
+            try:
+                await to_thread.run_sync(self.flush_usage)
+            except Exception:
+                logger.exception("Не удалось сохранить счётчики шаблонов")
+            await asyncio.sleep(self.reload_seconds)
+
+
+engine = TemplateEngine()
@@ -0,0 +1,40 @@
+"""
+Модульные тесты без БД и OpenAI: настройки берутся из переменных окружения,
+поэтому обязательные задаются заглушками до импорта backend.
+
+    python -m pytest -q
+"""
+import os
+import sys
+
+for name, value in {
+    "APP_DB_USER": "test",
+    "APP_DB_PASSWORD": "test",
+    "APP_DB_NAME": "test",
+    "APP_JWT_SECRET_KEY": "test-secret",
+    "APP_OPENAI_API_KEY": "sk-test",
+    "APP_EMAIL_PORT": "587",
+}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest  # noqa: E402
+
+
+class FakeClock:
+    """Замена time.monotonic для модуля: время двигается только вручную."""
+
+    def __init__(self, start: float = 1000.0):
+        self.now = start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
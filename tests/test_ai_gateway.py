@@ -0,0 +1,158 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from backend.config import settings
+from backend.services import ai_gateway, resilience
+from backend.services.ai_gateway import RateLimited
+from backend.services.ratelimit import TokenBucket
+from backend.services.resilience import AIUnavailableError, CircuitBreaker
+
+
+@pytest.fixture(autouse=True)
+def gateway(monkeypatch):
+    """Свежие лимиты и breaker на каждый тест; повторы без пауз."""
+    monkeypatch.setattr(ai_gateway, "_slots", None)
+    monkeypatch.setattr(ai_gateway, "_global_tokens", TokenBucket(rate=1, capacity=1000))
+    monkeypatch.setattr(ai_gateway, "_stats", dict(ai_gateway._stats, in_flight=0))
+    monkeypatch.setattr(ai_gateway, "breaker", CircuitBreaker(
+        window=10, min_calls=10, error_rate=0.5, slow_seconds=60, slow_rate=1.0, open_seconds=30,
+    ))
+    monkeypatch.setattr(settings, "AI_RETRY_ATTEMPTS", 3)
+    monkeypatch.setattr(settings, "AI_RETRY_BASE_DELAY", 0.0)
+    monkeypatch.setattr(settings, "AI_RETRY_MAX_DELAY", 0.0)
+
+
+def failing(errors, result="ok"):
+    """call(), который сначала бросает errors по порядку, затем возвращает result."""
+    errors = list(errors)
+    calls = []
+
+    async def call():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    return call, calls
+
+
+# ---------- admission ----------
+def test_admit_rejects_client_over_burst(monkeypatch):
+    monkeypatch.setattr(settings, "AI_CLIENT_BURST", 2)
+    monkeypatch.setattr(settings, "AI_CLIENT_REQUESTS_PER_MINUTE", 1)
+    phone = "+70000000001"
+
+    async def scenario():
+        for _ in range(2):
+            await ai_gateway.admit(phone, 10, max_wait=0)
+            ai_gateway.release()
+        with pytest.raises(RateLimited) as exc:
+            await ai_gateway.admit(phone, 10, max_wait=0)
+        return exc.value
+
+    error = asyncio.run(scenario())
+    assert error.status_code == 429
+    assert int(error.headers["Retry-After"]) >= 1
+    assert ai_gateway._stats["rejected_client"] >= 1
+    assert ai_gateway._stats["in_flight"] == 0
+
+
+def test_admit_rejects_when_global_tokens_exhausted(monkeypatch):
+    monkeypatch.setattr(ai_gateway, "_global_tokens", TokenBucket(rate=1, capacity=100))
+
+    async def scenario():
+        await ai_gateway.admit(None, 100, max_wait=0)
+        ai_gateway.release()
+        with pytest.raises(RateLimited):
+            await ai_gateway.admit(None, 100, max_wait=0.01)
+
+    asyncio.run(scenario())
+    assert ai_gateway._stats["rejected_overload"] == 1
+
+
+def test_admit_queues_for_slot_and_times_out(monkeypatch):
+    monkeypatch.setattr(settings, "AI_MAX_CONCURRENT_CALLS", 1)
+
+    async def scenario():
+        await ai_gateway.admit(None, 1, max_wait=0.05)
+        assert ai_gateway._stats["in_flight"] == 1
+        with pytest.raises(RateLimited):
+            await ai_gateway.admit(None, 1, max_wait=0.05)
+        # Слот, освобождённый во время ожидания, достаётся стоящему в очереди
+        waiter = asyncio.ensure_future(ai_gateway.admit(None, 1, max_wait=1.0))
+        await asyncio.sleep(0.01)
+        ai_gateway.release()
+        await waiter
+        ai_gateway.release()
+
+    asyncio.run(scenario())
+    assert ai_gateway._stats["queued"] >= 2
+    assert ai_gateway._stats["in_flight"] == 0
+
+
+def test_check_breaker_raises_503_when_open():
+    for _ in range(10):
+        ai_gateway.breaker.record(False)
+    with pytest.raises(AIUnavailableError) as exc:
+        ai_gateway._check_breaker()
+    assert exc.value.status_code == 503
+    assert exc.value.headers["Retry-After"] == "30"
+
+
+# ---------- повторы и breaker ----------
+def test_retries_transient_errors_then_succeeds():
+    call, calls = failing([asyncio.TimeoutError(), asyncio.TimeoutError()])
+    assert asyncio.run(ai_gateway._call_with_retries(call, hedge=False)) == "ok"
+    assert len(calls) == 3
+    assert ai_gateway._stats["retries"] == 2
+    assert ai_gateway.breaker.stats()["errors"] == 2
+
+
+def test_gives_up_after_attempts_with_503():
+    call, calls = failing([asyncio.TimeoutError()] * 5)
+    with pytest.raises(AIUnavailableError):
+        asyncio.run(ai_gateway._call_with_retries(call, hedge=False))
+    assert len(calls) == 3
+
+
+def test_request_errors_are_not_retried_nor_counted_as_failures():
+    call, calls = failing([ValueError("bad request")])
+    with pytest.raises(ValueError):
+        asyncio.run(ai_gateway._call_with_retries(call, hedge=False))
+    assert len(calls) == 1
+    assert ai_gateway.breaker.stats()["errors"] == 0
+
+
+def test_stops_retrying_once_breaker_opens(monkeypatch):
+    monkeypatch.setattr(ai_gateway, "breaker", CircuitBreaker(
+        window=10, min_calls=1, error_rate=0.5, slow_seconds=60, slow_rate=1.0, open_seconds=30,
+    ))
+    call, calls = failing([asyncio.TimeoutError()] * 5)
+    with pytest.raises(AIUnavailableError) as exc:
+        asyncio.run(ai_gateway._call_with_retries(call, hedge=False))
+    assert len(calls) == 1
+    assert exc.value.headers["Retry-After"] == "30"
+
+
+def test_cancelled_probe_is_released(monkeypatch, clock):
+    monkeypatch.setattr(resilience, "time", SimpleNamespace(monotonic=clock))
+    breaker = CircuitBreaker(window=10, min_calls=1, error_rate=0.5, slow_seconds=60, slow_rate=1.0, open_seconds=30)
+    monkeypatch.setattr(ai_gateway, "breaker", breaker)
+    breaker.record(False)
+    clock.advance(30)
+    assert breaker.allow()
+
+    async def call():
+        await asyncio.sleep(10)
+
+    async def scenario():
+        task = asyncio.ensure_future(ai_gateway._call_with_retries(call, hedge=False))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert breaker.allow()
@@ -0,0 +1,141 @@
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import DataError, IntegrityError, OperationalError
+
+from backend.services import ai_log
+from backend.services.ai_log import AILogWriter
+
+
+class FakeDB:
+    """Сессия, которая «пишет» строки в written и падает по правилам fail(rows)."""
+
+    def __init__(self, written, fail):
+        self.written, self.fail = written, fail
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, statement, rows):
+        rows = rows if isinstance(rows, list) else [rows]
+        error = self.fail(rows)
+        if error:
+            raise error
+        self.written.extend(rows)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+def make_writer(fail=lambda rows: None, **kwargs):
+    written = []
+    writer = AILogWriter(session_factory=lambda: FakeDB(written, fail), **kwargs)
+    # Без фонового цикла put() пишет сразу; для тестов буфера держим его «запущенным»
+    writer._task = object()
+    writer._loop = SimpleNamespace(call_soon_threadsafe=lambda callback: None)
+    writer._wake = SimpleNamespace(set=None)
+    return writer, written
+
+
+def rows(n, bad=()):
+    return [dict(ai_log.entry("classify", ticket_id=i), bad=i in bad) for i in range(n)]
+
+
+def bad_rows(rows):
+    if any(r["bad"] for r in rows):
+        return DataError("INSERT", {}, Exception("value too long"))
+
+
+def test_flush_writes_in_batches():
+    writer, written = make_writer(batch_size=4)
+    writer.put(*rows(10))
+    assert writer.flush() == 10
+    assert len(written) == 10
+    assert writer.stats()["batches"] == 3
+
+
+def test_put_drops_over_capacity():
+    writer, _ = make_writer(max_size=5)
+    writer.put(*rows(8))
+    stats = writer.stats()
+    assert (stats["queued"], stats["dropped"], stats["buffered"]) == (5, 3, 5)
+
+
+def test_integrity_error_drops_only_offending_rows():
+    def fail(batch):
+        if len(batch) > 1:
+            return IntegrityError("INSERT", {}, Exception("fk"))
+        if batch[0]["ticket_id"] == 2:
+            return IntegrityError("INSERT", {}, Exception("fk"))
+
+    writer, written = make_writer(fail, batch_size=10)
+    writer.put(*rows(5))
+    assert writer.flush() == 4
+    assert [r["ticket_id"] for r in written] == [0, 1, 3, 4]
+    assert writer.stats()["dropped"] == 1
+
+
+def test_disconnect_keeps_batch_without_counting_attempts():
+    down = [True]
+
+    def fail(batch):
+        if down[0]:
+            return OperationalError("INSERT", {}, Exception("connection refused"))
+
+    writer, written = make_writer(fail, batch_size=10, max_attempts=2)
+    writer.put(*rows(5))
+    for _ in range(5):
+        with pytest.raises(OperationalError):
+            writer.flush()
+    assert writer.stats()["buffered"] == 5
+    down[0] = False
+    assert writer.flush() == 5
+    assert writer.stats()["dropped"] == 0
+
+
+def test_bad_row_is_isolated_after_max_attempts():
+    writer, written = make_writer(bad_rows, batch_size=8, max_attempts=3)
+    writer.put(*rows(8, bad={5}))
+    for _ in range(2):
+        with pytest.raises(DataError):
+            writer.flush()
+        assert writer.stats()["buffered"] == 8
+    assert writer.flush() == 7
+    assert sorted(r["ticket_id"] for r in written) == [0, 1, 2, 3, 4, 6, 7]
+    stats = writer.stats()
+    assert (stats["dropped"], stats["buffered"]) == (1, 0)
+
+
+def test_failing_batch_does_not_block_later_rows():
+    writer, written = make_writer(bad_rows, batch_size=4, max_attempts=2)
+    writer.put(*rows(4, bad={0, 1, 2, 3}))
+    writer.put(*rows(4))
+    with pytest.raises(DataError):
+        writer.flush()
+    assert writer.flush() == 4
+    stats = writer.stats()
+    assert (stats["written"], stats["dropped"], stats["buffered"]) == (4, 4, 0)
+
+
+def test_bisect_requeues_remainder_when_connection_drops():
+    def fail(batch):
+        if any(r["bad"] for r in batch):
+            return DataError("INSERT", {}, Exception("bad"))
+        return OperationalError("INSERT", {}, Exception("connection lost"))
+
+    writer, written = make_writer(fail, batch_size=8, max_attempts=1)
+    writer.put(*rows(8, bad={0}))
+    with pytest.raises(OperationalError):
+        writer.flush()
+    # Плохая строка отброшена, остальные ждут связи с БД в исходном порядке
+    stats = writer.stats()
+    assert (stats["dropped"], stats["buffered"]) == (1, 7)
+    batch, attempts = writer._retry[0]
+    assert [r["ticket_id"] for r in batch] == [1, 2, 3, 4, 5, 6, 7]
+    assert attempts == 0
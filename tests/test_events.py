@@ -0,0 +1,121 @@
+import asyncio
+
+from backend.services.events import Broker, Event, Filters
+
+
+def event(type="ticket.updated", ticket_id=1, **data) -> Event:
+    return Event(1, type, ticket_id, data)
+
+
+# ---------- Filters.matches ----------
+def test_empty_filters_match_everything():
+    assert Filters().matches(event())
+    assert Filters().matches(event("comment.created", ticket_id=None))
+
+
+def test_filter_by_type_and_ticket():
+    filters = Filters(types={"ticket.created"}, ticket_id=7)
+    assert filters.matches(event("ticket.created", 7))
+    assert not filters.matches(event("ticket.updated", 7))
+    assert not filters.matches(event("ticket.created", 8))
+
+
+def test_filter_by_field_value():
+    filters = Filters(values={"status": "new"})
+    assert filters.matches(event(status="new"))
+    assert not filters.matches(event(status="closed"))
+
+
+def test_missing_field_is_not_filtered_out():
+    # Комментарии и пакетные обновления не несут полей заявки
+    assert Filters(values={"status": "new"}).matches(event("comment.created", comment_id=3))
+
+
+def test_ticket_leaving_filter_is_delivered():
+    filters = Filters(values={"status": "new"})
+    assert filters.matches(event(status="closed", changes={"status": ["new", "closed"]}))
+    assert not filters.matches(event(status="closed", changes={"status": ["in_progress", "closed"]}))
+
+
+def test_reset_passes_any_filter():
+    filters = Filters(types={"comment.created"}, ticket_id=5, values={"category": "инцидент"})
+    assert filters.matches(Event(0, "reset", None, {"reason": "cursor_expired"}))
+
+
+# ---------- Broker ----------
+def published(broker: Broker, count: int) -> None:
+    broker._dispatch([{"type": "ticket.updated", "ticket_id": i, "status": "new"} for i in range(count)])
+
+
+def test_since_returns_missed_events():
+    broker = Broker(buffer_size=10)
+    published(broker, 5)
+    missed = broker._since(f"{broker.epoch}-2")
+    assert [e.id for e in missed] == [3, 4, 5]
+    assert broker._since(f"{broker.epoch}-5") == []
+
+
+def test_since_rejects_foreign_or_broken_cursor():
+    broker = Broker(buffer_size=10)
+    published(broker, 3)
+    assert broker._since("deadbeef-1") is None
+    assert broker._since(f"{broker.epoch}-abc") is None
+    assert broker._since("garbage") is None
+
+
+def test_since_detects_evicted_events():
+    broker = Broker(buffer_size=3)
+    published(broker, 6)  # в буфере 4..6
+    assert broker._since(f"{broker.epoch}-3") is not None
+    assert broker._since(f"{broker.epoch}-2") is None
+
+
+def test_subscribe_replays_missed_events_through_filters():
+    broker = Broker(buffer_size=10)
+    published(broker, 4)
+
+    async def scenario():
+        sub = broker.subscribe(Filters(ticket_id=2), last_event_id=f"{broker.epoch}-1")
+        return [sub.queue.get_nowait() for _ in range(sub.queue.qsize())]
+
+    assert [(e.id, e.ticket_id) for e in asyncio.run(scenario())] == [(3, 2)]
+
+
+def test_subscribe_with_expired_cursor_starts_with_reset():
+    broker = Broker(buffer_size=2)
+    published(broker, 5)
+
+    async def scenario():
+        sub = broker.subscribe(Filters(types={"comment.created"}), last_event_id=f"{broker.epoch}-1")
+        return sub.queue.get_nowait()
+
+    first = asyncio.run(scenario())
+    assert first.type == "reset"
+    assert first.data["reason"] == "cursor_expired"
+
+
+def test_subscribe_resets_when_missed_events_overflow_queue():
+    broker = Broker(buffer_size=20, queue_size=3)
+    published(broker, 10)
+
+    async def scenario():
+        sub = broker.subscribe(Filters(), last_event_id=f"{broker.epoch}-0")
+        return [sub.queue.get_nowait() for _ in range(sub.queue.qsize())]
+
+    events = asyncio.run(scenario())
+    assert [e.type for e in events] == ["reset"]
+    assert events[0].data["reason"] == "too_many_missed"
+
+
+def test_slow_subscriber_is_dropped():
+    broker = Broker(buffer_size=20, queue_size=2)
+
+    async def scenario():
+        sub = broker.subscribe(Filters())
+        published(broker, 3)
+        return sub
+
+    sub = asyncio.run(scenario())
+    assert sub.overflowed
+    assert sub not in broker._subscribers
+    assert broker.stats()["dropped_subscribers"] == 1
@@ -0,0 +1,110 @@
+from types import SimpleNamespace
+
+import pytest
+
+from backend.services.local_classifier import LocalClassifier, _split, load_training_data, report, tokenize
+
+SAMPLES = [
+    ("Нет интернета с утра", "инцидент"),
+    ("Интернет пропал, роутер мигает", "инцидент"),
+    ("Не работает интернет дома", "инцидент"),
+    ("Списали деньги дважды за тариф", "жалоба"),
+    ("Неправильный счёт за месяц, верните деньги", "жалоба"),
+    ("Почему списали деньги", "жалоба"),
+]
+
+
+def test_tokenize_adds_stems_and_bigrams():
+    features = tokenize("Ёлка интернетом")
+    assert "елка" in features
+    assert "~интер" in features
+    assert "~елка_интер" not in features
+    assert "елка_интер" in features
+
+
+def test_predicts_trained_categories():
+    model = LocalClassifier.train(SAMPLES)
+    label, confidence = model.predict("опять нет интернета")
+    assert label == "инцидент"
+    assert 0.5 < confidence <= 1.0
+    assert model.predict("списали лишние деньги")[0] == "жалоба"
+
+
+def test_unknown_words_give_zero_confidence():
+    model = LocalClassifier.train(SAMPLES)
+    assert model.predict("qwerty zxcvb")[1] == 0.0
+
+
+def test_train_requires_samples():
+    with pytest.raises(ValueError):
+        LocalClassifier.train([])
+
+
+def test_save_and_load_roundtrip(tmp_path):
+    model = LocalClassifier.train(SAMPLES)
+    path = str(tmp_path / "model.json")
+    model.save(path)
+    loaded = LocalClassifier.load(path)
+    for text, _ in SAMPLES:
+        assert loaded.predict(text) == pytest.approx(model.predict(text))
+
+
+def test_split_is_deterministic():
+    samples = [(f"заявка {i}", "инцидент") for i in range(200)]
+    train, test = _split(samples, 0.2)
+    assert _split(samples, 0.2) == (train, test)
+    assert len(train) + len(test) == 200
+    assert 10 < len(test) < 80
+
+
+def test_report_counts_accuracy_and_coverage():
+    model = LocalClassifier.train(SAMPLES)
+    result = report(model, SAMPLES, threshold=0.0)
+    assert result["samples"] == len(SAMPLES)
+    assert result["accuracy"] == 1.0
+    assert result["coverage"] == 1.0
+    assert set(result["per_class"]) == {"инцидент", "жалоба"}
+
+
+class FakeQuery:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def outerjoin(self, *args):
+        return self
+
+    def filter(self, *args):
+        return self
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class FakeDB:
+    def __init__(self, logs, operator_labels):
+        self.results = [logs, operator_labels]
+
+    def query(self, *columns):
+        return FakeQuery(self.results.pop(0))
+
+
+def test_training_data_skips_own_predictions_and_prefers_operator():
+    logs = [
+        SimpleNamespace(request_payload=None, response_payload={"category": "инцидент"}, text="Нет сети"),
+        SimpleNamespace(request_payload=None, response_payload={"category": "жалоба", "source": "openai"},
+                        text="Двойное списание"),
+        SimpleNamespace(request_payload=None, response_payload={"category": "инцидент", "source": "local"},
+                        text="Свои предсказания"),
+        SimpleNamespace(request_payload=None, response_payload={"category": "инцидент", "source": "duplicate"},
+                        text="Дубль"),
+        SimpleNamespace(request_payload={"text": "Старый формат"}, response_payload={"category": "жалоба"},
+                        text=None),
+        SimpleNamespace(request_payload=None, response_payload={"category": "выдумка"}, text="Мусор"),
+    ]
+    operator_labels = [("нет сети", "жалоба")]
+    samples = dict(load_training_data(FakeDB(logs, operator_labels)))
+    assert samples == {
+        "нет сети": "жалоба",
+        "Двойное списание": "жалоба",
+        "Старый формат": "жалоба",
+    }
@@ -0,0 +1,196 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import openai
+import pytest
+
+from backend.services import resilience
+from backend.services.resilience import CircuitBreaker, LatencyWindow, backoff_delay, hedged, is_retryable
+
+
+def make_breaker(clock, monkeypatch, **overrides) -> CircuitBreaker:
+    monkeypatch.setattr(resilience, "time", SimpleNamespace(monotonic=clock))
+    params = dict(window=10, min_calls=4, error_rate=0.5, slow_seconds=5.0, slow_rate=0.75, open_seconds=30.0)
+    params.update(overrides)
+    return CircuitBreaker(**params)
+
+
+# ---------- CircuitBreaker ----------
+def test_breaker_stays_closed_below_min_calls(clock, monkeypatch):
+    breaker = make_breaker(clock, monkeypatch)
+    for _ in range(3):
+        breaker.record(False)
+    assert breaker.state == "closed"
+    assert breaker.allow()
+
+
+def test_breaker_opens_on_error_rate(clock, monkeypatch):
+    breaker = make_breaker(clock, monkeypatch)
+    for ok in (True, False, True, False):
+        breaker.record(ok)
+    assert breaker.state == "open"
+    assert breaker.trips == 1
+    assert not breaker.allow()
+    assert breaker.is_open()
+    assert breaker.retry_after() == 30.0
+
+
+def test_breaker_opens_on_slow_calls(clock, monkeypatch):
+    breaker = make_breaker(clock, monkeypatch)
+    for latency in (6.0, 6.0, 6.0, 1.0):
+        breaker.record(True, latency)
+    assert breaker.state == "open"
+
+
+def test_breaker_ignores_old_outcomes_outside_window(clock, monkeypatch):
+    breaker = make_breaker(clock, monkeypatch, window=4)
+    breaker.record(False)
+    for _ in range(4):
+        breaker.record(True)
+    breaker.record(False)
+    assert breaker.state == "closed"
+
+
+def test_breaker_half_open_allows_single_probe(clock, monkeypatch):
+    breaker = make_breaker(clock, monkeypatch, min_calls=1)
+    breaker.record(False)
+    clock.advance(29)
+    assert not breaker.allow()
+    clock.advance(1)
+    assert not breaker.is_open()
+    assert breaker.allow()
+    assert breaker.state == "half_open"
+    # Пока пробный вызов не завершён, остальные не проходят
+    assert not breaker.allow()
+    assert breaker.stats()["state"] == "half_open"
+
+
+def test_breaker_probe_success_closes(clock, monkeypatch):
+    breaker = make_breaker(clock, monkeypatch, min_calls=1)
+    breaker.record(False)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record(True, 0.1)
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+@pytest.mark.parametrize("ok, latency", [(False, 0.1), (True, 10.0)])
+def test_breaker_probe_failure_or_slow_reopens(clock, monkeypatch, ok, latency):
+    breaker = make_breaker(clock, monkeypatch, min_calls=1)
+    breaker.record(False)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.record(ok, latency)
+    assert breaker.state == "open"
+    assert breaker.trips == 2
+    assert not breaker.allow()
+
+
+def test_breaker_release_probe_lets_next_probe_through(clock, monkeypatch):
+    breaker = make_breaker(clock, monkeypatch, min_calls=1)
+    breaker.record(False)
+    clock.advance(30)
+    assert breaker.allow()
+    breaker.release_probe()
+    assert breaker.allow()
+
+
+# ---------- повторы ----------
+def _request() -> httpx.Request:
+    return httpx.Request("POST", "https://api.openai.com/v1/chat/completions")
+
+
+def _status_error(code: int) -> openai.APIStatusError:
+    return openai.APIStatusError("error", response=httpx.Response(code, request=_request()), body=None)
+
+
+@pytest.mark.parametrize("error, expected", [
+    (asyncio.TimeoutError(), True),
+    (openai.APIConnectionError(request=_request()), True),
+    (_status_error(429), True),
+    (_status_error(500), True),
+    (_status_error(503), True),
+    (_status_error(400), False),
+    (_status_error(401), False),
+    (ValueError("bad"), False),
+])
+def test_is_retryable(error, expected):
+    assert is_retryable(error) is expected
+
+
+def test_backoff_delay_is_bounded(monkeypatch):
+    monkeypatch.setattr(resilience.random, "uniform", lambda low, high: high)
+    assert [backoff_delay(a, 0.5, 4.0) for a in range(5)] == [0.5, 1.0, 2.0, 4.0, 4.0]
+
+
+def test_backoff_delay_has_jitter():
+    delays = {backoff_delay(3, 0.5, 4.0) for _ in range(50)}
+    assert len(delays) > 1
+    assert all(0 <= d <= 4.0 for d in delays)
+
+
+def test_latency_window_percentile():
+    window = LatencyWindow(size=100)
+    for i in range(19):
+        window.add(i)
+    assert window.percentile(0.95) is None
+    window.add(19)
+    assert window.percentile(0.95) == 19
+    assert window.percentile(0.5) == 10
+
+
+# ---------- hedged ----------
+def test_hedged_without_threshold_makes_one_call():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        return "ok"
+
+    assert asyncio.run(hedged(call, None)) == "ok"
+    assert len(calls) == 1
+
+
+def test_hedged_second_call_wins_and_first_is_cancelled():
+    started, cancelled, hedges = [], [], []
+
+    async def call():
+        n = len(started)
+        started.append(n)
+        try:
+            await asyncio.sleep(1.0 if n == 0 else 0.01)
+        except asyncio.CancelledError:
+            cancelled.append(n)
+            raise
+        return n
+
+    result = asyncio.run(hedged(call, 0.01, on_hedge=lambda: hedges.append(1)))
+    assert result == 1
+    assert cancelled == [0]
+    assert hedges == [1]
+
+
+def test_hedged_returns_success_when_one_call_fails():
+    started = []
+
+    async def call():
+        n = len(started)
+        started.append(n)
+        if n == 0:
+            await asyncio.sleep(0.02)
+            raise asyncio.TimeoutError()
+        await asyncio.sleep(0.05)
+        return "second"
+
+    assert asyncio.run(hedged(call, 0.01)) == "second"
+
+
+def test_hedged_raises_when_all_calls_fail():
+    async def call():
+        await asyncio.sleep(0.02)
+        raise ValueError("down")
+
+    with pytest.raises(ValueError):
+        asyncio.run(hedged(call, 0.01))
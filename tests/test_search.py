@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+
+from backend.services import search
+
+np = pytest.importorskip("numpy")
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+# ---------- cluster ----------
+def test_cluster_groups_similar_and_drops_small():
+    ids = [10, 11, 12, 20, 21, 30]
+    vectors = np.stack([
+        unit(1, 0, 0), unit(0.99, 0.1, 0), unit(0.98, 0, 0.1),
+        unit(0, 1, 0), unit(0.1, 0.99, 0),
+        unit(0, 0, 1),
+    ])
+    clusters = search.cluster(ids, vectors, threshold=0.9, min_size=2)
+    assert sorted(sorted(c) for c in clusters) == [[10, 11, 12], [20, 21]]
+    # Самый большой кластер — первым, его центр — первая заявка
+    assert sorted(clusters[0]) == [10, 11, 12]
+
+
+def test_cluster_does_not_chain_through_bridge():
+    # Соседние векторы (через 20°) похожи, дальние — нет: связные компоненты
+    # склеили бы всю цепочку в один инцидент
+    ids = [1, 2, 3, 4, 5]
+    vectors = np.stack([unit(np.cos(a), np.sin(a)) for a in np.radians([0, 20, 40, 60, 80])])
+    clusters = search.cluster(ids, vectors, threshold=0.9, min_size=1)
+    assert clusters == [[2, 1, 3], [4, 5]]
+
+
+def test_cluster_empty():
+    assert search.cluster([], np.zeros((0, 4), dtype=np.float32), 0.5, 1) == []
+
+
+def test_embed_is_normalized_and_similar_for_similar_texts():
+    a = search.embed("Нет интернета в квартире", 256)
+    b = search.embed("нет интернета в квартире с утра", 256)
+    c = search.embed("Верните деньги за тариф", 256)
+    assert np.linalg.norm(a) == pytest.approx(1.0, abs=1e-5)
+    assert float(a @ b) > float(a @ c)
+
+
+# ---------- VectorIndex ----------
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def all(self):
+        return self.rows
+
+    def scalar_one_or_none(self):
+        return None
+
+
+class FakeDB:
+    """Видимые (закоммиченные) заявки; запросы различаются по тексту SQL."""
+
+    def __init__(self, visible):
+        self.visible = visible
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, statement):
+        sql = str(statement)
+        params = list(statement.compile().params.values())
+        rows = sorted(self.visible.values(), key=lambda r: r.id)
+        if "OFFSET" in sql:
+            return FakeResult([])
+        if "now()" in sql:
+            return FakeResult([r for r in rows if r.id <= params[0]])
+        last_id, limit = params[0], params[1]
+        return FakeResult([r for r in rows if r.id > last_id][:limit])
+
+
+def ticket(ticket_id, text="нет интернета"):
+    return SimpleNamespace(id=ticket_id, subject=None, text=text, created_at=datetime.utcnow())
+
+
+def test_index_picks_up_ticket_committed_out_of_order():
+    visible = {}
+    index = search.VectorIndex(dim=32, max_items=100, session_factory=lambda: FakeDB(visible))
+    visible[1] = ticket(1)
+    assert index.refresh() == 1
+    # Заявка 3 закоммичена раньше заявки 2
+    visible[3] = ticket(3)
+    assert index.refresh() == 1
+    visible[2] = ticket(2)
+    assert index.refresh() == 1
+    assert index.refresh() == 0
+    _, ids, _ = index._snapshot()
+    assert sorted(ids.tolist()) == [1, 2, 3]
+
+
+def test_index_search_respects_since_and_exclude():
+    index = search.VectorIndex(dim=64, max_items=100, session_factory=None)
+    now = datetime.utcnow()
+    texts = ["нет интернета дома", "нет интернета в офисе", "верните деньги"]
+    index.add([1, 2, 3], texts, [search._epoch(now - timedelta(days=2)), search._epoch(now), search._epoch(now)])
+    vector = search.embed("нет интернета", 64)
+    assert [i for i, _ in index.search(vector, k=3)][:2] in ([1, 2], [2, 1])
+    assert [i for i, _ in index.search(vector, k=3, since=now - timedelta(hours=1), min_score=0.3)] == [2]
+    assert 2 not in [i for i, _ in index.search(vector, k=3, exclude=[2])]
+
+
+def test_index_trims_oldest_when_full():
+    index = search.VectorIndex(dim=16, max_items=10, session_factory=None)
+    index.add(list(range(1, 12)), [f"заявка {i}" for i in range(1, 12)], [0.0] * 11)
+    _, ids, _ = index._snapshot()
+    assert len(ids) == 9
+    assert ids.tolist() == list(range(3, 12))
@@ -0,0 +1,111 @@
+from decimal import Decimal
+from types import SimpleNamespace
+
+import pytest
+
+from backend.services import templates
+from backend.services.templates import TemplateEngine, TemplateError, parse_fields
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self.rows = rows
+
+    def one(self):
+        return self.rows
+
+    def scalars(self):
+        return self
+
+    def all(self):
+        return self.rows
+
+
+class FakeDB:
+    def __init__(self, rows, fingerprint):
+        self.rows, self.fingerprint = rows, fingerprint
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def execute(self, statement):
+        if statement is templates._FINGERPRINT_SQL:
+            return FakeResult(self.fingerprint)
+        return FakeResult(self.rows)
+
+
+def make_engine(*bodies, category="инцидент", fingerprint=(1, "a")):
+    rows = [
+        SimpleNamespace(id=i, name=f"t{i}", category=category, text=body)
+        for i, body in enumerate(bodies, start=1)
+    ]
+    engine = TemplateEngine(session_factory=lambda: FakeDB(rows, fingerprint))
+    engine.reload()
+    return engine
+
+
+# ---------- parse_fields ----------
+def test_parse_fields_returns_placeholders():
+    assert parse_fields("Здравствуйте, {full_name}! Заявка #{ticket_id}, баланс {balance:.2f}") == {
+        "full_name", "ticket_id", "balance",
+    }
+    assert parse_fields("Без подстановок") == frozenset()
+
+
+@pytest.mark.parametrize("body", [
+    "Незакрытая {скобка",
+    "Поле {password}",
+    "Формат не для Decimal {balance:d}",
+    "Формат не для строки {full_name:.2f}",
+    "Атрибут {ticket_id.real.imag.nope}",
+])
+def test_parse_fields_rejects_bad_templates(body):
+    with pytest.raises(TemplateError):
+        parse_fields(body)
+
+
+# ---------- подбор и подстановка ----------
+def test_most_specific_template_wins():
+    engine = make_engine("Общий ответ", "Заявка #{ticket_id} принята", "{full_name}, заявка #{ticket_id} принята")
+    rendered = engine.render("инцидент", {"ticket_id": 5, "full_name": "Анна"})
+    assert rendered.text == "Анна, заявка #5 принята"
+    assert engine.render("инцидент", {"ticket_id": 5, "full_name": None}).text == "Заявка #5 принята"
+    assert engine.render("инцидент", {}).text == "Общий ответ"
+
+
+def test_unknown_category_is_a_miss():
+    engine = make_engine("Ответ")
+    assert engine.render("биллинг", {}) is None
+    assert engine.stats()["misses"] == 1
+
+
+def test_invalid_rows_are_skipped_on_reload():
+    engine = make_engine("Ответ {ticket_id}", "Плохой {balance:d}", "Неизвестное {secret}")
+    stats = engine.stats()
+    assert (stats["templates"], stats["invalid"]) == (1, 2)
+
+
+def test_render_error_falls_back_to_next_template():
+    engine = make_engine("Баланс {balance:.2f}", "Запасной ответ")
+    # Значение не того типа: шаблон не подставился — берётся следующий
+    rendered = engine.render("инцидент", {"balance": "не число"})
+    assert rendered.text == "Запасной ответ"
+    assert engine.stats()["render_errors"] == 1
+    assert engine.render("инцидент", {"balance": Decimal("10")}).text == "Баланс 10.00"
+
+
+def test_reload_skips_unchanged_table():
+    engine = make_engine("Ответ")
+    assert not engine.reload()
+    assert engine.reload(force=True)
+
+
+def test_usage_is_counted_per_template():
+    engine = make_engine("Ответ")
+    engine.render("инцидент", {})
+    engine.render("инцидент", {})
+    assert {tid: n for tid, (n, _) in engine.pending_usage().items()} == {1: 2}
+    assert engine.stats()["hits"] == 2